@@ -21,8 +21,9 @@ from .models import (
     DatasetImage,
     Analysis,
     Result,
+    Job,
 )
-from .forms import TrainModelForm, PerformAnalysisForm
+from .forms import TrainModelForm, PerformAnalysisForm, QuantizeModelForm
 
 
 User = get_user_model()
@@ -50,6 +51,9 @@ class MLModelAdmin(admin.ModelAdmin):
         'training_hparams_parsed',
         'learner_path',
         'parameters_path',
+        'inference_model_path',
+        'quantized_model_path',
+        'quantization_report_parsed',
         # 'snapshots_parsed',
     )
     readonly_fields = (
@@ -58,6 +62,7 @@ class MLModelAdmin(admin.ModelAdmin):
         'hparams',
         'hparams_parsed',
         'training_hparams_parsed',
+        'quantization_report_parsed',
         'snapshots_parsed',
         'model_actions',
     )
@@ -74,6 +79,11 @@ class MLModelAdmin(admin.ModelAdmin):
                self.admin_site.admin_view(self.process_analyze),
                name='mlmodel-analyze',
            ),
+           path(
+               '<path:mlmodel_id>/quantize/',
+               self.admin_site.admin_view(self.process_quantize),
+               name='mlmodel-quantize',
+           ),
         ] + super().get_urls()
 
     def process_train(self, request, mlmodel_id, *args, **kwargs):
@@ -92,6 +102,14 @@ class MLModelAdmin(admin.ModelAdmin):
             action_title='Perform Analysis',
         )
 
+    def process_quantize(self, request, mlmodel_id, *args, **kwargs):
+        return self.process_action(
+            request=request,
+            mlmodel_id=mlmodel_id,
+            action_form=QuantizeModelForm,
+            action_title='Quantize ML Model (int8)',
+        )
+
     def process_action(self, request, mlmodel_id, action_form, action_title):
         mlmodel = self.get_object(request, mlmodel_id)
 
@@ -105,9 +123,8 @@ class MLModelAdmin(admin.ModelAdmin):
                 except Exception as exc:
                     pass  # bc it was already added to be displayed to user
                 else:
-                    # TODO: message and redirect based on return from form.save
-                    self.message_user(request, 'Success')
-                    url = reverse('admin:coreapp_mlmodel_changelist')
+                    self.message_user(request, 'Queued (run by `manage.py run_workers`)')
+                    url = reverse('admin:coreapp_job_changelist')
                     return HttpResponseRedirect(url)
 
         context = self.admin_site.each_context(request)
@@ -126,6 +143,7 @@ class MLModelAdmin(admin.ModelAdmin):
         return mark_safe(f"""
             <a class="button" href="{reverse('admin:mlmodel-train', args=[obj.pk])}">Train</a>
             <a class="button" href="{reverse('admin:mlmodel-analyze', args=[obj.pk])}">Perform Analysis</a>
+            <a class="button" href="{reverse('admin:mlmodel-quantize', args=[obj.pk])}">Quantize</a>
         """)
 
     def hparams_parsed(self, obj):
@@ -137,6 +155,9 @@ class MLModelAdmin(admin.ModelAdmin):
     def training_hparams_parsed(self, obj):
         return mark_safe(f"<pre>{json.dumps(json.loads(obj.training_hparams_json_str), indent=4)}")
 
+    def quantization_report_parsed(self, obj):
+        return mark_safe(f"<pre>{json.dumps(json.loads(obj.quantization_report_json_str), indent=4)}")
+
     def snapshots_parsed(self, obj):
         return mark_safe(f"<pre>{json.dumps(json.loads(obj.snapshots_json_str), indent=4)}")
 
@@ -214,11 +235,13 @@ class LabelImageAdmin(admin.ModelAdmin):
 
 class ResultInline(nested_admin.NestedTabularInline):
     model = Result
-    fields = ('thumb_img_tag', 'counts_parsed')
-    readonly_fields = ('thumb_img_tag', 'counts_parsed')
+    fields = ('thumb_img_tag', 'counts_parsed', 'error')
+    readonly_fields = ('thumb_img_tag', 'counts_parsed', 'error')
     extra = 0
 
     def thumb_img_tag(self, obj):
+        if not obj.labelimage:  # (failed, see error)
+            return '-'
         return mark_safe(f'<a href="{make_image_field_url(obj.labelimage.image)}" target="_blank"><img src="{obj.labelimage.image_thumb.url}" /></a>')
     thumb_img_tag.short_description = "Thumbnail"
 
@@ -234,11 +257,13 @@ class AnalysisAdmin(nested_admin.NestedModelAdmin):
         'name',
         'created_at',
         'model',
+        'precision',
         'datasets',
         'count_labels_parsed'
     )
     readonly_fields = (
         'created_at',
+        'precision',
         'count_labels_parsed'
     )
 
@@ -246,6 +271,37 @@ class AnalysisAdmin(nested_admin.NestedModelAdmin):
         return mark_safe(f"<pre>{json.dumps(json.loads(obj.count_labels_json_str), indent=4)}")
 
 
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'type', 'status', 'attempts', 'worker_id', 'created_at', 'finished_at')
+    list_filter = ('type', 'status')
+    fields = (
+        'type',
+        'status',
+        'payload_parsed',
+        'progress_parsed',
+        'result_parsed',
+        'error',
+        'worker_id',
+        'lease_expires_at',
+        'attempts',
+        'max_attempts',
+        'created_at',
+        'started_at',
+        'finished_at',
+    )
+    readonly_fields = fields
+
+    def payload_parsed(self, obj):
+        return mark_safe(f"<pre>{json.dumps(json.loads(obj.payload_json_str), indent=4)}")
+
+    def progress_parsed(self, obj):
+        return mark_safe(f"<pre>{json.dumps(json.loads(obj.progress_json_str), indent=4)}")
+
+    def result_parsed(self, obj):
+        return mark_safe(f"<pre>{json.dumps(json.loads(obj.result_json_str), indent=4)}")
+
+
 @admin.register(User)
 class UserAdmin(BaseUserAdmin):
     fieldsets = (
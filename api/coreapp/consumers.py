@@ -3,7 +3,8 @@ import json
 from asgiref.sync import async_to_sync
 from channels.generic.websocket import WebsocketConsumer
 
-from .models import MLModel
+from .jobs import training_group_name
+from .models import Job, MLModel
 from utils.utils import pp
 
 
@@ -12,7 +13,7 @@ class TrainingProgressConsumer(WebsocketConsumer):
         self.model_id = int(self.scope['url_route']['kwargs']['model_id'])
         self.ts_id = int(self.scope['url_route']['kwargs']['training_session_id'])
 
-        self.group_name = f'training.model-{self.model_id}.ts-{self.ts_id}'
+        self.group_name = training_group_name(self.model_id, self.ts_id)
 
         # join group:
         # a group that progress can be broascast to is created so that progress
@@ -39,53 +40,24 @@ class TrainingProgressConsumer(WebsocketConsumer):
             self.handle_train(msg)
 
     def handle_train(self, msg):
-        # send message to WebSocket
-        self.send_to_channel_and_group({
-            'type': 'training_started',
-            'training_session_id': self.ts_id
-        })
-
+        # training runs in a worker process (see coreapp.jobs), which reports
+        # progress to this consumer's group
         model = MLModel.objects.get(pk=self.model_id)
-
-        def on_epoch_done(epoch, *args, **kwargs):
-            self.send_to_channel_and_group({
-                'type': 'training_progress',
-                'training_session_id': self.ts_id,
-                'epoch': epoch + 1,
-            })
-
-        fake = msg.get('__fake__', False)
-        params = dict(
+        payload = dict(
+            model_id=model.pk,
             dataset_ids=list(map(int, msg.get('dataset_ids'))),
             training_hparams=msg.get('training_hparams'),
-            on_epoch_done=on_epoch_done,
-            _fake=fake,
+            training_session_id=self.ts_id,
+            resume=msg.get('resume', False),
+            _fake=msg.get('__fake__', False),
         )
-
-        print(f"\n====== training:\n", pp(params))
-        # import pdb; pdb.set_trace()
-        res = model.train(**params)
-        if not fake:
-            json_safe_res = {
-                'scores': res['scores'],
-                'results': [
-                    (str(k), list(map(str, v))) for k, v in res['results'].items()
-                ],
-                'new_parameters_path': (
-                    str(res['new_parameters_path'])
-                    if res.get('new_parameters_path', None) else
-                    None),
-                'new_learner_path': (
-                    str(res['new_learner_path'])
-                    if res.get('new_learner_path', None) else
-                    None),
-            }
-        else:
-            json_safe_res = {}
+        print(f"\n====== training:\n", pp(payload))
+        job = Job.enqueue('train', payload)
 
         self.send_to_channel_and_group({
-            'type': 'training_done',
-            'result': json_safe_res,
+            'type': 'training_queued',
+            'training_session_id': self.ts_id,
+            'job_id': job.pk,
         })
 
     # receive message from room group
@@ -96,6 +68,16 @@ class TrainingProgressConsumer(WebsocketConsumer):
         # send message to WebSocket
         self.send_json({**msg, 'type': 'training_progress'})
 
+    def broadcast_training_batch_progress(self, msg):
+        if msg['_origin_consumer_id_'] == id(self):
+            return
+        self.send_json({**msg, 'type': 'training_batch_progress'})
+
+    def broadcast_training_queued(self, msg):
+        if msg['_origin_consumer_id_'] == id(self):
+            return
+        self.send_json({**msg, 'type': 'training_queued'})
+
     def broadcast_training_started(self, msg):
         if msg['_origin_consumer_id_'] == id(self):
             return
@@ -106,6 +88,16 @@ class TrainingProgressConsumer(WebsocketConsumer):
             return
         self.send_json({**msg, 'type': 'training_done'})
 
+    def broadcast_training_failed(self, msg):
+        if msg['_origin_consumer_id_'] == id(self):
+            return
+        self.send_json({**msg, 'type': 'training_failed'})
+
+    def broadcast_training_results(self, msg):
+        if msg['_origin_consumer_id_'] == id(self):
+            return
+        self.send_json({**msg, 'type': 'training_results'})
+
     def send_json(self, msg):
         self.send(text_data=json.dumps(msg))
 
@@ -1,10 +1,12 @@
 import json
+import time
 import traceback
 
 from django import forms
 from django.utils.html import mark_safe
 
-from .models import Dataset, Analysis
+import ml.api as ML
+from .models import Dataset, Job
 
 
 class TrainModelForm(forms.Form):
@@ -12,12 +14,21 @@ class TrainModelForm(forms.Form):
         choices=[(ds.id, ds.name) for ds in Dataset.objects.all()]
     )
     training_hparams = forms.CharField(widget=forms.Textarea, initial='{}')
+    resume = forms.BooleanField(
+        required=False, help_text="continue interrupted training from its last checkpoint")
 
     def save(self, mlmodel, user):
         try:
             training_hparams = json.loads(self.cleaned_data['training_hparams'])
             dataset_ids = list(map(int, self.cleaned_data['datasets']))
-            return mlmodel.train(dataset_ids, training_hparams)
+            return Job.enqueue('train', {
+                'model_id': mlmodel.pk,
+                'dataset_ids': dataset_ids,
+                'training_hparams': training_hparams,
+                # (progress is reported to this (websocket) training session)
+                'training_session_id': int(time.time()),
+                'resume': self.cleaned_data['resume'],
+            })
         except Exception as exc:
             self.add_error(None, str(exc) + ": \n\n" + traceback.format_exc())
             raise exc
@@ -29,6 +40,13 @@ class PerformAnalysisForm(forms.Form):
         choices=[(ds.id, ds.name) for ds in Dataset.objects.all()]
     )
     count_labels = forms.CharField(widget=forms.Textarea, initial='', required=False)
+    precision = forms.ChoiceField(
+        choices=[(p, p) for p in ML.INFERENCE_PRECISIONS], initial='float32',
+        help_text="int8 needs the model to be quantized first")
+    workers = forms.IntegerField(
+        required=False, min_value=0,
+        help_text=f"processes predicting images in parallel (default {ML.PREDICT_WORKERS}, "
+                  "0 for one per core)")
 
     def save(self, mlmodel, user):
         try:
@@ -36,9 +54,32 @@ class PerformAnalysisForm(forms.Form):
                 json.loads(self.cleaned_data['count_labels'])
                 if self.cleaned_data['count_labels'] else
                 None)
-            datasets = Dataset.objects.filter(pk__in=self.cleaned_data['datasets'])
-            return Analysis.perform(
-                mlmodel, datasets, count_labels, name=self.cleaned_data['analysis_name'])
+            mlmodel.get_inference_model_path(self.cleaned_data['precision'])
+            return Job.enqueue('analyze', {
+                'model_id': mlmodel.pk,
+                'dataset_ids': list(map(int, self.cleaned_data['datasets'])),
+                'count_labels': count_labels,
+                'name': self.cleaned_data['analysis_name'],
+                'precision': self.cleaned_data['precision'],
+                'workers': self.cleaned_data['workers'],
+            })
+        except Exception as exc:
+            self.add_error(None, str(exc) + ": \n\n" + traceback.format_exc())
+            raise exc
+
+
+class QuantizeModelForm(forms.Form):
+    datasets = forms.MultipleChoiceField(
+        choices=[(ds.id, ds.name) for ds in Dataset.objects.all()],
+        help_text="images to calibrate the int8 model on, and check it against the float one",
+    )
+
+    def save(self, mlmodel, user):
+        try:
+            return Job.enqueue('quantize', {
+                'model_id': mlmodel.pk,
+                'dataset_ids': list(map(int, self.cleaned_data['datasets'])),
+            })
         except Exception as exc:
             self.add_error(None, str(exc) + ": \n\n" + traceback.format_exc())
             raise exc
@@ -0,0 +1,310 @@
+"""
+Background jobs: what runs each type of Job, and the worker loop claiming and
+running them (worker processes are started by `manage.py run_workers`).
+
+Handlers report progress / results to the websocket consumers of the job
+through the channel layer.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+from pathlib import Path
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+import ml.api as ML
+from .models import Analysis, Dataset, Job, MLModel
+
+
+log = logging.getLogger(__name__)
+
+# min seconds between saves of (per batch) progress to the Job
+JOB_PROGRESS_SAVE_INTERVAL_S = 5
+
+
+def training_group_name(model_id, training_session_id):
+    return f'training.model-{model_id}.ts-{training_session_id}'
+
+
+def send_to_group(group_name, msg):
+    """Send a message to all websocket consumers of a group (see TrainingProgressConsumer)."""
+    async_to_sync(get_channel_layer().group_send)(group_name, {
+        **msg,
+        'type': 'broadcast_' + msg['type'],
+        # (not sent by any consumer, so every consumer forwards it)
+        '_origin_consumer_id_': None,
+    })
+
+
+class CoalescingGroupSender:
+    """
+    Send messages to a group (see send_to_group) at most `max_per_s` times per
+    second: messages sent meanwhile replace each other, and only the latest
+    goes out once the interval is over, so frequent progress updates don't
+    flood the channel layer.
+
+    Messages sent with `coalesce=False` go out right away (and drop any
+    pending, older, one).
+    """
+
+    def __init__(self, group_name, max_per_s=None):
+        self.group_name = group_name
+        self.min_interval_s = 1 / (max_per_s or settings.TRAINING_PROGRESS_MAX_MSGS_PER_SEC)
+        self._lock = threading.Lock()
+        self._pending = None
+        self._timer = None
+        self._last_sent_t = float('-inf')
+
+    def send(self, msg, coalesce=True):
+        with self._lock:
+            if not coalesce:
+                self._drop_pending()
+                self._send(msg)
+                return
+            wait_s = self._last_sent_t + self.min_interval_s - time.monotonic()
+            if wait_s <= 0 and self._pending is None:
+                self._send(msg)
+                return
+            self._pending = msg
+            if self._timer is None:
+                self._timer = threading.Timer(max(0., wait_s), self._flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _flush(self):
+        with self._lock:
+            self._timer = None
+            if self._pending is not None:
+                msg, self._pending = self._pending, None
+                self._send(msg)
+
+    def _drop_pending(self):
+        self._pending = None
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _send(self, msg):
+        self._last_sent_t = time.monotonic()
+        send_to_group(self.group_name, msg)
+
+
+def make_json_safe_results(results):
+    return [(str(k), list(map(str, v))) for k, v in results.items()]
+
+
+def run_train_job(job):
+    """
+    payload: {model_id, dataset_ids, training_hparams, training_session_id,
+              resume: bool, _fake: bool}
+    """
+    payload = job.payload
+    model = MLModel.objects.get(pk=payload['model_id'])
+    ts_id = payload['training_session_id']
+    group_name = training_group_name(model.pk, ts_id)
+    fake = payload.get('_fake', False)
+
+    send_to_group(group_name, {
+        'type': 'training_started',
+        'training_session_id': ts_id,
+        'job_id': job.pk,
+    })
+
+    sender = CoalescingGroupSender(group_name)
+
+    def on_epoch_done(epoch, *args, smooth_loss=None, last_metrics=None, **kwargs):
+        progress = {
+            'type': 'training_progress',
+            'training_session_id': ts_id,
+            'epoch': epoch + 1,
+            'train_loss': float(smooth_loss) if smooth_loss is not None else None,
+            'validation_loss': float(last_metrics[0]) if last_metrics else None,
+        }
+        job.set_progress(progress)
+        sender.send(progress, coalesce=False)
+
+    last_saved_t = [time.monotonic()]
+
+    def make_on_batch_done(run):
+        def on_batch_done(progress):
+            progress = {
+                'type': 'training_batch_progress',
+                'training_session_id': ts_id,
+                'run': run,
+                **progress,
+            }
+            sender.send(progress)
+            # (only saved now and then, the db doesn't need to keep up)
+            if time.monotonic() - last_saved_t[0] >= JOB_PROGRESS_SAVE_INTERVAL_S:
+                job.set_progress(progress)
+                last_saved_t[0] = time.monotonic()
+        return on_batch_done
+
+    # 'deferred' predictions get a (durable) job of their own
+    training_hparams = dict(payload.get('training_hparams') or {})
+    deferred = (
+        {**model.training_hparams, **training_hparams}.get('predict_after_training') or
+        ML.PREDICT_AFTER_TRAINING
+    ) == 'deferred'
+    if deferred:
+        training_hparams['predict_after_training'] = 'off'
+
+    try:
+        res = model.train(
+            dataset_ids=payload['dataset_ids'],
+            training_hparams=training_hparams,
+            on_epoch_done=on_epoch_done,
+            on_batch_done=make_on_batch_done('validated'),
+            on_final_batch_done=make_on_batch_done('final'),
+            # (a job re-claimed after its worker died continues from checkpoints)
+            resume=payload.get('resume', False) or job.attempts > 1,
+            _fake=fake,
+        )
+    except Exception as exc:
+        sender.send({
+            'type': 'training_failed',
+            'training_session_id': ts_id,
+            'error': str(exc),
+        }, coalesce=False)
+        raise
+
+    if fake:
+        result = {}
+    else:
+        result = {
+            'scores': res['scores'],
+            # (can be only some or none of the images, see predict_after_training)
+            'results': make_json_safe_results(res['results']),
+            'results_deferred': deferred,
+            'new_parameters_path': str(res['new_parameters_path']),
+            'new_learner_path': str(res['new_learner_path']),
+        }
+        if 'quantization_report' in res:
+            result['quantization_report'] = res['quantization_report']
+        if deferred:
+            result['predict_job_id'] = Job.enqueue('predict', {
+                'model_id': model.pk,
+                'dataset_ids': payload['dataset_ids'],
+                'training_session_id': ts_id,
+            }).pk
+
+    sender.send({
+        'type': 'training_done',
+        'result': result,
+    }, coalesce=False)
+    return result
+
+
+def run_predict_job(job):
+    """
+    Predict the training images with a model's current learner (for trainings
+    with 'deferred' predict_after_training).
+
+    payload: {model_id, dataset_ids, training_session_id}
+    """
+    payload = job.payload
+    model = MLModel.objects.get(pk=payload['model_id'])
+    group_name = training_group_name(model.pk, payload['training_session_id'])
+    image_paths = []
+    for ds in Dataset.objects.filter(pk__in=payload['dataset_ids']):
+        image_paths.extend(ds.get_image_paths())
+
+    def send_results(**msg):
+        send_to_group(group_name, {
+            'type': 'training_results',
+            'training_session_id': payload['training_session_id'],
+            **msg,
+        })
+
+    try:
+        results = ML.predict(Path(model.learner_path), model.labels, image_paths, save=True)
+    except Exception as exc:
+        send_results(error=str(exc))
+        raise
+    result = {'results': make_json_safe_results(results)}
+    send_results(**result)
+    return result
+
+
+def run_analyze_job(job):
+    """payload: {model_id, dataset_ids, count_labels, name, precision, workers}"""
+    payload = job.payload
+    model = MLModel.objects.get(pk=payload['model_id'])
+    datasets = Dataset.objects.filter(pk__in=payload['dataset_ids'])
+    analysis = Analysis.perform(
+        model, datasets, payload.get('count_labels'), name=payload.get('name', ''),
+        precision=payload.get('precision'), workers=payload.get('workers'))
+    return {
+        'analysis_id': analysis.pk,
+        'failed_images': analysis.results.exclude(error='').count(),
+    }
+
+
+def run_quantize_job(job):
+    """payload: {model_id, dataset_ids}"""
+    payload = job.payload
+    model = MLModel.objects.get(pk=payload['model_id'])
+    report = model.quantize(payload['dataset_ids'])
+    return {
+        'quantized_model_path': model.quantized_model_path,
+        'report': report,
+    }
+
+
+JOB_HANDLERS = {
+    'train': run_train_job,
+    'predict': run_predict_job,
+    'analyze': run_analyze_job,
+    'quantize': run_quantize_job,
+}
+
+
+def run_job(job):
+    """Run a claimed job, renewing its lease meanwhile, and record its outcome."""
+    done = threading.Event()
+
+    def keep_lease():
+        while not done.wait(settings.JOB_LEASE_SECONDS / 3):
+            if not job.renew_lease():
+                log.warning(f"{job} lease lost, another worker may run it too")
+                break
+        connection.close()  # (this thread's own connection)
+
+    lease_keeper = threading.Thread(target=keep_lease, daemon=True)
+    lease_keeper.start()
+    try:
+        result = JOB_HANDLERS[job.type](job)
+    except Exception:
+        log.exception(f"{job} failed")
+        job.fail(traceback.format_exc())
+    else:
+        job.finish(result)
+    finally:
+        done.set()
+        lease_keeper.join()
+
+
+def run_worker(job_types, slot=None, stop=None):
+    """
+    Claim and run jobs of `job_types`, one at a time, until `stop` (an Event) is set.
+
+    `slot` picks the cores this worker is pinned to, for execution profiles
+    that pin cores (see ml.runtime).
+    """
+    worker_id = f'{socket.gethostname()}:{os.getpid()}'
+    ML.apply_execution_profile(slot=slot)
+    log.info(f"worker {worker_id} running {', '.join(job_types)} jobs")
+    while not (stop and stop.is_set()):
+        close_old_connections()
+        job = Job.claim(job_types, worker_id)
+        if job is None:
+            time.sleep(settings.JOB_POLL_SECONDS)
+            continue
+        log.info(f"worker {worker_id} running {job} (attempt {job.attempts})")
+        run_job(job)
@@ -0,0 +1,70 @@
+import logging
+import multiprocessing
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django import db
+
+from coreapp.jobs import JOB_HANDLERS, run_worker
+
+
+log = logging.getLogger(__name__)
+
+
+def _run_worker(job_type, slot, stop):
+    # (SIGTERM from the parent, which set its own handler before forking, kills)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    run_worker([job_type], slot, stop)
+
+
+class Command(BaseCommand):
+    help = (
+        "Run background job workers: settings.JOB_CONCURRENCY processes per job "
+        "type, restarted if they die.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--types', nargs='+', choices=list(JOB_HANDLERS),
+            help="only run jobs of these types")
+        parser.add_argument(
+            '--shutdown-timeout', type=float, default=30,
+            help="seconds to let workers finish their current jobs on shutdown "
+                 "(unfinished jobs are re-claimed once their leases expire)")
+
+    def handle(self, *args, types=None, shutdown_timeout=30, **options):
+        # one (job_type, slot) per worker process, slots numbered across types
+        # so workers pinned to cores get distinct ones
+        workers = [
+            job_type
+            for job_type, n in settings.JOB_CONCURRENCY.items()
+            if job_type in JOB_HANDLERS and (not types or job_type in types)
+            for _ in range(n)
+        ]
+        stop = multiprocessing.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stop.set())
+        procs = {}
+
+        try:
+            while not stop.is_set():
+                for slot, job_type in enumerate(workers):
+                    proc = procs.get(slot)
+                    if proc is not None and proc.is_alive():
+                        continue
+                    if proc is not None:
+                        log.warning(f"{proc.name} died (exit code {proc.exitcode}), restarting")
+                    # (forked workers must open their own db connections)
+                    db.connections.close_all()
+                    procs[slot] = proc = multiprocessing.Process(
+                        target=_run_worker, args=(job_type, slot, stop),
+                        name=f'worker-{slot}-{job_type}')
+                    proc.start()
+                    self.stdout.write(f"started {proc.name} (pid {proc.pid})")
+                stop.wait(1)
+        except KeyboardInterrupt:
+            stop.set()
+        finally:
+            for proc in procs.values():
+                proc.join(shutdown_timeout)
+                if proc.is_alive():
+                    proc.terminate()
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.3 on 2026-10-18 12:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coreapp', '0010_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mlmodel',
+            name='inference_model_path',
+            field=models.CharField(blank=True, max_length=4096),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.3 on 2026-10-18 14:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coreapp', '0011_mlmodel_inference_model_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mlmodel',
+            name='quantized_model_path',
+            field=models.CharField(blank=True, max_length=4096),
+        ),
+        migrations.AddField(
+            model_name='mlmodel',
+            name='quantization_report_json_str',
+            field=models.TextField(blank=True, default='{}'),
+        ),
+        migrations.AddField(
+            model_name='analysis',
+            name='precision',
+            field=models.CharField(blank=True, default='float32', max_length=16),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.3 on 2026-10-18 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coreapp', '0012_quantized_model'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='result',
+            name='error',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -4,14 +4,16 @@ import json
 import logging
 import os
 # import re
+import shutil
 import time
 import uuid
 from functools import partial
 from pathlib import Path
 
-# from django.conf import settings
+from django.conf import settings
 from django.db import models as m
 from django.contrib.auth.models import AbstractUser, UserManager as DefaultUserManager
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 # from PIL import Image as PILImage
@@ -78,6 +80,10 @@ class MLModel(TimestampedModel, m.Model):
     name = m.CharField(max_length=255, unique=True)
     learner_path = m.CharField(max_length=MAX_FS_PATH_LEN, blank=True)
     parameters_path = m.CharField(max_length=MAX_FS_PATH_LEN, blank=True)
+    # lean TorchScript export of the learner's model (see ml.inference)
+    inference_model_path = m.CharField(max_length=MAX_FS_PATH_LEN, blank=True)
+    # its int8 quantized variant (see ml.quantize), if made
+    quantized_model_path = m.CharField(max_length=MAX_FS_PATH_LEN, blank=True)
 
     labels_json_str = m.TextField(blank=True, default="[]")
     @property
@@ -106,6 +112,15 @@ class MLModel(TimestampedModel, m.Model):
     def training_hparams(self, val):
         self.training_hparams_json_str = json.dumps(val)
 
+    # how the int8 model agrees with the float32 one (see ML.quantize)
+    quantization_report_json_str = m.TextField(blank=True, default="{}")
+    @property
+    def quantization_report(self):
+        return json.loads(self.quantization_report_json_str)
+    @quantization_report.setter
+    def quantization_report(self, val):
+        self.quantization_report_json_str = json.dumps(val)
+
     snapshots_json_str = m.TextField(blank=True, default="[]")
     @property
     def snapshots(self):
@@ -114,7 +129,15 @@ class MLModel(TimestampedModel, m.Model):
     def snapshots(self, val):
         self.snapshots_json_str = json.dumps(val)
 
-    def train(self, dataset_ids, training_hparams=None, on_epoch_done=None, on_final_epoch_done=None, _fake=False):
+    @property
+    def checkpoint_dir(self):
+        return ML.CHECKPOINTS_PATH / f'mlmodel-{self.pk}'
+
+    def train(self, dataset_ids, training_hparams=None, on_epoch_done=None, on_final_epoch_done=None,
+              on_batch_done=None, on_final_batch_done=None, resume=False, _fake=False):
+        """With `resume`, continue an interrupted training from its latest checkpoint
+        (training_hparams should be the same as the interrupted one's). With
+        `quantize: true` in training_hparams, also make the int8 model after."""
         train_with_hparams = self.training_hparams.copy()
         if training_hparams:
             train_with_hparams.update(training_hparams)
@@ -137,7 +160,9 @@ class MLModel(TimestampedModel, m.Model):
                     on_epoch_done(i)
             return {}
 
-        self.save_snapshot(trained_with_hparams=train_with_hparams)
+        if not resume:  # (already taken by the interrupted training)
+            self.save_snapshot(trained_with_hparams=train_with_hparams)
+        quantize = train_with_hparams.pop('quantize', False)
 
         tres = ML.train_and_predict(
             labels=self.labels,
@@ -148,33 +173,118 @@ class MLModel(TimestampedModel, m.Model):
             parameters_path=Path(self.parameters_path) if self.parameters_path else None,
             on_epoch_done=on_epoch_done,
             on_final_epoch_done=on_final_epoch_done,
+            on_batch_done=on_batch_done,
+            on_final_batch_done=on_final_batch_done,
             save_learner=True,
             save_parameters=True,
+            save_inference_model=True,
             save_results=True,
+            checkpoint_dir=self.checkpoint_dir,
+            resume=resume,
         )
 
+        # record how training went in the snapshot taken for it
+        snapshots = self.snapshots
+        if snapshots:
+            snapshots[-1]['training_outcome'] = {
+                k: tres['scores'][k]
+                for k in ('epochs_run', 'stop_reason', 'final_epochs_run', 'final_stop_reason')
+                if k in tres['scores']}
+            self.snapshots = snapshots
+
+        # previous learner / inference models won't be used anymore, free them from memory
+        for path in (self.learner_path, self.inference_model_path, self.quantized_model_path):
+            if path:
+                ML.invalidate_learner(Path(path))
         self.learner_path = str(tres['new_learner_path'])
         self.parameters_path = str(tres['new_parameters_path'])
+        self.inference_model_path = str(tres['new_inference_model_path'] or '')
+        # (made for the previous parameters)
+        self.quantized_model_path = ''
+        self.quantization_report = {}
         self.save()
 
+        # training's done and recorded, checkpoints aren't needed anymore
+        shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+
+        if quantize:
+            tres['quantization_report'] = self.quantize(dataset_ids)
+
         return tres
 
-    def analyze(self, datasets, count_labels=None):
+    def quantize(self, dataset_ids):
+        """Make the int8 model of the current learner, calibrated on (and checked
+        against the float32 model on) tiles of the datasets' images.
+
+        Returns the quantization report."""
         image_paths = []
-        for ds in datasets:
+        for ds in Dataset.objects.filter(id__in=dataset_ids):
             image_paths.extend(ds.get_image_paths())
+        if not image_paths:
+            raise ValueError(f"no images to calibrate model {self} on in datasets {list(dataset_ids)}")
 
-        pres = ML.predict(
+        qres = ML.quantize(
             Path(self.learner_path),
             self.labels,
             image_paths,
-            save=True
+            reference_model_path=(
+                Path(self.inference_model_path) if self.inference_model_path else None),
         )
 
-        res = {'labels': {
-            str(image_path): (str(raw_result_path), str(nice_result_path))
-            for image_path, (raw_result_path, nice_result_path) in pres.items()
-        }}
+        if self.quantized_model_path:
+            ML.invalidate_learner(Path(self.quantized_model_path))
+        self.quantized_model_path = str(qres['new_quantized_model_path'])
+        if 'new_inference_model_path' in qres:
+            self.inference_model_path = str(qres['new_inference_model_path'])
+        self.quantization_report = qres['report']
+        self.save()
+
+        return qres['report']
+
+    def get_inference_model_path(self, precision=None):
+        """Path of the model to analyze with, for one of ML.INFERENCE_PRECISIONS
+        (default 'float32')."""
+        precision = precision or 'float32'
+        if precision not in ML.INFERENCE_PRECISIONS:
+            raise ValueError(f"unknown precision {precision!r}, "
+                             f"expected one of {', '.join(ML.INFERENCE_PRECISIONS)}")
+        if precision == 'int8':
+            if not self.quantized_model_path:
+                raise ValueError(f"model {self} has no int8 quantized model, quantize it first")
+            return Path(self.quantized_model_path)
+        # (the exported inference model, if any, is quicker to load and run)
+        return Path(self.inference_model_path or self.learner_path)
+
+    def analyze(self, datasets, count_labels=None, precision=None, workers=None):
+        labels, counts, errors = {}, {}, {}
+        for image_path, raw_result_path, nice_result_path, image_counts, error in \
+                self.analyze_iter(datasets, count_labels, precision, workers):
+            if error:
+                errors[image_path] = error
+                continue
+            labels[image_path] = (raw_result_path, nice_result_path)
+            if count_labels:
+                counts[image_path] = image_counts
+
+        res = {'labels': labels, 'errors': errors}
+        if count_labels:
+            res['counts'] = counts
+
+        return res
+
+    def analyze_iter(self, datasets, count_labels=None, precision=None, workers=None):
+        """Yield (image_path, raw_result_path, nice_result_path, counts or None, None)
+        for each image, in order, as soon as it's analyzed (with the `precision`
+        model, see get_inference_model_path), or (image_path, None, None, None,
+        error) for images that failed.
+
+        Images are predicted by `workers` processes (default: ML.PREDICT_WORKERS),
+        see ML.predict_sharded_iter."""
+        model_path = self.get_inference_model_path(precision)
+
+        image_paths = []
+        for ds in datasets:
+            image_paths.extend(ds.get_image_paths())
 
         if count_labels:
             labels_with_count_params = self.labels.copy()
@@ -184,12 +294,27 @@ class MLModel(TimestampedModel, m.Model):
                     lbl['count'] = True
                 else:
                     lbl['count'] = False
-            counts = {}
-            for image_path, (raw_result_path, _) in pres.items():
-                counts[str(image_path)] = ML.count_patches(raw_result_path, labels_with_count_params)
-            res['counts'] = counts
 
-        return res
+        for image_path, raw_result_path, nice_result_path, error in ML.predict_sharded_iter(
+            model_path,
+            self.labels,
+            image_paths,
+            workers=workers,
+            save=True
+        ):
+            if error:
+                yield str(image_path), None, None, None, error
+                continue
+            try:
+                counts = (
+                    ML.count_patches(raw_result_path, labels_with_count_params)
+                    if count_labels else
+                    None)
+            except Exception as exc:
+                log.exception(f"failed counting patches of {image_path}")
+                yield str(image_path), None, None, None, f"{type(exc).__name__}: {exc}"
+                continue
+            yield str(image_path), str(raw_result_path), str(nice_result_path), counts, None
 
     def make_snapshot(self, **extra_data):
         now = datetime.datetime.now()
@@ -199,6 +324,8 @@ class MLModel(TimestampedModel, m.Model):
             'name': self.name,
             'learner_path': self.learner_path,
             'parameters_path': self.parameters_path,
+            'inference_model_path': self.inference_model_path,
+            'quantized_model_path': self.quantized_model_path,
             'labels': self.labels,
             'hparams': self.hparams,
             'training_hparams': self.training_hparams,
@@ -215,10 +342,15 @@ class MLModel(TimestampedModel, m.Model):
         s = [s for s in self.snapshots if s['at'] == at][0]
         learner_path = s.get('learner_path', None)
         if learner_path and os.path.exists(learner_path):
+            ML.invalidate_learner(Path(learner_path))
             os.unlink(learner_path)
         parameters_path = s.get('parameters_path', None)
         if parameters_path and os.path.exists(parameters_path):
             os.unlink(parameters_path)
+        for model_path in (s.get('inference_model_path', None), s.get('quantized_model_path', None)):
+            if model_path and os.path.exists(model_path):
+                ML.invalidate_learner(Path(model_path))
+                os.unlink(model_path)
         self.snapshots = [s for s in self.snapshots if s['at'] != at]
         self.save()
 
@@ -249,6 +381,14 @@ class Dataset(TimestampedModel, m.Model):
         return self.name
 
 
+class ConvertToRGB:
+    """imagekit processor: palette (eg. label / result PNGs), greyscale or RGBA
+    images -> RGB, which JPEG thumbnails can be encoded from."""
+
+    def process(self, img):
+        return img if img.mode == "RGB" else img.convert("RGB")
+
+
 def make_image_filepath(instance, filename, prefix):
     path, ext = os.path.splitext(filename)
     return os.path.join(prefix, uuid.uuid4().hex + ext)
@@ -268,14 +408,14 @@ class BaseImage(TimestampedModel, m.Model):
 
     image_thumb = ImageSpecField(
         source="image",
-        processors=[ResizeToFill(*SIZE_THUMB)],
+        processors=[ConvertToRGB(), ResizeToFill(*SIZE_THUMB)],
         format="JPEG",
         options={"quality": 80},
     )
 
     image_websize = ImageSpecField(
         source="image",
-        processors=[ResizeToFit(*SIZE_WEB)],
+        processors=[ConvertToRGB(), ResizeToFit(*SIZE_WEB)],
         format="JPEG",
         options={"quality": 90},
     )
@@ -373,6 +513,8 @@ class Analysis(TimestampedModel, m.Model):
     datasets = m.ManyToManyField(Dataset)
 
     name = m.CharField(max_length=255)
+    # model precision analyzed with, one of ML.INFERENCE_PRECISIONS
+    precision = m.CharField(max_length=16, blank=True, default='float32')
 
     count_labels_json_str = m.TextField(blank=True, default="{}")
     @property
@@ -386,24 +528,26 @@ class Analysis(TimestampedModel, m.Model):
         return f"{self.name} ({self.id})"
 
     @classmethod
-    def perform(cls, model, datasets, count_labels, name=''):
-        # : { labels -> {image_path -> (raw_result_path, nice_result_path),
-        #     counts -> {image_path -> {label -> count}} }
-        r = model.analyze(datasets, count_labels)
-        labels = r['labels']
-        counts = r.get('counts', None)
-
+    def perform(cls, model, datasets, count_labels, name='', precision=None, workers=None):
         image_path2dsi = {}
         for ds in datasets:
             for dsi in ds.datasetimages.all():
                 image_path2dsi[dsi.image.image.path] = dsi
 
-        analysis = cls.objects.create(model=model, name=name)
+        # (fail early if there's no model for this precision)
+        model.get_inference_model_path(precision)
+        analysis = cls.objects.create(model=model, name=name, precision=precision or 'float32')
         analysis.count_labels = count_labels
         analysis.save()
         analysis.datasets.set(datasets)
 
-        for image_path, (raw_result_path, nice_result_path) in labels.items():
+        # results are saved as soon as each image is analyzed
+        # (failed images get a result with just their error)
+        for image_path, raw_result_path, nice_result_path, counts, error in model.analyze_iter(
+                datasets, count_labels, precision, workers):
+            if error:
+                analysis.results.create(datasetimage=image_path2dsi[image_path], error=error)
+                continue
             result_label_image = LabelImage.objects.create(
                 image=nice_result_path,
             )
@@ -411,7 +555,7 @@ class Analysis(TimestampedModel, m.Model):
                 datasetimage=image_path2dsi[image_path],
                 labelimage=result_label_image,
             )
-            result.counts = counts[image_path] if counts else ''
+            result.counts = counts if counts is not None else ''
             result.save()
 
         return analysis
@@ -421,6 +565,8 @@ class Result(TimestampedModel, m.Model):
     analysis = m.ForeignKey(Analysis, on_delete=m.CASCADE, related_name='results')
     datasetimage = m.ForeignKey(DatasetImage, on_delete=m.SET_NULL, null=True, blank=True)
     labelimage = m.OneToOneField(LabelImage, on_delete=m.SET_NULL, null=True, blank=True)
+    # why analyzing the image failed (then there's no labelimage)
+    error = m.TextField(blank=True, default="")
 
     counts_json_str = m.TextField(blank=True, default="{}")
     @property
@@ -431,6 +577,137 @@ class Result(TimestampedModel, m.Model):
         self.counts_json_str = json.dumps(val)
 
 
+class Job(TimestampedModel, m.Model):
+    """
+    Background work (training, analysis...) enqueued by request handlers and
+    run by `manage.py run_workers` worker processes (see coreapp.jobs).
+
+    A running job is leased to its worker until `lease_expires_at`, which the
+    worker keeps renewing while it runs. So jobs of workers that died (or were
+    restarted) are claimed again once their lease expires, up to
+    `max_attempts` times.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    STATUSES = (QUEUED, RUNNING, DONE, FAILED, CANCELLED)
+
+    type = m.CharField(max_length=32, db_index=True)
+    status = m.CharField(
+        max_length=16, choices=[(s, s) for s in STATUSES], default=QUEUED, db_index=True)
+
+    payload_json_str = m.TextField(blank=True, default="{}")
+    @property
+    def payload(self):
+        return json.loads(self.payload_json_str)
+    @payload.setter
+    def payload(self, val):
+        self.payload_json_str = json.dumps(val)
+
+    result_json_str = m.TextField(blank=True, default="null")
+    @property
+    def result(self):
+        return json.loads(self.result_json_str)
+    @result.setter
+    def result(self, val):
+        self.result_json_str = json.dumps(val)
+
+    progress_json_str = m.TextField(blank=True, default="null")
+    @property
+    def progress(self):
+        return json.loads(self.progress_json_str)
+    @progress.setter
+    def progress(self, val):
+        self.progress_json_str = json.dumps(val)
+
+    error = m.TextField(blank=True, default="")
+    worker_id = m.CharField(max_length=255, blank=True, default="")
+    lease_expires_at = m.DateTimeField(null=True, blank=True, db_index=True)
+    attempts = m.IntegerField(default=0)
+    max_attempts = m.IntegerField(default=3)
+    started_at = m.DateTimeField(null=True, blank=True)
+    finished_at = m.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Job({self.id}, {self.type}, {self.status})"
+
+    @classmethod
+    def enqueue(cls, type, payload, max_attempts=None):
+        job = cls(type=type, max_attempts=max_attempts or settings.JOB_MAX_ATTEMPTS)
+        job.payload = payload
+        job.save()
+        return job
+
+    @classmethod
+    def claim(cls, types, worker_id, lease_s=None):
+        """
+        Lease the oldest claimable job of one of `types` to `worker_id`.
+
+        Claims are a compare-and-set UPDATE of the job's status and lease, so
+        concurrent workers (in any process / host) never get the same job.
+
+        Returns
+        -------
+        Job or None
+        """
+        now = timezone.now()
+        lease_s = lease_s or settings.JOB_LEASE_SECONDS
+        expired = m.Q(status=cls.RUNNING, lease_expires_at__lt=now)
+        # give up on jobs whose workers keep dying on them
+        cls.objects.filter(expired, type__in=types, attempts__gte=m.F('max_attempts')).update(
+            status=cls.FAILED,
+            error="lease expired after last attempt (worker died?)",
+            finished_at=now)
+
+        candidates = cls.objects.filter(
+            m.Q(status=cls.QUEUED) | expired, type__in=types
+        ).order_by('created_at')[:10]
+        for job in candidates:
+            claimed = cls.objects.filter(
+                pk=job.pk, status=job.status, lease_expires_at=job.lease_expires_at
+            ).update(
+                status=cls.RUNNING,
+                worker_id=worker_id,
+                lease_expires_at=now + datetime.timedelta(seconds=lease_s),
+                attempts=m.F('attempts') + 1,
+                started_at=now)
+            if claimed:
+                job.refresh_from_db()
+                return job
+        return None
+
+    def _update_if_owned(self, **fields):
+        """Update job fields unless its lease was lost (to another worker)."""
+        return bool(type(self).objects.filter(
+            pk=self.pk, status=self.RUNNING, worker_id=self.worker_id,
+        ).update(**fields))
+
+    def renew_lease(self, lease_s=None):
+        lease_s = lease_s or settings.JOB_LEASE_SECONDS
+        return self._update_if_owned(
+            lease_expires_at=timezone.now() + datetime.timedelta(seconds=lease_s))
+
+    def set_progress(self, progress):
+        return self._update_if_owned(progress_json_str=json.dumps(progress))
+
+    def finish(self, result):
+        return self._update_if_owned(
+            status=self.DONE, result_json_str=json.dumps(result),
+            lease_expires_at=None, finished_at=timezone.now())
+
+    def fail(self, error):
+        return self._update_if_owned(
+            status=self.FAILED, error=error,
+            lease_expires_at=None, finished_at=timezone.now())
+
+    def cancel(self):
+        """Cancel a job that hasn't started yet."""
+        return bool(type(self).objects.filter(pk=self.pk, status=self.QUEUED).update(
+            status=self.CANCELLED, finished_at=timezone.now()))
+
+
 # Users/Auth Models - just tweak so username is email...
 #####################################################################
 
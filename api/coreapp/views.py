@@ -1,4 +1,5 @@
 import os
+import time
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
@@ -15,6 +16,7 @@ from .models import (
     Dataset,
     DatasetImage,
     Image,
+    Job,
     LabelImage,
     MLModel,
 )
@@ -76,12 +78,15 @@ class MLModelSerializer(serializers.ModelSerializer):
             "name",
             "learner_path",
             "parameters_path",
+            "inference_model_path",
+            "quantized_model_path",
+            "quantization_report",
             "labels",
             "hparams",
             "training_hparams",
             "snapshots",
         )
-        read_only_fields = ("snapshots",)
+        read_only_fields = ("snapshots", "quantized_model_path", "quantization_report")
         extra_kwargs = {
             "labels": {"write_only": True},
             "learner_constructor_params": {"write_only": True},
@@ -91,6 +96,7 @@ class MLModelSerializer(serializers.ModelSerializer):
     hparams = serializers.JSONField(required=False)
     training_hparams = serializers.JSONField(required=False)
     snapshots = serializers.JSONField(required=False)
+    quantization_report = serializers.JSONField(read_only=True)
 
     def create(self, validated_data):
         m = super().create(validated_data)
@@ -119,14 +125,15 @@ class MLModelSerializer(serializers.ModelSerializer):
         return m
 
 
-class ResponseThen(Response):
-    def __init__(self, data, then_callback, **kwargs):
-        super().__init__(data, **kwargs)
-        self.then_callback = then_callback
-
-    def close(self):
-        super().close()
-        self.then_callback()
+def get_dataset_ids(request):
+    """`dataset_ids` of a request's data as [int] (ValueError if missing or not ids)."""
+    dataset_ids = request.data.get("dataset_ids")
+    if not isinstance(dataset_ids, (list, tuple)) or not dataset_ids:
+        raise ValueError("dataset_ids: expected a non-empty list of dataset ids")
+    try:
+        return [int(ds_id) for ds_id in dataset_ids]
+    except (TypeError, ValueError):
+        raise ValueError(f"dataset_ids: invalid dataset ids {dataset_ids!r}")
 
 
 class MLModelsViewSet(viewsets.ModelViewSet):
@@ -135,38 +142,108 @@ class MLModelsViewSet(viewsets.ModelViewSet):
     queryset = MLModel.objects.all()
     serializer_class = MLModelSerializer
 
-    # TODO: adapt next to current version
     @action(methods=["post"], detail=True, url_path="train")
     def train(self, request, pk=None):
+        """Enqueue a training job (progress is reported to the websocket
+        consumers of the training session)."""
+        model = self.get_object()
+        try:
+            dataset_ids = get_dataset_ids(request)
+        except ValueError as exc:
+            return Response({"detail": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        job = Job.enqueue("train", {
+            "model_id": model.pk,
+            "dataset_ids": dataset_ids,
+            "training_hparams": request.data.get("training_hparams", {}),
+            "training_session_id": int(
+                request.data.get("training_session_id", None) or time.time()),
+            "resume": bool(request.data.get("resume", False)),
+            "_fake": bool(request.query_params.get("_fake", None)),
+        })
+        return Response(JobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+    @action(methods=["post"], detail=True, url_path="analyze")
+    def analyze(self, request, pk=None):
+        """Enqueue an analysis job (its result has the created analysis' id)."""
+        model = self.get_object()
+        try:
+            model.get_inference_model_path(request.data.get("precision", None))
+            dataset_ids = get_dataset_ids(request)
+        except ValueError as exc:
+            return Response({"detail": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        job = Job.enqueue("analyze", {
+            "model_id": model.pk,
+            "dataset_ids": dataset_ids,
+            "count_labels": request.data.get("count_labels", None),
+            "name": request.data.get("name", ""),
+            "precision": request.data.get("precision", None),
+            "workers": request.data.get("workers", None),
+        })
+        return Response(JobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+    @action(methods=["post"], detail=True, url_path="quantize")
+    def quantize(self, request, pk=None):
+        """Enqueue a job making the model's int8 variant (its result has the
+        agreement report, also kept as the model's quantization_report)."""
         model = self.get_object()
+        try:
+            dataset_ids = get_dataset_ids(request)
+        except ValueError as exc:
+            return Response({"detail": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        job = Job.enqueue("quantize", {
+            "model_id": model.pk,
+            "dataset_ids": dataset_ids,
+        })
+        return Response(JobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
 
-        dataset_ids = request.data.get("dataset_ids")
-        params = request.data.get("params", {})
-        training_session_id = request.data.get("training_session_id", None)
-        parameters_id = request.data.get("parameters_id", None)
-
-        # get or create TrainingSession
-        if training_session_id is None:
-            ts = model.trainingsession_set.create()
-            training_session_id = ts.id
-        else:
-            ts = model.trainingsession_set.get(pk=training_session_id)
-
-        def do_training():
-            (
-                model.train
-                if not request.query_params.get("_fake", None)
-                else model.fake_train
-            )(
-                dataset_ids=dataset_ids,
-                params=params,
-                training_session=ts,
-                parameters_id=parameters_id,
-            )
 
-        return ResponseThen(
-            {"training_session_id": ts.id}, do_training, status=status.HTTP_200_OK
+class JobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Job
+        fields = (
+            "id",
+            "type",
+            "status",
+            "payload",
+            "progress",
+            "result",
+            "error",
+            "attempts",
+            "created_at",
+            "started_at",
+            "finished_at",
         )
+        read_only_fields = fields
+
+    payload = serializers.JSONField(read_only=True)
+    progress = serializers.JSONField(read_only=True)
+    result = serializers.JSONField(read_only=True)
+
+
+class JobsViewSet(viewsets.ReadOnlyModelViewSet):
+    permission_classes = (IsAuthenticated,)
+    model = Job
+    queryset = Job.objects.order_by("-created_at")
+    serializer_class = JobSerializer
+
+    def get_queryset(self):
+        qs = super().get_queryset()
+        for fld in ("type", "status"):
+            if self.request.query_params.get(fld):
+                qs = qs.filter(**{fld: self.request.query_params[fld]})
+        return qs
+
+    @action(methods=["post"], detail=True, url_path="cancel")
+    def cancel(self, request, pk=None):
+        """Cancel a job that hasn't started yet."""
+        job = self.get_object()
+        if not job.cancel():
+            return Response(
+                {"detail": f"can't cancel a {job.status} job"},
+                status=status.HTTP_409_CONFLICT)
+        job.refresh_from_db()
+        return Response(JobSerializer(job).data)
+
 
 DatasetSerializer, DatasetsViewSet = make_model_serializer_viewset(Dataset)
 
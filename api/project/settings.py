@@ -166,6 +166,22 @@ REST_FRAMEWORK = {
 
 ENABLE_CORS_HEADERS = False
 
+# Background jobs (see coreapp.jobs, run by `manage.py run_workers`)
+# worker processes per job type (ie. max concurrent jobs of each type, per host)
+JOB_CONCURRENCY = {
+    'train': 1,
+    'analyze': 1,
+    'predict': 1,
+    'quantize': 1,
+}
+# a running job is re-claimed by another worker if its worker doesn't renew its
+# lease for this long (workers renew it every JOB_LEASE_SECONDS / 3)
+JOB_LEASE_SECONDS = 60
+JOB_POLL_SECONDS = 2
+JOB_MAX_ATTEMPTS = 3
+# max (per batch) training progress messages per second, per websocket group
+TRAINING_PROGRESS_MAX_MSGS_PER_SEC = 2
+
 from local_settings import *  # noqa
 
 if ENABLE_CORS_HEADERS:
@@ -28,6 +28,7 @@ router.register(r'datasets', views.DatasetsViewSet)
 router.register(r'images', views.ImagesViewSet)
 router.register(r'label-images', views.LabelImagesViewSet)
 router.register(r'analyses', views.AnalysesViewSet)
+router.register(r'jobs', views.JobsViewSet)
 
 
 urlpatterns = [
@@ -1,3 +1,4 @@
 #!/bin/sh
 docker run -p 6379:6379 redis:2.8 \
+    & python manage.py run_workers \
     & python manage.py runserver histobot.test:8000
@@ -1,77 +1,279 @@
-from collections import defaultdict
 import datetime
+import itertools
+import logging
+import multiprocessing
+import shutil
+import time
 import uuid
+from collections import deque
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 
 import numpy as np
-from fastai.vision.image import open_image
 from PIL import Image as PILImage
 
 from .config import *
 from .core import (
     make_data_bunch,
+    make_random_crop_data_bunch,
     make_learner,
     parameters_load,
     parameters_save,
-    get_tile_paths,
-    make_img_from_tiles,
-    get_images_tiles_path,
+    learner_cache,
     learner_load,
     learner_save,
     learner_train,
-    get_raw_label_path,
-    make_wh1_result,
-    count_islands,
+    export_inference_model,
+    pop_data_hparams,
+    resolve_batching,
+    predict_tiles,
+)
+from .preprocessing import (
+    get_images_tiles_path,
+    get_raw_label_paths,
+    preprocessing_cache,
 )
+from . import inference, server
+from .inference import (
+    inference_model_cache,
+    is_inference_model_path,
+    keep_result_arr,
+    load_inference_model,
+)
+from .runtime import apply_execution_profile, get_available_cores
+from .tiles import pair_tiles, sample_tile_arrs
 from .masks import (
-    make_raw_mask,
+    count_islands,
+    get_cls_codes_arr,
     make_nice_mask,
+    make_raw_mask,
 )
 
 
+log = logging.getLogger(__name__)
+
+
 def predict(
     learner_path,
     labels,
     image_paths,
-    save=False
+    save=False,
+    bs=None,
+    execution_profile=None,
+    backend=None,
 ):
     """
+    Parameters
+    ----------
+    learner_path : Path of an exported Learner (.pkl), or of an inference model
+        (.pt, see export_inference_model), run without any Learner
+    labels : [{label, rgb}] (can be None for inference models, which have theirs)
+    bs : tiles per forward pass (default: sized automatically from available RAM)
+    execution_profile : name of one of EXECUTION_PROFILES (default: EXECUTION_PROFILE)
+    backend : one of PREDICT_BACKENDS (default: PREDICT_BACKEND), 'server' predicts
+        in the inference server (see ml.server), where `bs` and `execution_profile`
+        are up to it
+
     Returns
     -------
     {image_path -> (
-        raw_result_path if save else raw_result_image,
+        raw_result_path if save else raw_result_arr,
         nice_result_path if save else nice_result_image
     )}
+    (saved results are one file, so both paths are the same, see save_prediction)
     """
-    # --- load Learner
-    learner = learner_load(learner_path)
+    return {
+        image_path: (raw_result, nice_result)
+        for image_path, raw_result, nice_result
+        in predict_iter(
+            learner_path, labels, image_paths,
+            save=save, bs=bs, execution_profile=execution_profile, backend=backend)
+    }
 
-    # --- get (make if not already existing) _tiles from images
-    # tile_paths : [str]
-    # tile2image_paths : {tile_path -> image_path}
-    # image_szs : {image_path -> (w: int, h: int)
-    tile_paths, tile2image_paths, image_szs = get_images_tiles_path(image_paths)
 
-    # --- make predictions for tiles
-    result_tiles = defaultdict(list)  # : image_path -> [(tile_path, result_img_arr)]
-    for tile_path in tile_paths:
-        img = open_image(tile_path)
-        res = learner.predict(img)
-        result_img_arr = make_wh1_result(res[0])
-        result_tiles[tile2image_paths[tile_path]].append((tile_path, result_img_arr))
+def predict_iter(
+    learner_path,
+    labels,
+    image_paths,
+    save=False,
+    bs=None,
+    execution_profile=None,
+    backend=None,
+):
+    """
+    Like `predict`, but yield each image's results as soon as it's done,
+    so only about one image is kept in memory at a time.
+
+    Yields
+    ------
+    (image_path,
+     raw_result_path if save else raw_result_arr,
+     nice_result_path if save else nice_result_image)
+    """
+    # --- load Learner (or lean inference model)
+    # and tile images in memory, predict and reassemble results
+    apply_execution_profile(execution_profile)
+    results = load_predictor(learner_path, backend)(labels, image_paths, bs)
 
-    # --- reassemble full result images from tiles and convert them to nice versions
-    results = {}  # : image_path -> (raw_result_img, nice_result_img)
-    for image_path, tiles in result_tiles.items():
-        # assemble results (raw) from predicted tiles (using tile2image_paths)
-        raw_result_img = make_img_from_tiles(tiles, image_szs[image_path])
-        # create nice version of prediction from raw version
-        nice_result_img = make_nice_mask(raw_result_img, labels)
-        results[image_path] = (raw_result_img, nice_result_img)
+    for image_path, raw_result_arr, nice_result_img in results:
+        if save:
+            yield (image_path, *save_prediction(raw_result_arr, nice_result_img))
+        else:
+            yield image_path, raw_result_arr, nice_result_img
 
-    if save:
-        return save_predictions(results)
 
-    return results
+def load_predictor(learner_path, backend=None):
+    """
+    Load a Learner (.pkl) or an inference model (.pt) to predict images with
+    (or connect to the inference server that has it loaded, for backend 'server').
+
+    Returns
+    -------
+    (labels, image_paths, bs) -> iterator of
+        (image_path, raw_result_arr, nice_result_image), one image at a time
+    """
+    backend = backend or PREDICT_BACKEND
+    if backend not in PREDICT_BACKENDS:
+        raise ValueError(f"unknown predict backend {backend!r}, "
+                         f"expected one of {', '.join(PREDICT_BACKENDS)}")
+    if backend == 'server':
+        return partial(server.iter_predict_images, server.get_client().model(learner_path))
+    if is_inference_model_path(learner_path):
+        return partial(inference.iter_predict_images, load_inference_model(learner_path))
+    return partial(iter_predict_images, learner_load(learner_path))
+
+
+def _predict_image(predictor, labels, image_path, save, bs):
+    """(image_path, raw_result, nice_result, None), or (image_path, None, None, error) if it failed."""
+    try:
+        [(_, raw_result, nice_result)] = predictor(labels, [image_path], bs)
+        if save:
+            raw_result, nice_result = save_prediction(raw_result, nice_result)
+        return image_path, raw_result, nice_result, None
+    except Exception as exc:
+        log.exception(f"failed predicting {image_path}")
+        return image_path, None, None, f"{type(exc).__name__}: {exc}"
+
+
+# : predictor of the model loaded in a predict_sharded_iter worker process
+_worker_predictor = None
+
+
+def _init_predict_worker(learner_path, n_workers, next_slot, backend):
+    global _worker_predictor
+    with next_slot.get_lock():
+        slot = next_slot.value
+        next_slot.value += 1
+    apply_execution_profile(f'shared-{n_workers}', slot)
+    _worker_predictor = load_predictor(learner_path, backend)
+
+
+def _predict_image_in_worker(labels, image_path, save, bs):
+    return _predict_image(_worker_predictor, labels, image_path, save, bs)
+
+
+def predict_sharded_iter(
+    learner_path,
+    labels,
+    image_paths,
+    workers=None,
+    save=False,
+    bs=None,
+    execution_profile=None,
+    backend=None,
+):
+    """
+    Like `predict_iter`, but with images split across `workers` processes
+    (default: PREDICT_WORKERS, 0 for one per core), each with its own loaded
+    model and its share of the cores ('shared-<workers>' execution profile,
+    `execution_profile` only applies when predicting in-process, with 1 worker).
+    With the 'server' `backend`, workers are just concurrent clients of the
+    inference server, and their requests get batched together.
+
+    Results still come in the order of `image_paths`. An image that fails
+    doesn't stop the others, its error is yielded instead.
+
+    Yields
+    ------
+    (image_path,
+     raw_result_path if save else raw_result_arr,
+     nice_result_path if save else nice_result_image,
+     None)
+    or (image_path, None, None, error:str) for failed images
+    """
+    image_paths = list(image_paths)
+    workers = PREDICT_WORKERS if workers is None else workers
+    workers = min(workers or len(get_available_cores()), len(image_paths))
+    if workers <= 1:
+        apply_execution_profile(execution_profile)
+        predictor = load_predictor(learner_path, backend)
+        for image_path in image_paths:
+            yield _predict_image(predictor, labels, image_path, save, bs)
+        return
+
+    # ('spawn', since forking a process that already ran torch ops can deadlock)
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=ctx,
+            initializer=_init_predict_worker,
+            initargs=(learner_path, workers, ctx.Value('i', 0), backend),
+    ) as pool:
+        def submit(image_path):
+            return image_path, pool.submit(_predict_image_in_worker, labels, image_path, save, bs)
+
+        # a couple of images queued per worker, so none of them idles, and
+        # results are yielded in order (without holding all of them)
+        image_paths = iter(image_paths)
+        pending = deque(map(submit, itertools.islice(image_paths, 2 * workers)))
+        while pending:
+            image_path, future = pending.popleft()
+            try:
+                res = future.result()
+            except Exception as exc:  # (eg. its worker process died)
+                log.exception(f"failed predicting {image_path}")
+                res = image_path, None, None, f"{type(exc).__name__}: {exc}"
+            for next_image_path in itertools.islice(image_paths, 1):
+                pending.append(submit(next_image_path))
+            yield res
+
+
+def predict_images(learner, labels, image_paths, bs=None):
+    """
+    Predict images with an already loaded Learner, tiling them in memory.
+
+    Returns
+    -------
+    {image_path -> (raw_result_arr, nice_result_image)}
+    """
+    return {
+        image_path: (raw_result_arr, nice_result_img)
+        for image_path, raw_result_arr, nice_result_img
+        in iter_predict_images(learner, labels, image_paths, bs)
+    }
+
+
+def iter_predict_images(learner, labels, image_paths, bs=None):
+    """
+    Yields
+    ------
+    (image_path, raw_result_arr, nice_result_image), one image at a time
+    """
+    return inference.iter_predict_images(
+        learner, labels, image_paths, bs, predict_tiles=predict_tiles)
+
+
+# runs 'deferred' predictions after training, one training's at a time
+_deferred_predictions = ThreadPoolExecutor(max_workers=1, thread_name_prefix='deferred-predict')
+
+
+def sample_image_paths(image_paths, n):
+    """`n` of `image_paths`, evenly spread (all of them if there aren't more)."""
+    if len(image_paths) <= n:
+        return list(image_paths)
+    step = len(image_paths) / n
+    return [image_paths[int(i * step)] for i in range(n)]
 
 
 def train_and_predict(
@@ -84,79 +286,203 @@ def train_and_predict(
     parameters_path=None,
     save_parameters=False,
     save_learner=False,
+    save_inference_model=False,
     save_results=False,
     on_epoch_done=None,
     on_final_epoch_done=None,
+    on_batch_done=None,
+    on_final_batch_done=None,
+    predict_bs=None,
+    preprocess_workers=None,
+    execution_profile=None,
+    checkpoint_dir=None,
+    resume=False,
 ):
     """
+    Parameters
+    ----------
+    model_hparams : {learner_class, model_class, ...}
+    training_hparams : {epochs, lr, ...
+                        training_strategy: one of TRAINING_STRATEGIES,
+                        finetune_epochs: int, finetune_lr: float
+                        (for 'validate_then_finetune'),
+                        sampling: 'tiles' (default, fixed tiles) or 'random_crops',
+                        crop_size: (w, h), samples_per_epoch: int, mmap: bool
+                        (for 'random_crops', see make_random_crop_data_bunch),
+                        early_stopping_patience: int, early_stopping_min_delta: float,
+                        time_budget_s: float (per training run, see learner_train),
+                        predict_after_training: one of PREDICT_AFTER_TRAINING_MODES,
+                        predict_sample_size: int (for 'sample')}
+        (both can also contain DATA_HPARAMS, see ml.core)
+    checkpoint_dir : Path, where to checkpoint training (in a subdirectory per
+        training run), left for the caller to remove once it has recorded the
+        new learner (until then, an interrupted caller can still resume)
+    resume : bool, continue training runs from their latest checkpoints in
+        checkpoint_dir (instead of clearing them and starting over)
+    on_epoch_done, on_batch_done : progress callbacks of the (first) training
+        run, on_final_* ones of the final run, see learner_train
+
     Returns
     -------
-    {scores,
+    {scores: {..., epochs_run, stop_reason, final_epochs_run, final_stop_reason,
+              training_strategy, training_time_s, time_saved_s,
+              bs, accumulate_steps, effective_bs},
      new_parameters_path,
      new_learner_path,
-     results: {image_path -> (raw_result_path/image, nice_result_path/image)}
+     new_inference_model_path (None if exporting it failed),
+     results: {image_path -> (raw_result_path/arr, nice_result_path/image)}
+              (only the sampled images for 'sample', empty for 'off' / 'deferred'),
+     deferred_results: Future of `results` (for 'deferred')}
     """
     # === main idea
     # - first train on a data with some (20%) samples left for validation
     #   so we can report validation scores too
-    # - then train on full data with nothing left for validation to get
-    #   the best possibly trained model
-    # - then predict with this second model
-
-    # --- create a DataBunch
-    # tile_paths : [str]
-    # tile2image_paths : {tile_path -> image_path}
-    # image_szs : {image_path -> (w: int, h: int)
-    tile_paths, tile2image_paths, image_szs = get_images_tiles_path(image_paths)
-    label_raw_paths = [get_raw_label_path(label_path, labels) for label_path in label_paths]
-    label_tile_paths, label_tile2label_paths, label_szs = get_images_tiles_path(label_raw_paths)
-
-    tile_paths = sorted(tile_paths, key=lambda p: (tile2image_paths[p].stem, p))
-    label_tile_paths = sorted(label_tile_paths, key=lambda p: (label_tile2label_paths[p].stem, p))
-
-    cls_codes = [it['label'] for it in labels]
-    data_bunch = make_data_bunch(tile_paths, label_tile_paths, cls_codes)
-
-    # --- create or load Learner
-    # and load load trained parameters from file
-    learner = make_learner(model_hparams, data_bunch)
-    if parameters_path:
-        parameters_load(learner, parameters_path)
-
-    # --- train
-    scores = learner_train(learner, {**training_hparams, 'on_epoch_done': on_epoch_done})
-
-    # --- retrain on whole data (valid_pct=0) before predicting
-    data_bunch = make_data_bunch(tile_paths, label_tile_paths, cls_codes, valid_pct=0)
-    learner = make_learner(model_hparams, data_bunch)
-    if parameters_path:
-        parameters_load(learner, parameters_path)
-    scores_final = learner_train(learner, {**training_hparams, 'on_epoch_done': on_final_epoch_done})
-    scores['final_train_losses'] = scores_final['train_losses']
-
-    # --- make predictions for tiles
-    result_tiles = defaultdict(list)  # : image_path -> [(tile_path, result_img_arr)]
-    for tile_path in tile_paths:
-        img = open_image(tile_path)
-        res = learner.predict(img)
-        result_img_arr = make_wh1_result(res[0])
-        result_tiles[tile2image_paths[tile_path]].append((tile_path, result_img_arr))
-
-    # --- reassemble full result images from tiles and convert them to nice versions
-    results = {}  # image_path -> (raw_result_img, nice_result_img)
-    for image_path, tiles in result_tiles.items():
-        # assemble results (raw) from predicted tiles (using tile2image_paths)
-        raw_result_img = make_img_from_tiles(tiles, image_szs[image_path])
-        # create nice version of prediction from raw version
-        nice_result_img = make_nice_mask(raw_result_img, labels)
-        results[image_path] = (raw_result_img, nice_result_img)
-
-    # --- (optionally) save results to files
-    if save_results:
-        results = save_predictions(results)
+    # - then (depending on training strategy) train on full data with
+    #   nothing left for validation to get the best possibly trained model,
+    #   either from scratch or continuing from the validated model
+    # - then predict with this final model
+    training_hparams = training_hparams.copy()
+    strategy = training_hparams.pop('training_strategy', None) or TRAINING_STRATEGY
+    if strategy not in TRAINING_STRATEGIES:
+        raise ValueError(f"unknown training_strategy {strategy!r}, "
+                         f"expected one of {', '.join(TRAINING_STRATEGIES)}")
+    finetune_epochs = training_hparams.pop(
+        'finetune_epochs',
+        max(1, round(training_hparams['epochs'] * FINETUNE_EPOCHS_FRACTION)))
+    finetune_lr = training_hparams.pop('finetune_lr', training_hparams['lr'] / 10)
+    predict_mode = training_hparams.pop('predict_after_training', None) or PREDICT_AFTER_TRAINING
+    if predict_mode not in PREDICT_AFTER_TRAINING_MODES:
+        raise ValueError(f"unknown predict_after_training {predict_mode!r}, "
+                         f"expected one of {', '.join(PREDICT_AFTER_TRAINING_MODES)}")
+    predict_sample_size = training_hparams.pop('predict_sample_size', PREDICT_SAMPLE_SIZE)
+    model_hparams, training_hparams, data_hparams = pop_data_hparams(
+        model_hparams, training_hparams)
+    sampling = training_hparams.pop('sampling', 'tiles')
+    crops_kwargs = dict(
+        crop_size=training_hparams.pop('crop_size', None),
+        samples_per_epoch=training_hparams.pop('samples_per_epoch', None),
+        mmap=training_hparams.pop('mmap', False),
+    )
+
+    # (an 'auto' bs depends on the size of the samples: crops or TILE_SIZE tiles)
+    batching = resolve_batching(
+        data_hparams, size=crops_kwargs['crop_size'] if sampling == 'random_crops' else None)
+    training_hparams['accumulate_steps'] = batching['accumulate_steps']
+    data_kwargs = dict(
+        bs=batching['bs'],
+        num_workers=data_hparams.get('num_workers'),
+        pin_memory=data_hparams.get('pin_memory', False),
+    )
+
+    # (preprocessing cache entries the training reads are pinned, so other
+    # trainings filling the cache can't evict them meanwhile)
+    with ExitStack() as pins:
+        # --- create a DataBunch
+        cls_codes = [it['label'] for it in labels]
+        # (labels are converted in parallel, in preprocess_workers processes)
+        label_raw_paths = get_raw_label_paths(label_paths, labels, workers=preprocess_workers)
+        if pins.enter_context(preprocessing_cache.pinned(label_raw_paths)):
+            # (some evicted before they got pinned, make them again)
+            label_raw_paths = get_raw_label_paths(
+                label_paths, labels, workers=preprocess_workers)
+
+        if sampling == 'random_crops':
+            # random crops out of whole images, a new set every epoch
+            def make_data(valid_pct=0.2):
+                return make_random_crop_data_bunch(
+                    image_paths, label_raw_paths, cls_codes,
+                    valid_pct=valid_pct, **crops_kwargs, **data_kwargs)
+        elif sampling == 'tiles':
+            # fixed tiles of images
+            # image_tiles : [(image_idx, [tile_path])]
+            # (images are tiled in parallel, in preprocess_workers processes)
+            def get_tiles():
+                image_tiles, _ = get_images_tiles_path(image_paths, workers=preprocess_workers)
+                label_tiles, _ = get_images_tiles_path(label_raw_paths, workers=preprocess_workers)
+                return image_tiles, label_tiles
+            image_tiles, label_tiles = get_tiles()
+            tile_dirs = [paths[0].parent for _, paths in image_tiles + label_tiles if paths]
+            if pins.enter_context(preprocessing_cache.pinned(tile_dirs)):
+                image_tiles, label_tiles = get_tiles()
+
+            # pair image and label tiles by image index + tile box (tiles are named by box,
+            # while the cached tiles/raw labels directories are named by content hash)
+            tile_paths, label_tile_paths = pair_tiles(image_tiles, label_tiles)
+
+            def make_data(valid_pct=0.2):
+                return make_data_bunch(
+                    tile_paths, label_tile_paths, cls_codes, valid_pct=valid_pct, **data_kwargs)
+        else:
+            raise ValueError(f"unknown sampling {sampling!r}, expected 'tiles' or 'random_crops'")
+
+        data_bunch = make_data()
+
+        # --- create or load Learner
+        # and load load trained parameters from file
+        learner = make_learner(model_hparams, data_bunch, execution_profile)
+        if parameters_path:
+            parameters_load(learner, parameters_path)
+
+        # --- train
+        def checkpointing(run):
+            if not checkpoint_dir:
+                return {}
+            return {'checkpoint_dir': checkpoint_dir / run, 'resume': resume}
+        if checkpoint_dir and not resume:
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+        t0 = time.perf_counter()
+        scores = learner_train(learner, {
+            **training_hparams,
+            **checkpointing('validated'),
+            'on_epoch_done': on_epoch_done,
+            'on_batch_done': on_batch_done,
+        })
+        validated_time = time.perf_counter() - t0
+
+        # --- get final model trained on whole data (valid_pct=0) before predicting
+        t0 = time.perf_counter()
+        if strategy == 'validate_then_retrain':
+            # retrain from the same starting weights, for as many epochs as the
+            # validated run ended up running (no validation data to stop on plateau)
+            data_bunch = make_data(valid_pct=0)
+            learner = make_learner(model_hparams, data_bunch, execution_profile)
+            if parameters_path:
+                parameters_load(learner, parameters_path)
+            scores_final = learner_train(learner, {
+                **training_hparams,
+                'epochs': scores['epochs_run'],
+                **checkpointing('final'),
+                'on_epoch_done': on_final_epoch_done,
+                'on_batch_done': on_final_batch_done,
+            })
+        elif strategy == 'validate_then_finetune':
+            # continue from the validated weights, shortly
+            learner.data = make_data(valid_pct=0)
+            scores_final = learner_train(learner, {
+                **training_hparams,
+                'epochs': finetune_epochs,
+                'lr': finetune_lr,
+                **checkpointing('final'),
+                'on_epoch_done': on_final_epoch_done,
+                'on_batch_done': on_final_batch_done,
+            })
+        if strategy != 'validate_only':
+            scores['final_train_losses'] = scores_final['train_losses']
+            scores['final_epochs_run'] = scores_final['epochs_run']
+            scores['final_stop_reason'] = scores_final['stop_reason']
+        final_time = time.perf_counter() - t0
+
+    scores.update(batching)
+    scores['training_strategy'] = strategy
+    scores['training_time_s'] = validated_time + final_time
+    # (compared to retraining, which takes about as long as the validated run)
+    scores['time_saved_s'] = (
+        0. if strategy == 'validate_then_retrain' else
+        max(0., validated_time - final_time))
 
     # --- start building result
-    res = {'scores': scores, 'results': results}
+    res = {'scores': scores}
 
     # --- save new trained parameters
     dts = datetime.datetime.now().strftime('%Y-%m-%d-%H%M%S')
@@ -170,12 +496,127 @@ def train_and_predict(
             learner,
             LEARNERS_PATH / f'{dts}-{uuid.uuid4().hex}.pkl'
         )
+    if save_inference_model:
+        # (best effort, the learner works without it, just slower to load and run)
+        try:
+            res['new_inference_model_path'] = export_inference_model(
+                learner,
+                labels,
+                INFERENCE_MODELS_PATH / f'{dts}-{uuid.uuid4().hex}.pt'
+            )
+        except Exception:
+            log.exception("failed exporting inference model, predicting with the learner")
+            res['new_inference_model_path'] = None
 
     res['learner'] = learner
 
+    # --- make predictions for (in memory) tiles of (some of) the training images
+    # and (optionally) save results to files
+    def predict_results(paths):
+        results = predict_images(learner, labels, paths, predict_bs)
+        return save_predictions(results) if save_results else results
+
+    res['predict_after_training'] = predict_mode
+    if predict_mode == 'all':
+        res['results'] = predict_results(image_paths)
+    elif predict_mode == 'sample':
+        res['results'] = predict_results(sample_image_paths(image_paths, predict_sample_size))
+    elif predict_mode == 'deferred':
+        res['results'] = {}
+        res['deferred_results'] = _deferred_predictions.submit(predict_results, image_paths)
+    else:
+        res['results'] = {}
+
+    return res
+
+
+def quantize(
+    learner_path,
+    labels,
+    image_paths,
+    reference_model_path=None,
+    calibration_tiles=None,
+    check_tiles=None,
+    execution_profile=None,
+):
+    """
+    Make the int8 quantized inference model of a Learner (see ml.quantize),
+    calibrated on tiles of some images (eg. the training ones), and check how
+    much it agrees with the float32 model on other tiles of them.
+
+    Parameters
+    ----------
+    learner_path : Path of an exported Learner (.pkl)
+    reference_model_path : Path of the float32 inference model to check against
+        (default: exported anew from the Learner)
+    calibration_tiles, check_tiles : number of tiles to calibrate on / check on
+        (default: QUANTIZE_CALIBRATION_TILES / QUANTIZE_CHECK_TILES)
+
+    Returns
+    -------
+    {new_quantized_model_path,
+     new_inference_model_path (if no reference_model_path was given),
+     report: {calibration_tiles, ...see inference.compare_inference_models}}
+    """
+    apply_execution_profile(execution_profile)
+    n_calibration = calibration_tiles or QUANTIZE_CALIBRATION_TILES
+    n_check = check_tiles or QUANTIZE_CHECK_TILES
+
+    # --- two disjoint random samples of tiles
+    tile_arrs = sample_tile_arrs(image_paths, n_calibration + n_check)
+    if len(tile_arrs) < 2:
+        raise ValueError("images have too few tiles to both calibrate and check quantization")
+    np.random.RandomState(0).shuffle(tile_arrs)
+    if len(tile_arrs) < n_calibration + n_check:  # (fewer tiles than asked for, split them)
+        n_calibration = max(1, min(
+            len(tile_arrs) - 1,
+            round(len(tile_arrs) * n_calibration / (n_calibration + n_check))))
+    calibration_tile_arrs, check_tile_arrs = tile_arrs[:n_calibration], tile_arrs[n_calibration:]
+
+    # --- export float32 (if needed) and int8 models
+    learner = learner_load(learner_path)
+    dts = datetime.datetime.now().strftime('%Y-%m-%d-%H%M%S')
+    res = {}
+    if reference_model_path is None:
+        reference_model_path = res['new_inference_model_path'] = export_inference_model(
+            learner,
+            labels,
+            INFERENCE_MODELS_PATH / f'{dts}-{uuid.uuid4().hex}.pt'
+        )
+    res['new_quantized_model_path'] = export_inference_model(
+        learner,
+        labels,
+        INFERENCE_MODELS_PATH / f'{dts}-{uuid.uuid4().hex}-int8.pt',
+        calibration_tile_arrs=calibration_tile_arrs,
+    )
+
+    # --- check int8 model against float32 one
+    res['report'] = {
+        'calibration_tiles': len(calibration_tile_arrs),
+        **inference.compare_inference_models(
+            load_inference_model(reference_model_path, cache=False),
+            load_inference_model(res['new_quantized_model_path'], cache=False),
+            check_tile_arrs,
+        ),
+    }
     return res
 
 
+def invalidate_learner(learner_path=None):
+    """Drop a (or all if no path is given) cached loaded learner(s) / inference model(s)."""
+    learner_cache.invalidate(learner_path)
+    inference_model_cache.invalidate(learner_path)
+
+
+def learner_cache_stats():
+    """
+    Returns
+    -------
+    {hits, misses, evictions, entries, nbytes, max_bytes}
+    """
+    return learner_cache.stats()
+
+
 def count_patches(raw_result_abs_path, labels_with_count_params):
     """
     Parameters
@@ -190,7 +631,7 @@ def count_patches(raw_result_abs_path, labels_with_count_params):
     -------
     {label:str -> count:int}
     """
-    img_arr = np.asarray(PILImage.open(raw_result_abs_path).convert(mode='L'))
+    img_arr = load_raw_result(raw_result_abs_path)
     code2params = {i:it for i, it in enumerate(labels_with_count_params) if it['count']}
     code2label = {i:it['label'] for i, it in enumerate(labels_with_count_params) if it['count']}
     # : {code -> (area, w, h)}
@@ -213,18 +654,49 @@ def count_patches(raw_result_abs_path, labels_with_count_params):
     return {code2label[code]: count for code, count in res.items()}
 
 
+def load_raw_result(raw_result_abs_path):
+    """h*w uint8 np.array of class codes (memory-mapped for huge, .npy results)
+
+    Reads results saved by save_prediction (palette PNGs, whose indices are the
+    codes) and older separate raw ('L') PNGs alike.
+    """
+    if str(raw_result_abs_path).endswith('.npy'):
+        return np.load(raw_result_abs_path, mmap_mode='r')
+    return get_cls_codes_arr(PILImage.open(raw_result_abs_path))
+
+
+def render_result(raw_result_abs_path, labels):
+    """Nice version of a saved result, with the colors of `labels` ('P' mode image)."""
+    return make_nice_mask(load_raw_result(raw_result_abs_path), labels)
+
+
 def save_predictions(results):
     res = {}
-    for image_path, (raw_result_img, nice_result_img) in results.items():
-        filename = (
-            datetime.datetime.now().strftime('%Y-%m-%d-%H%M%S') +
-            '-' + uuid.uuid4().hex + '.png')
-        raw_result_path = RAW_LABELS_PATH / filename
-        nice_result_path = LABELS_PATH / filename
-        raw_result_img.save(raw_result_path)
-        nice_result_img.save(nice_result_path)
-        res[image_path] = (
-            raw_result_path,
-            nice_result_path,
-        )
-    return res
\ No newline at end of file
+    for image_path, (raw_result_arr, nice_result_img) in results.items():
+        res[image_path] = save_prediction(raw_result_arr, nice_result_img)
+    return res
+
+
+def save_prediction(raw_result_arr, nice_result_img):
+    """
+    Save a result once, as a palette PNG in LABELS_PATH: its pixels are the
+    class codes and its palette the labels' colors (`nice_result_img` as
+    make_nice_mask renders it), so it's both the raw and the nice version.
+    Huge (memory-mapped) results are kept as the .npy they were stitched
+    into (moved to RAW_LABELS_PATH), next to a PNG of their downscaled preview.
+
+    Returns
+    -------
+    (raw_result_path, nice_result_path)
+    """
+    name = datetime.datetime.now().strftime('%Y-%m-%d-%H%M%S') + '-' + uuid.uuid4().hex
+    if isinstance(raw_result_arr, np.memmap):
+        # (huge result, already written to its temporary .npy as it was
+        # stitched, see ml.inference.make_result_arr)
+        raw_result_path = keep_result_arr(raw_result_arr, RAW_LABELS_PATH / (name + '.npy'))
+        nice_result_path = LABELS_PATH / (name + '.png')
+        nice_result_img.save(nice_result_path, compress_level=RESULT_PNG_COMPRESS_LEVEL)
+        return raw_result_path, nice_result_path
+    result_path = LABELS_PATH / (name + '.png')
+    nice_result_img.save(result_path, compress_level=RESULT_PNG_COMPRESS_LEVEL)
+    return result_path, result_path
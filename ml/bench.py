@@ -0,0 +1,316 @@
+"""Micro-benchmarks for the ML pipeline.
+
+Run from the project root, eg.:
+
+    python -m ml.bench predict data/learners/<learner>.pkl data/images/<image>.png
+    python -m ml.bench calibrate data/learners/<learner>.pkl data/images/<image>.png
+    python -m ml.bench coldstart data/learners/<learner>.pkl data/inference-models/<model>.pt
+    python -m ml.bench results
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from PIL import Image as PILImage
+from fastai.vision.image import open_image
+
+from .core import (
+    learner_load,
+    make_wh1_result,
+    predict_tiles,
+)
+from .preprocessing import get_tile_paths
+from .config import EXECUTION_PROFILES, RESULT_PNG_COMPRESS_LEVEL
+from .masks import (
+    get_cls_codes_arr,
+    image_rgb_to_cls_codes,
+    make_col2cls,
+    make_nice_mask,
+)
+from .runtime import apply_execution_profile
+from .tiles import iter_tiles, load_image_arr
+
+
+def timed(f, *args, **kwargs):
+    t0 = time.perf_counter()
+    res = f(*args, **kwargs)
+    return res, time.perf_counter() - t0
+
+
+def bench_predict(learner_path, image_path, bss=(1, 4, 16, None), repeats=1):
+    """Compare tiles/sec of one-tile-at-a-time `Learner.predict` on tile files
+    vs `predict_tiles` on in-memory tiles.
+
+    Returns
+    -------
+    {method:str -> tiles_per_sec:float}
+    """
+    learner = learner_load(learner_path)
+    tile_paths = get_tile_paths(image_path)
+    tile_imgs = [open_image(tile_path) for tile_path in tile_paths]
+    tile_arrs = [tile.arr for tile in iter_tiles(load_image_arr(image_path))]
+    n = len(tile_imgs) * repeats
+
+    def per_tile():
+        for _ in range(repeats):
+            for img in tile_imgs:
+                make_wh1_result(learner.predict(img)[0])
+
+    def batched(bs):
+        for _ in range(repeats):
+            for _ in predict_tiles(learner, tile_arrs, bs):
+                pass
+
+    res = {}
+    _, dt = timed(per_tile)
+    res['Learner.predict'] = n / dt
+    for bs in bss:
+        _, dt = timed(batched, bs)
+        res[f'predict_tiles(bs={bs or "auto"})'] = n / dt
+    return res
+
+
+def _bench_profile(learner_path, image_path, profile, repeats):
+    apply_execution_profile(profile)
+    learner = learner_load(learner_path, cache=False)
+    tile_arrs = [tile.arr for tile in iter_tiles(load_image_arr(image_path))]
+
+    def batched():
+        for _ in range(repeats):
+            for _ in predict_tiles(learner, tile_arrs):
+                pass
+
+    for _ in predict_tiles(learner, tile_arrs[:1]):  # warm up
+        pass
+    _, dt = timed(batched)
+    return len(tile_arrs) * repeats / dt
+
+
+def bench_profiles(learner_path, image_path, profiles=None, repeats=1):
+    """
+    Measure batched prediction tiles/sec for each execution profile (each in
+    a fresh process, since thread settings can only be applied once).
+
+    Returns
+    -------
+    {profile:str -> tiles_per_sec:float}
+    """
+    res = {}
+    for profile in profiles or EXECUTION_PROFILES:
+        with ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            res[profile] = pool.submit(
+                _bench_profile, learner_path, image_path, profile, repeats).result()
+    return res
+
+
+# (run as a separate script: importing this module would already pull in
+# fastai, and the imports are most of a Learner's cold start)
+_COLDSTART_SCRIPT = """
+import json, sys, time
+t0 = time.perf_counter()
+import numpy as np
+model_path = sys.argv[1]
+if model_path.endswith('.pt'):
+    from ml.inference import load_inference_model
+    model = load_inference_model(model_path, cache=False)
+    predict = model.predict_batch
+    w, h = model.tile_size
+else:
+    from ml.config import TILE_SIZE
+    from ml.core import learner_load, predict_tiles
+    learner = learner_load(model_path, cache=False)
+    predict = lambda tile_arrs: list(predict_tiles(learner, tile_arrs, len(tile_arrs)))
+    w, h = TILE_SIZE
+res = {'load (secs)': time.perf_counter() - t0}
+tile_arr = np.zeros((h, w, 3), dtype=np.uint8)
+t1 = time.perf_counter()
+predict([tile_arr])
+res['first tile (secs)'] = time.perf_counter() - t1
+res['total to first tile (secs)'] = time.perf_counter() - t0
+t1 = time.perf_counter()
+for _ in range(10):
+    predict([tile_arr])
+res['per tile, bs=1 (secs)'] = (time.perf_counter() - t1) / 10
+print(json.dumps(res))
+"""
+
+
+def bench_coldstart(model_paths):
+    """
+    Measure load time (imports included) and first / warm single tile latency
+    of learners (.pkl) and exported inference models (.pt), each in a fresh
+    interpreter.
+
+    Returns
+    -------
+    {model_name:measure:str -> seconds:float}
+    """
+    res = {}
+    for model_path in model_paths:
+        out = subprocess.run(
+            [sys.executable, '-c', _COLDSTART_SCRIPT, str(model_path)],
+            check=True, stdout=subprocess.PIPE, universal_newlines=True,
+        ).stdout
+        for k, v in json.loads(out.strip().splitlines()[-1]).items():
+            res[f'{model_path.name}: {k}'] = v
+    return res
+
+
+BENCH_LABELS = [
+    {'label': '__void__', 'rgb': (0, 0, 0)},
+    {'label': 'nucleus', 'rgb': (0, 0, 255)},
+    {'label': 'stain A', 'rgb': (255, 0, 0)},
+    {'label': 'stain B', 'rgb': (0, 255, 0)},
+    {'label': 'RBC', 'rgb': (255, 255, 0)},
+]
+
+
+def make_bench_label_arr(megapixels, labels=BENCH_LABELS, seed=0):
+    """Random label image (with some unknown colors too) of about `megapixels`."""
+    rng = np.random.RandomState(seed)
+    side = int((megapixels * 1e6) ** 0.5)
+    colors = np.array([lbl['rgb'] for lbl in labels] + [(1, 2, 3)], dtype=np.uint8)
+    return colors[rng.randint(0, len(colors), (side, side))]
+
+
+def _image_rgb_to_cls_codes_legacy(rgb_arr, col2cls):
+    # per pixel implementation image_rgb_to_cls_codes replaced, for reference
+    return np.apply_along_axis(
+        lambda rgb: col2cls.get(tuple(rgb), [0])[0], 2, rgb_arr
+    ).astype(np.uint8)
+
+
+def bench_rgb_to_cls_codes(megapixels=(1, 4), legacy=True):
+    """
+    Returns
+    -------
+    {method@size:str -> seconds:float}
+    """
+    col2cls = make_col2cls(BENCH_LABELS)
+    res = {}
+    for mp in megapixels:
+        rgb_arr = make_bench_label_arr(mp)
+        codes, res[f'vectorized@{mp}MP'] = timed(image_rgb_to_cls_codes, rgb_arr, col2cls)
+        if legacy:
+            legacy_codes, res[f'legacy@{mp}MP'] = timed(
+                _image_rgb_to_cls_codes_legacy, rgb_arr, col2cls)
+            assert (codes == legacy_codes).all()
+    return res
+
+
+def make_bench_result_arr(megapixels, labels=BENCH_LABELS, blob=25, noise=0.02, seed=0):
+    """Predicted-like class codes of about `megapixels`: `blob` px square regions
+    of one class, with a `noise` fraction of stray pixels."""
+    rng = np.random.RandomState(seed)
+    side = int((megapixels * 1e6) ** 0.5) // blob * blob
+    arr = np.kron(
+        rng.randint(0, len(labels), (side // blob, side // blob)).astype(np.uint8),
+        np.ones((blob, blob), dtype=np.uint8))
+    stray = rng.rand(side, side) < noise
+    arr[stray] = rng.randint(0, len(labels), stray.sum())
+    return arr
+
+
+def bench_result_storage(megapixels=(4, 16), compress_level=RESULT_PNG_COMPRESS_LEVEL):
+    """Encode time and size of saved results: separate raw ('L') + nice palette
+    PNGs (as saved before) vs one palette PNG.
+
+    Returns
+    -------
+    {method:measure@size:str -> ms or KB per megapixel:float}
+    """
+    def encode(imgs, **kwargs):
+        t0 = time.perf_counter()
+        n_bytes = 0
+        for img in imgs:
+            buf = io.BytesIO()
+            img.save(buf, 'PNG', **kwargs)
+            n_bytes += buf.tell()
+        return time.perf_counter() - t0, n_bytes
+
+    res = {}
+    for mp in megapixels:
+        codes = make_bench_result_arr(mp)
+        real_mp = codes.size / 1e6
+        nice_img = make_nice_mask(codes, BENCH_LABELS)
+        methods = {
+            'raw + nice PNGs': lambda: encode([PILImage.fromarray(codes), nice_img]),
+            'palette PNG': lambda: encode([nice_img], compress_level=compress_level),
+        }
+        for method, run in methods.items():
+            dt, n_bytes = run()
+            res[f'{method}: ms/MP@{mp}MP'] = dt * 1000 / real_mp
+            res[f'{method}: KB/MP@{mp}MP'] = n_bytes / 1024 / real_mp
+        # (the palette PNG is lossless: its indices are the codes)
+        buf = io.BytesIO()
+        nice_img.save(buf, 'PNG', compress_level=compress_level)
+        assert (get_cls_codes_arr(PILImage.open(buf)) == codes).all()
+    return res
+
+
+def print_results(title, res):
+    print(f"\n=== {title}")
+    for k, v in res.items():
+        print(f"{k:>40}: {v:10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    sub = parser.add_subparsers(dest='cmd')
+
+    p = sub.add_parser('predict', help="tiles/sec, per-tile vs batched prediction")
+    p.add_argument('learner_path', type=Path)
+    p.add_argument('image_path', type=Path)
+    p.add_argument('--repeats', type=int, default=1)
+
+    p = sub.add_parser('calibrate', help="tiles/sec, per execution profile")
+    p.add_argument('learner_path', type=Path)
+    p.add_argument('image_path', type=Path)
+    p.add_argument('--profiles', nargs='+', choices=list(EXECUTION_PROFILES))
+    p.add_argument('--repeats', type=int, default=1)
+
+    p = sub.add_parser('coldstart', help="secs, load + first tile, learner vs exported model")
+    p.add_argument('model_paths', type=Path, nargs='+')
+
+    p = sub.add_parser('rgb2codes', help="secs, label image colors to class codes")
+    p.add_argument('--megapixels', type=float, nargs='+', default=[1, 4])
+    p.add_argument('--no-legacy', action='store_true')
+
+    p = sub.add_parser('results', help="ms and KB per megapixel, saving results")
+    p.add_argument('--megapixels', type=float, nargs='+', default=[4, 16])
+    p.add_argument('--compress-level', type=int, default=RESULT_PNG_COMPRESS_LEVEL)
+
+    args = parser.parse_args()
+    if args.cmd == 'predict':
+        print_results(
+            'predict (tiles/sec)',
+            bench_predict(args.learner_path, args.image_path, repeats=args.repeats))
+    elif args.cmd == 'calibrate':
+        print_results(
+            'execution profiles (tiles/sec)',
+            bench_profiles(
+                args.learner_path, args.image_path, args.profiles, repeats=args.repeats))
+    elif args.cmd == 'coldstart':
+        print_results('cold start (secs)', bench_coldstart(args.model_paths))
+    elif args.cmd == 'rgb2codes':
+        print_results(
+            'image_rgb_to_cls_codes (secs)',
+            bench_rgb_to_cls_codes(args.megapixels, legacy=not args.no_legacy))
+    elif args.cmd == 'results':
+        print_results(
+            'saving results (ms/MP, KB/MP)',
+            bench_result_storage(args.megapixels, args.compress_level))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # (not on Windows, index updates are then only thread safe)
+    fcntl = None
+
+
+class LearnerCache:
+    """
+    Process-wide LRU cache of loaded Learners.
+
+    Entries are keyed by (learner_path, mtime, size) of the exported learner
+    file, so a file rewritten in place is never served stale. The total
+    (estimated) size of the cached models is kept under `max_bytes` by
+    evicting the least recently used ones (the most recently loaded learner
+    is always kept, even if it alone goes over budget).
+
+    Parameters
+    ----------
+    load : (learner_abs_path) -> Learner
+    sizeof : (Learner) -> int, estimated bytes held by a loaded Learner
+    max_bytes : int, memory budget (0 disables caching)
+    """
+
+    def __init__(self, load, sizeof, max_bytes):
+        self.load = load
+        self.sizeof = sizeof
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # : {(path, mtime, size) -> (learner, nbytes)}
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def make_key(learner_abs_path):
+        learner_abs_path = Path(learner_abs_path).resolve()
+        st = learner_abs_path.stat()
+        return str(learner_abs_path), st.st_mtime_ns, st.st_size
+
+    def get(self, learner_abs_path):
+        key = self.make_key(learner_abs_path)
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+            self.misses += 1
+            learner = self.load(learner_abs_path)
+            if self.max_bytes > 0:
+                # drop entries for older versions of the same file
+                self._discard(lambda k: k[0] == key[0])
+                self._entries[key] = (learner, self.sizeof(learner))
+                self._evict()
+            return learner
+
+    def invalidate(self, learner_abs_path=None):
+        """Drop cached learner(s) for a path (or everything if no path is given)."""
+        with self._lock:
+            if learner_abs_path is None:
+                self._entries.clear()
+            else:
+                path = str(Path(learner_abs_path).resolve())
+                self._discard(lambda k: k[0] == path)
+
+    @property
+    def nbytes(self):
+        return sum(nbytes for _, nbytes in self._entries.values())
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                entries=len(self._entries),
+                nbytes=self.nbytes,
+                max_bytes=self.max_bytes,
+            )
+
+    def _discard(self, pred):
+        for k in [k for k in self._entries if pred(k)]:
+            del self._entries[k]
+
+    def _evict(self):
+        while len(self._entries) > 1 and self.nbytes > self.max_bytes:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+class PreprocessingCache:
+    """
+    On-disk cache of preprocessing outputs (tiles, raw label masks), shared by processes.
+
+    Entries are keyed by the content hash of the source file plus the
+    parameters that affect the output (eg. tile size, label colors), so a
+    changed source or labels mapping never reuses stale outputs, while
+    identical inputs are reused across trainings (whatever their file name).
+
+    Entries are built in a temporary location and atomically renamed in
+    place. An index (`index.json`, updated under a file lock) tracks their
+    sizes and last use, and the least recently used are evicted to keep the
+    total under `max_bytes`. Except for entries pinned (see `pinned`) by
+    some process still using them.
+
+    Parameters
+    ----------
+    root : Path, cache directory
+    max_bytes : int, disk budget
+    """
+
+    INDEX_FILENAME = 'index.json'
+    LOCK_FILENAME = 'index.lock'
+    TMP_DIRNAME = 'tmp'
+    PINS_DIRNAME = 'pins'
+
+    def __init__(self, root, max_bytes):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self._hashes = {}  # : {(path, mtime, size) -> content hash}
+        self._pins = Counter()  # : {entry name -> times pinned by this process}
+        self._lock = threading.RLock()
+
+    def file_hash(self, abs_path):
+        st = os.stat(abs_path)
+        memo_key = (str(abs_path), st.st_mtime_ns, st.st_size)
+        if memo_key not in self._hashes:
+            h = hashlib.sha256()
+            with open(abs_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(2 ** 20), b''):
+                    h.update(chunk)
+            self._hashes[memo_key] = h.hexdigest()
+        return self._hashes[memo_key]
+
+    def make_key(self, src_abs_path, kind, **params):
+        """Cache key for the `kind` output made from a source file with some params."""
+        h = hashlib.sha256(self.file_hash(src_abs_path).encode())
+        h.update(json.dumps(params, sort_keys=True).encode())
+        return f'{kind}-{h.hexdigest()[:32]}'
+
+    def get_or_make(self, key, make, suffix=''):
+        """
+        Get path of entry `key`, making it if missing.
+
+        Parameters
+        ----------
+        make : (tmp_abs_path) -> None, writes the entry to tmp_abs_path (a file
+            or a directory, as long as it's created by `make`)
+        suffix : str, file extension of entry
+
+        Returns
+        -------
+        abs path of entry
+        """
+        entry_abs_path = self.root / (key + suffix)
+        if not entry_abs_path.exists():
+            tmp_abs_path = self.root / self.TMP_DIRNAME / (uuid.uuid4().hex + suffix)
+            tmp_abs_path.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                make(tmp_abs_path)
+                try:
+                    os.rename(tmp_abs_path, entry_abs_path)
+                except OSError:
+                    # made concurrently by someone else meanwhile, use theirs
+                    if not entry_abs_path.exists():
+                        raise
+            finally:
+                _rm(tmp_abs_path)
+        self._touch(key + suffix, entry_abs_path)
+        return entry_abs_path
+
+    def invalidate(self, key, suffix=''):
+        with self._locked_index() as index:
+            index.pop(key + suffix, None)
+            _rm(self.root / (key + suffix))
+
+    @contextmanager
+    def pinned(self, entry_abs_paths):
+        """
+        Keep entries from being evicted, by any process, while in the block
+        (eg. for the life of a training reading them).
+
+        Pins are held by a file (in PINS_DIRNAME) listing the entries, share
+        locked for as long as they're pinned, so the pins of a process that
+        died are ignored (and cleaned up).
+
+        Yields
+        ------
+        [entry_abs_path] of the entries evicted before they got pinned, for
+        the caller to make again (they're pinned too)
+        """
+        names = sorted({Path(p).name for p in entry_abs_paths})
+        pins_abs_path = self.root / self.PINS_DIRNAME
+        pins_abs_path.mkdir(parents=True, exist_ok=True)
+        pin_name = f'{os.getpid()}-{uuid.uuid4().hex}.json'
+        tmp_pin_abs_path = pins_abs_path / (pin_name + '.tmp')
+        pin_file = open(tmp_pin_abs_path, 'w')
+        try:
+            if fcntl:
+                fcntl.flock(pin_file, fcntl.LOCK_SH)
+            pin_file.write(json.dumps(names))
+            pin_file.flush()
+            with self._locked_index():
+                # (renamed in place once locked and complete, so evicting
+                # processes never take it for the pin of a dead process)
+                os.rename(tmp_pin_abs_path, pins_abs_path / pin_name)
+                with self._lock:
+                    self._pins.update(names)
+                missing = [self.root / name for name in names
+                           if not (self.root / name).exists()]
+            yield missing
+        finally:
+            with self._lock:
+                self._pins.subtract(names)
+                self._pins += Counter()  # (drop non-positive counts)
+            for abs_path in (pins_abs_path / pin_name, tmp_pin_abs_path):
+                try:
+                    abs_path.unlink()
+                except OSError:
+                    pass
+            pin_file.close()
+
+    def stats(self):
+        with self._locked_index() as index:
+            return dict(
+                entries=len(index),
+                nbytes=sum(it['nbytes'] for it in index.values()),
+                max_bytes=self.max_bytes,
+            )
+
+    def _touch(self, name, entry_abs_path):
+        with self._locked_index() as index:
+            if name not in index:
+                index[name] = {'nbytes': _du(entry_abs_path)}
+            index[name]['last_used'] = time.time()
+            self._evict(index, keep=name)
+
+    def _evict(self, index, keep):
+        total = sum(it['nbytes'] for it in index.values())
+        if total <= self.max_bytes:
+            return
+        pinned = self._pinned_names()
+        for name in sorted(index, key=lambda n: index[n]['last_used']):
+            if total <= self.max_bytes:
+                break
+            if name == keep or name in pinned:
+                continue
+            total -= index.pop(name)['nbytes']
+            _rm(self.root / name)
+
+    def _pinned_names(self):
+        """Names of the entries pinned by any (live) process (call with the index locked)."""
+        with self._lock:
+            pinned = set(self._pins)
+        pins_abs_path = self.root / self.PINS_DIRNAME
+        if not fcntl or not pins_abs_path.is_dir():
+            return pinned
+        for pin_abs_path in pins_abs_path.glob('*.json'):
+            try:
+                with open(pin_abs_path) as pin_file:
+                    try:
+                        fcntl.flock(pin_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:  # (share locked, its process is using the entries)
+                        pinned.update(json.load(pin_file))
+                    else:  # (left over by a process that died)
+                        pin_abs_path.unlink()
+            except (OSError, ValueError):
+                continue
+        return pinned
+
+    @contextmanager
+    def _locked_index(self):
+        """Lock index (across threads and processes), yield it as dict and save it after."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        index_abs_path = self.root / self.INDEX_FILENAME
+        with self._lock, open(self.root / self.LOCK_FILENAME, 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    index = json.loads(index_abs_path.read_text())
+                except (OSError, ValueError):
+                    index = {}
+                yield index
+                tmp_index_abs_path = index_abs_path.with_name(
+                    f'{self.INDEX_FILENAME}.{uuid.uuid4().hex}.tmp')
+                tmp_index_abs_path.write_text(json.dumps(index))
+                os.replace(tmp_index_abs_path, index_abs_path)
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _du(abs_path):
+    abs_path = Path(abs_path)
+    if abs_path.is_dir():
+        return sum(p.stat().st_size for p in abs_path.rglob('*') if p.is_file())
+    return abs_path.stat().st_size
+
+
+def _rm(abs_path):
+    abs_path = Path(abs_path)
+    if abs_path.is_dir():
+        shutil.rmtree(abs_path, ignore_errors=True)
+    elif abs_path.exists():
+        abs_path.unlink()
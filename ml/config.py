@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 PROJ_ROOT_PATH = Path(__file__).parent.parent.resolve()
@@ -8,6 +9,9 @@ LABELS_rPATH = DATA_rPATH / "labels"
 RAW_LABELS_rPATH = DATA_rPATH / "raw-labels"
 LEARNERS_rPATH = DATA_rPATH / "learners"
 PARAMETERS_rPATH = DATA_rPATH / "parameters"
+PREPROCESS_CACHE_rPATH = DATA_rPATH / "cache"
+CHECKPOINTS_rPATH = DATA_rPATH / "checkpoints"
+INFERENCE_MODELS_rPATH = DATA_rPATH / "inference-models"
 
 DATA_PATH = PROJ_ROOT_PATH / DATA_rPATH
 IMAGES_PATH = PROJ_ROOT_PATH / IMAGES_rPATH
@@ -15,5 +19,132 @@ LABELS_PATH = PROJ_ROOT_PATH / LABELS_rPATH
 RAW_LABELS_PATH = PROJ_ROOT_PATH / RAW_LABELS_rPATH
 LEARNERS_PATH = PROJ_ROOT_PATH / LEARNERS_rPATH
 PARAMETERS_PATH = PROJ_ROOT_PATH / PARAMETERS_rPATH
+PREPROCESS_CACHE_PATH = PROJ_ROOT_PATH / PREPROCESS_CACHE_rPATH
+CHECKPOINTS_PATH = PROJ_ROOT_PATH / CHECKPOINTS_rPATH
+INFERENCE_MODELS_PATH = PROJ_ROOT_PATH / INFERENCE_MODELS_rPATH
 
 TILE_SIZE = (200, 200)
+
+# --- batched inference
+# tiles per forward pass, None means "size automatically from available RAM"
+PREDICT_BS = None
+PREDICT_MAX_BS = 64
+# fraction of the currently available RAM a prediction batch may use
+PREDICT_MEM_FRACTION = 0.25
+# rough peak number of float32 activation "channels" kept alive per input pixel
+# during a forward pass (dominated by the decoder of a resnet34 based U-Net)
+PREDICT_ACTIVATION_CHANNELS = 256
+
+# tiles per region read from images (see tiles.iter_reader_tiles), along a row of tiles
+READ_REGION_TILES = 16
+# results of images at least this big (in pixels) are stitched into memory-mapped
+# .npy files instead of RAM, and their nice versions are downscaled previews of
+# at most NICE_PREVIEW_MAX_SIDE pixels wide / high
+MEMMAP_RESULT_MIN_PIXELS = 2 ** 26
+NICE_PREVIEW_MAX_SIDE = 4096
+# islands of results are counted in strips of rows of about this many pixels
+# (see masks.count_islands), so huge results are never labelled whole
+COUNT_ISLANDS_STRIP_PIXELS = 2 ** 24
+
+# zlib level (0-9) of saved results (palette PNGs, see ml.api.save_prediction):
+# past 3 they get barely smaller but several times slower to encode
+RESULT_PNG_COMPRESS_LEVEL = 3
+
+# worker processes predicting images in parallel (see ml.api.predict_sharded_iter),
+# each with its own loaded model and its share of the cores ('shared-<n>' profile)
+# - 1: predict in-process, one image after another
+# - 0 or None: one per available core
+PREDICT_WORKERS = int(os.environ.get('HISTOBOT_PREDICT_WORKERS', 1)) or None
+
+# where prediction runs (see ml.api.predict):
+# - 'local': in the calling process
+# - 'server': in the inference server (`python -m ml.server`), which keeps models
+#   loaded and batches tiles of concurrent callers together
+PREDICT_BACKENDS = ('local', 'server')
+PREDICT_BACKEND = os.environ.get('HISTOBOT_PREDICT_BACKEND', 'local')
+
+# --- inference server (see ml.server)
+INFERENCE_SERVER_ADDRESS = os.environ.get(
+    'HISTOBOT_INFERENCE_SERVER_ADDRESS', str(DATA_PATH / 'inference-server.sock'))
+# shared secret clients must know (besides having access to the socket file), or None
+INFERENCE_SERVER_AUTHKEY = os.environ.get('HISTOBOT_INFERENCE_SERVER_AUTHKEY', None)
+# max tiles per forward pass, and max time a request waits for others to batch with
+INFERENCE_SERVER_MAX_BS = 32
+INFERENCE_SERVER_MAX_LATENCY_MS = 20
+
+# --- int8 quantized inference (see ml.quantize)
+# quantized kernels backend, None means 'fbgemm' (x86) if available, else 'qnnpack' (ARM)
+QUANTIZATION_BACKEND = None
+# training tiles used to calibrate activation ranges, and (other) tiles used to
+# check the quantized model's agreement with the float one
+QUANTIZE_CALIBRATION_TILES = 64
+QUANTIZE_CHECK_TILES = 64
+# what analyses can run on: the float32 exported model or its int8 variant
+INFERENCE_PRECISIONS = ('float32', 'int8')
+
+# --- loaded learners cache (per process)
+# memory budget for the models kept loaded, 0 disables caching
+LEARNER_CACHE_MAX_BYTES = 2 * 2 ** 30
+
+# --- preprocessing (tiling images, converting labels)
+# worker processes (capped at the number of CPU cores), 0 or 1 means no pool
+PREPROCESS_WORKERS = int(os.environ.get('HISTOBOT_PREPROCESS_WORKERS', 4))
+# disk budget of the (content addressed) cache of tiles and raw label masks
+PREPROCESS_CACHE_MAX_BYTES = 20 * 2 ** 30
+
+# --- training
+# what train_and_predict predicts with the trained model (on the training images)
+# - 'all': all images
+# - 'sample': PREDICT_SAMPLE_SIZE images (or `predict_sample_size`), evenly spread
+# - 'off': nothing
+# - 'deferred': all images, in the background (train_and_predict returns a
+#   future of the results instead)
+PREDICT_AFTER_TRAINING_MODES = ('all', 'sample', 'off', 'deferred')
+PREDICT_AFTER_TRAINING = 'all'
+PREDICT_SAMPLE_SIZE = 4
+# how train_and_predict gets to its final model:
+# - 'validate_then_retrain': train with 20% validation data (for scores), then
+#   train again from the same starting weights on all data
+# - 'validate_only': just the run with validation data
+# - 'validate_then_finetune': run with validation data, then continue from its
+#   weights on all data for a few (`finetune_epochs`) more epochs
+TRAINING_STRATEGIES = ('validate_then_retrain', 'validate_only', 'validate_then_finetune')
+TRAINING_STRATEGY = 'validate_then_retrain'
+# default `finetune_epochs` as a fraction of `epochs`
+FINETUNE_EPOCHS_FRACTION = 0.25
+# `bs: 'auto'` picks the largest batch that fits this fraction of available RAM
+# (or `mem_budget` bytes, if given in hparams)
+TRAIN_MEM_FRACTION = 0.5
+TRAIN_MAX_BS = 64
+# rough number of float32 values kept per input pixel per sample while training
+# (activations saved for backward, their gradients, etc.)
+TRAIN_ACTIVATION_CHANNELS = 768
+# min seconds between (per batch) training progress reports, see learner_train
+TRAINING_PROGRESS_INTERVAL_S = 0.5
+# training checkpoints (weights + optimizer state + progress), when training with
+# a `checkpoint_dir`: saved every N epochs and/or M minutes (checked at epoch
+# ends, None disables either), only the K most recent are kept
+CHECKPOINT_EVERY_EPOCHS = 5
+CHECKPOINT_EVERY_MINUTES = 10
+CHECKPOINT_KEEP = 2
+
+# --- CPU execution profiles
+# - threads: torch intra-op threads, int or float (fraction of the CPU cores)
+# - interop_threads: torch inter-op threads
+# - pin_cores: pin the process to its own `threads` cores (slot picked by
+#   EXECUTION_SLOT, so concurrent jobs on the same box don't share cores)
+# - channels_last: use the NHWC memory layout (faster convolutions on CPU)
+EXECUTION_PROFILES = {
+    # leave torch defaults alone
+    'default': {},
+    # one job having the whole box
+    'exclusive': dict(threads=1., interop_threads=1, channels_last=True),
+    # 2 / 4 concurrent jobs (eg. training + analysis), each on its share of cores
+    # (any other 'shared-<n>' works too, see runtime.get_execution_profile)
+    'shared-2': dict(threads=1 / 2, interop_threads=1, pin_cores=True, channels_last=True),
+    'shared-4': dict(threads=1 / 4, interop_threads=1, pin_cores=True, channels_last=True),
+    # one thread (eg. per worker of a multi-process setup)
+    'single': dict(threads=1, interop_threads=1, channels_last=True),
+}
+EXECUTION_PROFILE = os.environ.get('HISTOBOT_EXECUTION_PROFILE', 'default')
+EXECUTION_SLOT = os.environ.get('HISTOBOT_EXECUTION_SLOT', None)
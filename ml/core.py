@@ -1,25 +1,50 @@
-import shutil
-from collections import defaultdict, deque
+import json
+import logging
+import os
+import time
 
 import fastai
+import torch
 from fastai.basic_train import load_learner
+from fastai.callbacks import OneCycleScheduler
 from fastai.vision import (
     SegmentationItemList,
+    SegmentationLabelList,
 )
+from fastai.vision.image import Image as FastaiImage, ImageSegment
 
 from .config import *
 from utils.utils import get_in_obj
+from .cache import LearnerCache
+from .inference import ExportedSegmenter, save_inference_model
+from .quantize import quantize_model
+from .runtime import (
+    apply_execution_profile,
+    auto_predict_bs,
+    get_available_memory,
+    get_process_rss,
+    prepare_batch,
+    prepare_model,
+)
+from .preprocessing import preprocessing_cache
+from .readers import crop_arr
+from .tiles import (
+    get_tile_boxes,
+    load_image_arr,
+    split_train_valid_arrs,
+)
 from .masks import *
 
 
-# fastai.torch_core.defaults.device = 'cpu'
-
+log = logging.getLogger(__name__)
 
-def get_img_size(image_path):
-    return PILImage.open(image_path).size
+# fastai.torch_core.defaults.device = 'cpu'
 
 
-def make_data_bunch(image_abs_paths, label_abs_paths, cls_codes, valid_pct=0.2, bs=1):
+def make_data_bunch(
+    image_abs_paths, label_abs_paths, cls_codes, valid_pct=0.2, bs=1,
+    num_workers=None, pin_memory=False,
+):
     image2label_paths = dict(zip(image_abs_paths, label_abs_paths))
 
     item_list = SegmentationItemList(items=image_abs_paths, path=image_abs_paths[0].parent)
@@ -31,17 +56,273 @@ def make_data_bunch(image_abs_paths, label_abs_paths, cls_codes, valid_pct=0.2,
         classes=np.asarray(cls_codes)
     )
 
-    data_bunch = label_lists.databunch(bs=bs)
+    loader_kwargs = {}
+    if num_workers is not None:
+        loader_kwargs['num_workers'] = num_workers
+    if pin_memory:
+        loader_kwargs['pin_memory'] = True
+    data_bunch = label_lists.databunch(bs=bs, **loader_kwargs)
 
     return data_bunch
 
 
+class RandomCropSampler:
+    """
+    Random crops (same box for image and mask) out of source images that are
+    decoded only once, and kept in memory or memory-mapped.
+
+    Item `i` < `n_train` gets a new crop every epoch out of the training
+    images, the others (validation items) always get the same one out of the
+    validation images (see `split_train_valid_arrs`, so validation crops never
+    overlap training ones). Images are picked proportionally to their area,
+    crops are uniformly placed inside them (images smaller than `crop_size`
+    are zero padded, so crops always have the same size).
+
+    Parameters
+    ----------
+    image_arrs : [h*w*3 np.array], training images
+    mask_arrs : [h*w np.array], class codes
+    crop_size : (w:int, h:int)
+    n_train : int, number of training items
+    valid_image_arrs, valid_mask_arrs : validation images and masks
+    """
+
+    def __init__(
+        self, image_arrs, mask_arrs, crop_size, n_train, seed=0,
+        valid_image_arrs=(), valid_mask_arrs=(),
+    ):
+        self.image_arrs = {True: list(image_arrs), False: list(valid_image_arrs)}
+        self.mask_arrs = {True: list(mask_arrs), False: list(valid_mask_arrs)}
+        self.crop_size = crop_size
+        self.n_train = n_train
+        self.seed = seed
+        self.epoch = 0
+        self.image_probs = {}
+        for is_train, arrs in self.image_arrs.items():
+            areas = np.array([arr.shape[0] * arr.shape[1] for arr in arrs], dtype=np.float64)
+            self.image_probs[is_train] = areas / areas.sum() if len(areas) else areas
+
+    def crop_box(self, i):
+        is_train = i < self.n_train
+        rng = np.random.RandomState(
+            [self.seed, i, self.epoch if is_train else 0, int(is_train)])
+        img_idx = rng.choice(len(self.image_arrs[is_train]), p=self.image_probs[is_train])
+        h, w = self.image_arrs[is_train][img_idx].shape[:2]
+        crop_w, crop_h = self.crop_size
+        x = rng.randint(0, max(0, w - crop_w) + 1)
+        y = rng.randint(0, max(0, h - crop_h) + 1)
+        return is_train, img_idx, [x, y, x + crop_w, y + crop_h]
+
+    def crop_image(self, i):
+        is_train, img_idx, box = self.crop_box(i)
+        return crop_arr(self.image_arrs[is_train][img_idx], box)
+
+    def crop_mask(self, i):
+        is_train, img_idx, box = self.crop_box(i)
+        return crop_arr(self.mask_arrs[is_train][img_idx], box)
+
+
+class RandomCropItemList(SegmentationItemList):
+    """Items are ints, image for item i is `sampler.crop_image(i)`."""
+
+    def __init__(self, items, sampler=None, **kwargs):
+        super().__init__(items, **kwargs)
+        self.sampler = sampler
+        self.copy_new.append('sampler')
+
+    def get(self, i):
+        arr = self.sampler.crop_image(self.items[i])
+        return FastaiImage(torch.from_numpy(
+            np.ascontiguousarray(arr.transpose(2, 0, 1))).float().div_(255))
+
+
+class RandomCropLabelList(SegmentationLabelList):
+    """Items are ints, mask for item i is `sampler.crop_mask(i)`."""
+
+    def __init__(self, items, sampler=None, **kwargs):
+        super().__init__(items, **kwargs)
+        self.sampler = sampler
+        self.copy_new.append('sampler')
+
+    def get(self, i):
+        arr = self.sampler.crop_mask(self.items[i])
+        return ImageSegment(torch.from_numpy(arr.astype(np.float32))[None])
+
+
+class ResampleCrops(fastai.callback.Callback):
+    """New random crops every epoch for a RandomCropItemList DataBunch."""
+
+    def __init__(self, learn, done_epochs=0):
+        self.learn = learn
+        self.done_epochs = done_epochs
+
+    def on_train_begin(self, **kwargs):
+        # (resumed training doesn't repeat the crops of the done epochs)
+        self.learn.data.train_ds.x.sampler.epoch += self.done_epochs
+
+    def on_epoch_begin(self, **kwargs):
+        self.learn.data.train_ds.x.sampler.epoch += 1
+
+
+def get_decoded_path(abs_path, decode):
+    """Get (make if not already in the preprocessing cache) a .npy of a decoded image."""
+    key = preprocessing_cache.make_key(abs_path, 'decoded', decode=decode.__name__)
+    return preprocessing_cache.get_or_make(
+        key, lambda tmp_abs_path: np.save(tmp_abs_path, decode(abs_path)), suffix='.npy')
+
+
+def load_mask_arr(mask_abs_path):
+    """Decode a raw mask to a h*w uint8 np.array of class codes."""
+    return np.asarray(PILImage.open(mask_abs_path))
+
+
+def make_random_crop_data_bunch(
+    image_abs_paths, label_abs_paths, cls_codes, crop_size=None, samples_per_epoch=None,
+    valid_pct=0.2, mmap=False, seed=0, bs=1, num_workers=None, pin_memory=False,
+):
+    """
+    Like `make_data_bunch`, but from random crops of whole images and raw masks
+    instead of fixed tiles (so each source file is read once).
+
+    Parameters
+    ----------
+    crop_size : (w:int, h:int), default TILE_SIZE
+    samples_per_epoch : int, training crops per epoch, default: as many
+        as there would be tiles of crop_size in the training images
+    valid_pct : float, part of the images (of the rows of a single image)
+        validation crops are taken from, see `split_train_valid_arrs`
+    mmap : bool, memory-map decoded images (cached in PREPROCESS_CACHE_PATH)
+        instead of keeping them in memory
+    """
+    crop_size = crop_size or TILE_SIZE
+    if mmap:
+        image_arrs = [np.load(get_decoded_path(p, load_image_arr), mmap_mode='r')
+                      for p in image_abs_paths]
+        mask_arrs = [np.load(get_decoded_path(p, load_mask_arr), mmap_mode='r')
+                     for p in label_abs_paths]
+    else:
+        image_arrs = [load_image_arr(p) for p in image_abs_paths]
+        mask_arrs = [load_mask_arr(p) for p in label_abs_paths]
+    # (validation crops come from held out images or rows, not from the
+    # regions training crops are taken from)
+    (image_arrs, mask_arrs), (valid_image_arrs, valid_mask_arrs) = split_train_valid_arrs(
+        image_arrs, mask_arrs, valid_pct, seed)
+    if samples_per_epoch is None:
+        samples_per_epoch = sum(
+            len(list(get_tile_boxes((arr.shape[1], arr.shape[0]), crop_size)))
+            for arr in image_arrs)
+    n_valid = int(round(samples_per_epoch * valid_pct)) if valid_image_arrs else 0
+
+    sampler = RandomCropSampler(
+        image_arrs, mask_arrs, crop_size, samples_per_epoch, seed,
+        valid_image_arrs=valid_image_arrs, valid_mask_arrs=valid_mask_arrs)
+
+    item_list = RandomCropItemList(
+        items=np.arange(samples_per_epoch + n_valid),
+        sampler=sampler,
+        path=image_abs_paths[0].parent)
+
+    item_lists = item_list.split_by_idx(np.arange(samples_per_epoch, samples_per_epoch + n_valid))
+
+    label_lists = item_lists.label_from_func(
+        lambda i: i,
+        label_cls=RandomCropLabelList,
+        sampler=sampler,
+        classes=np.asarray(cls_codes)
+    )
+
+    loader_kwargs = {}
+    if num_workers is not None:
+        loader_kwargs['num_workers'] = num_workers
+    if pin_memory:
+        loader_kwargs['pin_memory'] = True
+    data_bunch = label_lists.databunch(bs=bs, **loader_kwargs)
+
+    return data_bunch
+
+
+# hparams controlling data loading and batching, they can be given either in
+# model_hparams or in training_hparams (training_hparams win)
+# - bs: int or 'auto'
+# - effective_bs: int, batch size optimizer steps are made with (bs * accumulate_steps,
+#   an int bs must divide it)
+# - accumulate_steps: int, batches to accumulate gradients over before a step
+# - mem_budget: int, bytes 'auto' bs can use
+# - num_workers: int, DataLoader worker processes
+# - pin_memory: bool
+DATA_HPARAMS = ('bs', 'effective_bs', 'accumulate_steps', 'mem_budget', 'num_workers', 'pin_memory')
+
+
+def pop_data_hparams(model_hparams, training_hparams):
+    """
+    Returns
+    -------
+    (model_hparams, training_hparams, data_hparams), without DATA_HPARAMS in first two
+    """
+    model_hparams, training_hparams = model_hparams.copy(), training_hparams.copy()
+    data_hparams = {}
+    for hparams in (model_hparams, training_hparams):
+        for k in DATA_HPARAMS:
+            if k in hparams:
+                data_hparams[k] = hparams.pop(k)
+    return model_hparams, training_hparams, data_hparams
+
+
+def auto_train_bs(size=None, mem_budget=None, max_bs=None):
+    """Largest training batch size that fits the memory budget."""
+    tile_w, tile_h = size or TILE_SIZE
+    max_bs = max_bs or TRAIN_MAX_BS
+    if mem_budget is None:
+        avail = get_available_memory()
+        if avail is None:
+            return 1
+        mem_budget = avail * TRAIN_MEM_FRACTION
+    sample_bytes = tile_w * tile_h * 4 * TRAIN_ACTIVATION_CHANNELS
+    return int(max(1, min(max_bs, mem_budget // sample_bytes)))
+
+
+def resolve_batching(data_hparams, size=None):
+    """
+    Get physical batch size and gradient accumulation steps from data hparams.
+
+    With `effective_bs`, gradients are accumulated over enough batches to
+    reach it, and an 'auto' batch size is lowered to a divisor of it, so that
+    bs * accumulate_steps == effective_bs exactly and results stay comparable
+    whatever batch size fits in memory (an explicit bs must divide it).
+
+    Parameters
+    ----------
+    size : (w:int, h:int), default TILE_SIZE
+        size of the training samples (tiles or random crops), for an 'auto' bs
+
+    Returns
+    -------
+    {bs, accumulate_steps, effective_bs}
+    """
+    bs = data_hparams.get('bs', 1)
+    if bs != 'auto' and 'effective_bs' in data_hparams and data_hparams['effective_bs'] % bs:
+        raise ValueError(f"effective_bs {data_hparams['effective_bs']} isn't a multiple of bs {bs}")
+    if bs == 'auto':
+        max_bs = auto_train_bs(size, data_hparams.get('mem_budget'))
+        if 'effective_bs' in data_hparams:
+            max_bs = min(max_bs, data_hparams['effective_bs'])
+            bs = max(b for b in range(1, max_bs + 1) if data_hparams['effective_bs'] % b == 0)
+        else:
+            bs = max_bs
+    if 'effective_bs' in data_hparams:
+        accumulate_steps = max(1, -(-data_hparams['effective_bs'] // bs))
+    else:
+        accumulate_steps = data_hparams.get('accumulate_steps', 1)
+    return dict(bs=bs, accumulate_steps=accumulate_steps, effective_bs=bs * accumulate_steps)
+
+
 def _metric_top1acc(inp, tgt):
     tgt = tgt.squeeze(1)
     return (inp.argmax(dim=1) == tgt).float().mean()
 
 
-def make_learner(model_hparams, data_bunch):
+def make_learner(model_hparams, data_bunch, profile=None):
+    apply_execution_profile(profile)
     model_hparams = model_hparams.copy()
     learner_class_path = model_hparams.pop('learner_class')
     model_class_path = model_hparams.pop('model_class')
@@ -60,39 +341,480 @@ def make_learner(model_hparams, data_bunch):
         **model_hparams
     }
 
-    return learner_class(**params)
+    learner = learner_class(**params)
+    learner.model = prepare_model(learner.model, profile)
+    return learner
 
 
-def learner_load(learner_abs_path):
-    return load_learner(
+def _learner_load(learner_abs_path, profile=None):
+    apply_execution_profile(profile)
+    learner = load_learner(
         learner_abs_path.parent,
         learner_abs_path.name)
+    learner.model = prepare_model(learner.model, profile)
+    return learner
+
+
+def get_model_nbytes(learner):
+    """Memory held by a Learner's model parameters and buffers (eg. batchnorm stats)."""
+    tensors = list(learner.model.parameters()) + list(learner.model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+learner_cache = LearnerCache(
+    load=_learner_load,
+    sizeof=get_model_nbytes,
+    max_bytes=LEARNER_CACHE_MAX_BYTES,
+)
+
+
+def learner_load(learner_abs_path, cache=True):
+    if cache:
+        return learner_cache.get(learner_abs_path)
+    return _learner_load(learner_abs_path)
 
 
 def learner_save(learner, abs_path):
     abs_path.parent.mkdir(parents=True, exist_ok=True)
     learner.path = abs_path.parent
     learner.export(abs_path.name)
+    learner_cache.invalidate(abs_path)
     return abs_path
 
 
+def export_inference_model(learner, labels, abs_path, size=None, calibration_tile_arrs=None,
+                           bs=None):
+    """
+    Export a Learner's model for lean inference (see ml.inference): traced to
+    TorchScript on `size` (default TILE_SIZE) uint8 RGB tiles, with the input
+    normalization of its data baked in and the labels attached.
+
+    With `calibration_tile_arrs` ([h*w*3 uint8 np.array], representative
+    tiles, eg. from the training images) the int8 quantized variant of the
+    model is exported instead (see ml.quantize), calibrated on them in
+    batches of `bs` tiles.
+    """
+    tile_w, tile_h = size or TILE_SIZE
+    norm = getattr(learner.data, 'norm', None)
+    if norm is not None:
+        mean, std = norm.keywords['mean'].cpu(), norm.keywords['std'].cpu()
+    else:
+        mean, std = (0., 0., 0.), (1., 1., 1.)
+    meta = dict(
+        labels=labels,
+        tile_size=[tile_w, tile_h],
+        normalization=dict(mean=list(map(float, mean)), std=list(map(float, std))),
+        precision='float32',
+    )
+
+    if calibration_tile_arrs is None:
+        device = next(learner.model.parameters()).device
+        module = ExportedSegmenter(learner.model, mean, std).to(device).eval()
+    else:
+        # (int8 kernels are CPU only)
+        device = torch.device('cpu')
+        bs = bs or PREDICT_BS or auto_predict_bs(size)
+
+        def calibrate(model):
+            calibrating = ExportedSegmenter(model, mean, std).eval()
+            for i in range(0, len(calibration_tile_arrs), bs):
+                calibrating(torch.from_numpy(np.stack(calibration_tile_arrs[i:i + bs])))
+
+        model, n_convs = quantize_model(learner.model, calibrate)
+        module = ExportedSegmenter(model, mean, std).eval()
+        meta.update(precision='int8', int8_convs=n_convs,
+                    calibration_tiles=len(calibration_tile_arrs))
+
+    with torch.no_grad():
+        traced = torch.jit.trace(
+            module, torch.zeros((2, tile_h, tile_w, 3), dtype=torch.uint8, device=device))
+    return save_inference_model(traced, meta, abs_path)
+
+
+class AccumulateGradients(fastai.callback.Callback):
+    """
+    Step the optimizer only every `n_steps` batches, with the gradients of those
+    batches averaged, so it behaves like training with `n_steps` times bigger batches.
+    """
+
+    def __init__(self, learn, n_steps):
+        self.learn = learn
+        self.n_steps = n_steps
+        self.n_batches = 0
+
+    def on_train_begin(self, **kwargs):
+        opt = self.learn.opt
+        self._opt_step, self._opt_zero_grad = opt.step, opt.zero_grad
+        opt.step, opt.zero_grad = self._step, self._zero_grad
+
+    def on_epoch_begin(self, **kwargs):
+        self.n_batches = 0
+
+    def on_batch_begin(self, train, **kwargs):
+        if train:
+            self.n_batches += 1
+
+    def on_epoch_end(self, **kwargs):
+        # step with what's left of last (partial) group of batches
+        if self.n_batches % self.n_steps:
+            self._average_and_step(self.n_batches % self.n_steps)
+            self._opt_zero_grad()
+
+    def on_train_end(self, **kwargs):
+        opt = self.learn.opt
+        del opt.step, opt.zero_grad
+
+    def _step(self):
+        if self.n_batches % self.n_steps == 0:
+            self._average_and_step(self.n_steps)
+
+    def _zero_grad(self):
+        if self.n_batches % self.n_steps == 0:
+            self._opt_zero_grad()
+
+    def _average_and_step(self, n):
+        for p in self.learn.model.parameters():
+            if p.grad is not None:
+                p.grad.div_(n)
+        self._opt_step()
+
+
+class ResumableOneCycleScheduler(OneCycleScheduler):
+    """
+    One-cycle schedule planned over `total_epochs`, the first `done_epochs` of
+    which already ran (eg. before an interrupted run was checkpointed), so
+    fitting the remaining epochs continues on the same lr / momentum curves.
+
+    Can be replanned mid training over fewer epochs (see StopTraining).
+    """
+
+    def __init__(self, learn, lr_max, total_epochs, done_epochs=0, **kwargs):
+        super().__init__(learn, lr_max, **kwargs)
+        self.total_epochs = total_epochs
+        self.done_epochs = done_epochs
+
+    def on_train_begin(self, n_epochs, **kwargs):
+        self.train_begin_kwargs = kwargs
+        return self.replan(self.total_epochs, self.done_epochs)
+
+    def replan(self, total_epochs, done_epochs):
+        """Plan schedule over `total_epochs` and move to after `done_epochs` of them."""
+        self.total_epochs = total_epochs
+        # (OneCycleScheduler.on_train_begin keeps the tot_epochs / start_epoch
+        # it got first, so they're reset for it to plan over total_epochs)
+        self.tot_epochs = total_epochs
+        self.start_epoch = None
+        res = super().on_train_begin(n_epochs=total_epochs, **self.train_begin_kwargs)
+        # fast forward schedule past the batches of the done epochs
+        for _ in range(done_epochs * len(self.learn.data.train_dl)):
+            self.on_batch_end(train=True)
+        return res
+
+
+def get_training_history(learner, history=None):
+    """Losses and scores recorded by the last fit, appended to an earlier `history`."""
+    history = history or dict(train_losses=[], validation_losses=[], scores=[])
+    rec = learner.recorder
+    return dict(
+        train_losses=history['train_losses'] + [float(x) for x in rec.losses],
+        validation_losses=history['validation_losses'] + [float(x) for x in rec.val_losses],
+        scores=history['scores'] + [float(x[0]) for x in rec.metrics],
+    )
+
+
+def checkpoint_save(learner, checkpoint_dir, epoch, total_epochs, history, keep=None,
+                    stop_reason=None):
+    """
+    Save weights + optimizer state after `epoch` (1-based) of `total_epochs` to
+    `checkpoint_dir`, along with the training history so far (and why training
+    stopped, if it stopped early), then remove all but the `keep` most recent
+    checkpoints.
+    """
+    keep = keep or CHECKPOINT_KEEP
+    name = f'epoch-{epoch:04d}'
+    parameters_save(learner, checkpoint_dir / f'{name}.pth')
+    # (metadata written last, atomically, marks the checkpoint complete)
+    tmp_meta_path = checkpoint_dir / f'{name}.json.tmp'
+    tmp_meta_path.write_text(json.dumps(dict(
+        epoch=epoch,
+        total_epochs=total_epochs,
+        history=history,
+        stop_reason=stop_reason,
+        saved_at=time.time(),
+    )))
+    os.replace(tmp_meta_path, checkpoint_dir / f'{name}.json')
+    for meta_path in sorted(checkpoint_dir.glob('epoch-*.json'))[:-keep]:
+        meta_path.unlink()
+        meta_path.with_suffix('.pth').unlink()
+    log.info(f"saved checkpoint {checkpoint_dir / name} ({epoch}/{total_epochs} epochs)")
+
+
+def checkpoint_find_latest(checkpoint_dir, total_epochs):
+    """
+    Returns
+    -------
+    {path: Path of .pth, epoch, total_epochs, history, stop_reason, saved_at}
+    of the latest complete checkpoint of a `total_epochs` long training, or None
+    """
+    if not checkpoint_dir.exists():
+        return None
+    for meta_path in sorted(checkpoint_dir.glob('epoch-*.json'), reverse=True):
+        meta = json.loads(meta_path.read_text())
+        params_path = meta_path.with_suffix('.pth')
+        if meta['total_epochs'] == total_epochs and params_path.exists():
+            return {'stop_reason': None, **meta, 'path': params_path}
+    return None
+
+
+class StopTraining(fastai.callback.Callback):
+    """
+    Stop training before its planned epochs:
+    - on a validation loss plateau: no improvement of more than `min_delta`
+      in `patience` epochs
+    - on running out of a wall-clock `time_budget_s`: after each epoch the
+      one-cycle schedule is compressed to the epochs still fitting the budget
+      (at the average epoch time so far), so it still ends annealed to low lrs
+
+    `reason` is then 'plateau' or 'time_budget'.
+    """
+
+    def __init__(self, learn, scheduler, done_epochs=0, history=None,
+                 patience=None, min_delta=0., time_budget_s=None):
+        self.learn = learn
+        self.scheduler = scheduler
+        self.done_epochs = done_epochs
+        self.history = history
+        self.patience = patience
+        self.min_delta = min_delta
+        self.time_budget_s = time_budget_s
+
+    def on_train_begin(self, **kwargs):
+        self.t0 = time.monotonic()
+        self.n_epochs = 0
+        self.reason = None
+        self.initially_planned_epochs = self.scheduler.total_epochs
+        # (resumed training remembers the validation losses before it)
+        self.best_loss, self.n_bad_epochs = float('inf'), 0
+        for loss in (self.history or {}).get('validation_losses', []):
+            self._track_loss(loss)
+
+    def on_epoch_end(self, **kwargs):
+        self.n_epochs += 1
+        epoch = self.done_epochs + self.n_epochs
+        val_losses = self.learn.recorder.val_losses
+        if self.patience and val_losses:
+            self._track_loss(float(val_losses[-1]))
+            if self.n_bad_epochs >= self.patience:
+                self.reason = 'plateau'
+        if self.time_budget_s and not self.reason:
+            elapsed = time.monotonic() - self.t0
+            fitting_epochs = epoch + int((self.time_budget_s - elapsed) // (elapsed / self.n_epochs))
+            planned_epochs = self.scheduler.total_epochs
+            if fitting_epochs < planned_epochs:
+                if fitting_epochs > epoch:
+                    log.info(f"compressing one-cycle schedule to {fitting_epochs} epochs "
+                             f"to fit time budget of {self.time_budget_s}s")
+                    self.scheduler.replan(fitting_epochs, epoch)
+                elif epoch < planned_epochs:
+                    self.reason = 'time_budget'
+            elif self.initially_planned_epochs > epoch >= planned_epochs:
+                # (end of compressed schedule)
+                self.reason = 'time_budget'
+        if self.reason:
+            log.info(f"stopping training after {epoch} epochs ({self.reason})")
+            return {'stop_training': True}
+
+    def _track_loss(self, loss):
+        if loss < self.best_loss - self.min_delta:
+            self.best_loss, self.n_bad_epochs = loss, 0
+        else:
+            self.n_bad_epochs += 1
+
+
+class TrackTrainingBatchesProgress(fastai.callback.Callback):
+    """
+    Report progress after training batches, at most every `interval_s` seconds, as
+    on_batch_done({epoch, epochs, batch, n_batches, loss, tiles_per_s, eta_s, rss_bytes})
+    - epoch : 0-based, of the whole (maybe resumed) training, of `epochs` planned
+      by `scheduler` (fewer if compressed to fit a time budget)
+    - batch : 1-based, of `n_batches` per epoch
+    - loss : running (smoothed) training loss
+    - tiles_per_s : training samples (tiles or crops) per second so far
+    - eta_s : estimated seconds left (of training batches, validation not included)
+    - rss_bytes : resident memory of the training process
+    """
+
+    def __init__(self, learn, on_batch_done, scheduler, done_epochs=0, interval_s=None):
+        self.learn = learn
+        self.on_batch_done = on_batch_done
+        self.scheduler = scheduler
+        self.done_epochs = done_epochs
+        self.interval_s = TRAINING_PROGRESS_INTERVAL_S if interval_s is None else interval_s
+
+    def on_train_begin(self, **kwargs):
+        self.t0 = self.last_reported_t = time.monotonic()
+        self.n_batches_run = 0
+        self.n_samples = 0
+        self.epoch = self.done_epochs - 1
+
+    def on_epoch_begin(self, **kwargs):
+        self.epoch += 1
+        self.batch = 0
+
+    def on_batch_end(self, train, last_input, **kwargs):
+        if not train:
+            return
+        self.batch += 1
+        self.n_batches_run += 1
+        self.n_samples += len(last_input)
+        now = time.monotonic()
+        if now - self.last_reported_t < self.interval_s:
+            return
+        self.last_reported_t = now
+        elapsed = now - self.t0
+        n_batches = len(self.learn.data.train_dl)
+        loss = kwargs.get('smooth_loss', kwargs.get('last_loss'))
+        batches_left = (self.scheduler.total_epochs - self.epoch) * n_batches - self.batch
+        self.on_batch_done(dict(
+            epoch=self.epoch,
+            epochs=self.scheduler.total_epochs,
+            batch=self.batch,
+            n_batches=n_batches,
+            loss=float(loss) if loss is not None else None,
+            tiles_per_s=self.n_samples / elapsed,
+            eta_s=max(0, batches_left) * elapsed / self.n_batches_run,
+            rss_bytes=get_process_rss(),
+        ))
+
+
+class SaveCheckpoints(fastai.callback.Callback):
+    """
+    Checkpoint training every `every_epochs` epochs and/or `every_minutes`
+    minutes (both checked at epoch ends), and after the last epoch (the last
+    one `stopper`, a StopTraining callback placed before this one, allows).
+    """
+
+    def __init__(self, learn, checkpoint_dir, total_epochs, done_epochs=0, history=None,
+                 every_epochs=None, every_minutes=None, keep=None, stopper=None):
+        self.learn = learn
+        self.checkpoint_dir = checkpoint_dir
+        self.total_epochs = total_epochs
+        self.done_epochs = done_epochs
+        self.history = history
+        self.every_epochs = every_epochs
+        self.every_minutes = every_minutes
+        self.keep = keep
+        self.stopper = stopper
+
+    def on_train_begin(self, **kwargs):
+        self.checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        self.last_saved_t = time.monotonic()
+        self.n_epochs = 0
+
+    def on_epoch_end(self, **kwargs):
+        self.n_epochs += 1
+        epoch = self.done_epochs + self.n_epochs
+        stop_reason = self.stopper.reason if self.stopper else None
+        if (
+            epoch == self.total_epochs or
+            stop_reason or
+            (self.every_epochs and epoch % self.every_epochs == 0) or
+            (self.every_minutes and
+             time.monotonic() - self.last_saved_t >= self.every_minutes * 60)
+        ):
+            checkpoint_save(
+                self.learn, self.checkpoint_dir, epoch, self.total_epochs,
+                get_training_history(self.learn, self.history), self.keep, stop_reason)
+            self.last_saved_t = time.monotonic()
+
+
 def learner_train(learner, training_hparams):
+    """
+    Train with the one-cycle policy, for `epochs`, or less with:
+    - `early_stopping_patience` (and `early_stopping_min_delta`): stop once
+      validation loss stops improving
+    - `time_budget_s`: compress the schedule to fit a wall-clock budget
+    (see StopTraining).
+
+    Progress is reported to `on_epoch_done(epoch, **fastai_callback_state)`
+    and (optionally) `on_batch_done(progress)` (see TrackTrainingBatchesProgress).
+
+    With a `checkpoint_dir` in training_hparams, training is checkpointed
+    (see SaveCheckpoints and CHECKPOINT_* config, or `checkpoint_every_epochs`,
+    `checkpoint_every_minutes`, `checkpoint_keep` hparams), and with `resume`
+    it continues from the latest checkpoint there, if any.
+
+    Returns
+    -------
+    {train_losses, validation_losses, scores,
+     epochs_run, stop_reason: 'epochs' (ran all), 'plateau' or 'time_budget'}
+    """
     training_hparams = training_hparams.copy()
     epochs = training_hparams.pop('epochs')
     lr = training_hparams.pop('lr')
     on_epoch_done = training_hparams.pop('on_epoch_done')
+    on_batch_done = training_hparams.pop('on_batch_done', None)
+    accumulate_steps = training_hparams.pop('accumulate_steps', 1)
+    stop_kwargs = dict(
+        patience=training_hparams.pop('early_stopping_patience', None),
+        min_delta=training_hparams.pop('early_stopping_min_delta', 0.),
+        time_budget_s=training_hparams.pop('time_budget_s', None),
+    )
+    checkpoint_dir = training_hparams.pop('checkpoint_dir', None)
+    checkpoint_kwargs = dict(
+        every_epochs=training_hparams.pop('checkpoint_every_epochs', CHECKPOINT_EVERY_EPOCHS),
+        every_minutes=training_hparams.pop('checkpoint_every_minutes', CHECKPOINT_EVERY_MINUTES),
+        keep=training_hparams.pop('checkpoint_keep', CHECKPOINT_KEEP),
+    )
+    resume = training_hparams.pop('resume', False)
+    scheduler_kwargs = {
+        k: training_hparams.pop(k)
+        for k in ('moms', 'div_factor', 'pct_start') if k in training_hparams}
+
+    done_epochs, history = 0, None
+    if checkpoint_dir and resume:
+        checkpoint = checkpoint_find_latest(checkpoint_dir, epochs)
+        if checkpoint:
+            parameters_load(learner, checkpoint['path'])
+            done_epochs, history = checkpoint['epoch'], checkpoint['history']
+            log.info(f"resuming training from {checkpoint['path']}")
+            if checkpoint['stop_reason'] or done_epochs >= epochs:
+                return dict(
+                    **history,
+                    epochs_run=done_epochs,
+                    stop_reason=checkpoint['stop_reason'] or 'epochs')
+
+    lr = learner.lr_range(slice(lr))
+    scheduler = ResumableOneCycleScheduler(learner, lr, epochs, done_epochs, **scheduler_kwargs)
+    stopper = None
+    callbacks = []
     if on_epoch_done:
         class TrackTrainingEpochsProgress(fastai.callback.Callback):
             def on_epoch_end(self, epoch, **kwargs):
-                on_epoch_done(epoch, **kwargs)
-        training_hparams['callbacks'] = TrackTrainingEpochsProgress()
-    learner.fit_one_cycle(epochs, slice(lr), **training_hparams)
-    rec = learner.recorder
+                on_epoch_done(done_epochs + epoch, **kwargs)
+        callbacks.append(TrackTrainingEpochsProgress())
+    if on_batch_done:
+        callbacks.append(TrackTrainingBatchesProgress(
+            learner, on_batch_done, scheduler, done_epochs))
+    if accumulate_steps > 1:
+        callbacks.append(AccumulateGradients(learner, accumulate_steps))
+    if isinstance(learner.data.train_ds.x, RandomCropItemList):
+        callbacks.append(ResampleCrops(learner, done_epochs))
+    if stop_kwargs['patience'] or stop_kwargs['time_budget_s']:
+        stopper = StopTraining(learner, scheduler, done_epochs, history, **stop_kwargs)
+        callbacks.append(stopper)
+    if checkpoint_dir:
+        callbacks.append(SaveCheckpoints(
+            learner, checkpoint_dir, epochs, done_epochs, history,
+            stopper=stopper, **checkpoint_kwargs))
+    # (what Learner.fit_one_cycle does, with a resumable schedule)
+    learner.fit(epochs - done_epochs, lr, callbacks=callbacks + [scheduler], **training_hparams)
+
+    history = get_training_history(learner, history)
     return dict(
-        train_losses=[float(x) for x in rec.losses],
-        validation_losses=[float(x) for x in rec.val_losses],
-        scores=[float(x[0]) for x in rec.metrics],
-    )
+        **history,
+        epochs_run=done_epochs + len(learner.recorder.nb_batches),
+        stop_reason=(stopper and stopper.reason) or 'epochs')
 
 
 def parameters_load(learner, params_abs_path):
@@ -106,121 +828,45 @@ def parameters_save(learner, params_abs_path):
         return_path=True)
 
 
-def get_tile_paths(image_abs_path, size=None, recreate=False):
-    tile_w, tile_h = size or TILE_SIZE
-    dir_abs_path = image_abs_path.parent / (image_abs_path.name + f'_tiles_{tile_w}-{tile_h}')
-    if dir_abs_path.exists():
-        if recreate:
-            shutil.rmtree(dir_abs_path, ignore_errors=True)
-        else:
-            return dir_abs_path.ls()
-    dir_abs_path.mkdir()
-
-    img = PILImage.open(image_abs_path)
-    w, h = img.size
-    tile_abs_paths = []
-
-    for y in range(0, h, tile_h):
-        for x in range(0, w, tile_w):
-            # --- coords box/area we crop from original image and save as tile
-            # [left, top, right, bottom]
-            box = [x, y, x + tile_w, y + tile_h]
-            # if (last) box goes over edges, shift it back inside bounding area
-            # (yes, it will overlap with previous boxes)
-            if box[2] > w:
-                dx = box[2] - w
-                box[0] -= dx
-                box[2] -= dx
-            if box[3] > h:
-                dy = box[3] - h
-                box[1] -= dy
-                box[3] -= dy
-            # --- crop
-            tile_img = img.crop(box)
-            # --- save
-            tile_abs_path = dir_abs_path / ('-'.join(map(str, box)) + image_abs_path.suffix)
-            tile_abs_paths.append(tile_abs_path)
-            tile_img.save(tile_abs_path)
-
-    return tile_abs_paths
-
-
-def get_images_tiles_path(image_paths):
-    tile_paths = []  # : [str]
-    tile2image_paths = {}  # : {tile_path -> image_path}
-    image_szs = {}  # : {image_path -> (w: int, h: int)
-    for image_path in image_paths:
-        image_szs[image_path] = get_img_size(image_path)
-        for tile_path in get_tile_paths(image_path):
-            tile_paths.append(tile_path)
-            tile2image_paths[tile_path] = image_path
-    return tile_paths, tile2image_paths, image_szs
-
-
-def get_raw_label_path(nice_label_abs_path, labels):
-    raw_label_abs_path = RAW_LABELS_PATH / nice_label_abs_path.name
-    if not raw_label_abs_path.exists():
-        raw_label_abs_path.parent.mkdir(parents=True, exist_ok=True)
-        make_raw_mask(
-            PILImage.open(nice_label_abs_path), labels
-        ).save(raw_label_abs_path)
-    return raw_label_abs_path
-
-
-def get_nice_label_path(raw_label_abs_path, labels):
-    nice_label_abs_path = LABELS_PATH / raw_label_abs_path.name
-    if not nice_label_abs_path.exists():
-        nice_label_abs_path.parent.mkdir(parents=True, exist_ok=True)
-        make_nice_mask(
-            PILImage.open(nice_label_abs_path), labels
-        ).save(nice_label_abs_path)
-    return nice_label_abs_path
-
-
-def make_img_from_tiles(tiles, img_sz):
-    img = PILImage.new('RGB', img_sz)
-    for tile_path, tile_img_arr in tiles:
-        tile_img = PILImage.fromarray(tile_img_arr)
-        box = list(map(int, str(tile_path.stem).split('-')))
-        img.paste(tile_img, box)
-    return img
+def _predict_batch(learner, tile_arrs):
+    # same as fastai's open_image: RGB, channels first, float in [0, 1]
+    xb = torch.from_numpy(np.stack(tile_arrs)).permute(0, 3, 1, 2).float().div_(255)
+    ds = learner.data.single_ds
+    if ds.tfms:
+        xb = torch.stack([FastaiImage(x).apply_tfms(ds.tfms, **ds.tfmargs).data for x in xb])
+    yb = torch.zeros(len(tile_arrs), dtype=torch.long)
+    # same device placement + normalization as Learner.predict does
+    xb, _ = learner.data.single_dl.proc_batch((xb, yb))
+    xb = prepare_batch(xb)
+    with torch.no_grad():
+        out = learner.model.eval()(xb)
+    return list(out.argmax(dim=1).cpu().numpy().astype(np.uint8))
+
+
+def predict_tiles(learner, tile_arrs, bs=None):
+    """Predict class code masks for (same sized) tiles, `bs` tiles per forward pass.
+
+    Parameters
+    ----------
+    learner : fastai Learner
+    tile_arrs : iterable of h*w*3 uint8 np.array (eg. from `iter_tiles`)
+    bs : int, tiles per batch (default: PREDICT_BS or auto_predict_bs())
+
+    Yields
+    ------
+    h*w np.array of uint8 class codes, in the same order as `tile_arrs`
+    """
+    apply_execution_profile()
+    bs = bs or PREDICT_BS or auto_predict_bs()
+    batch = []
+    for tile_arr in tile_arrs:
+        batch.append(tile_arr)
+        if len(batch) == bs:
+            yield from _predict_batch(learner, batch)
+            batch = []
+    if batch:
+        yield from _predict_batch(learner, batch)
 
 
 def make_wh1_result(res_arr):
     return np.asarray(res_arr.data[0, :, :], dtype=np.uint8)
-
-
-def count_islands(m, codes):
-    island_szs = defaultdict(list)
-    visited = np.zeros(m.shape, dtype=np.int)
-
-    def explore_island(r, c):
-        code = m[r, c]
-        sz = 0
-        frontier = deque([(r, c)])
-        x_min, y_min, x_max, y_max = r, c, r, c
-        while frontier:
-            cx, cy = frontier.popleft()
-            visited[cx, cy] = 1
-            sz += 1
-            if cx < x_min: x_min = cx
-            if cx > x_max: x_max = cx
-            if cy < y_min: y_min = cy
-            if cy > y_max: y_max = cy
-            for x, y in neighbours(cx, cy):
-                if m[x, y] == code and not visited[x, y] and (x, y) not in frontier:
-                    frontier.append((x, y))
-        island_szs[code].append((sz, x_max - x_min + 1, y_max - y_min + 1))
-
-    def neighbours(x, y):
-        if x > 0: yield (x - 1, y)
-        if y > 0: yield (x, y - 1)
-        if x < m.shape[0] - 1: yield (x + 1, y)
-        if y < m.shape[1] - 1: yield (x, y + 1)
-
-    for r in range(m.shape[0]):
-        for c in range(m.shape[1]):
-            if m[r, c] in codes and not visited[r, c]:
-                explore_island(r, c)
-
-    return island_szs
@@ -0,0 +1,285 @@
+"""
+Lean inference on exported models (see ml.core.export_inference_model).
+
+Only needs torch, numpy and PIL: no fastai import chain, no Learner to unpickle,
+so it's quick to start and light to keep loaded.
+
+An exported model is a TorchScript module taking a batch of uint8 RGB tiles
+(n*h*w*3, as they come out of images) and returning their uint8 class codes
+(n*h*w), with the model's input normalization baked in. Its labels and tile
+size are attached to the same file (as the INFERENCE_META_FILENAME extra file).
+"""
+import itertools
+import json
+import os
+import time
+import uuid
+import weakref
+from operator import attrgetter
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from .config import *
+from .cache import LearnerCache
+from .masks import make_nice_mask
+from .runtime import apply_execution_profile, auto_predict_bs
+from .tiles import iter_images_tiles, make_arr_from_tiles, make_memmap_arr
+
+
+INFERENCE_META_FILENAME = 'histobot.json'
+INFERENCE_FORMAT_VERSION = 1
+
+
+class ExportedSegmenter(torch.nn.Module):
+    """uint8 n*h*w*3 RGB tiles -> uint8 n*h*w class codes, through a segmentation model."""
+
+    def __init__(self, model, mean, std):
+        super().__init__()
+        self.model = model
+        self.register_buffer('mean', torch.as_tensor(mean, dtype=torch.float32).view(1, 3, 1, 1))
+        self.register_buffer('std', torch.as_tensor(std, dtype=torch.float32).view(1, 3, 1, 1))
+
+    def forward(self, x):
+        # (NHWC input permuted to NCHW is already in channels last memory layout)
+        x = x.permute(0, 3, 1, 2).float().div(255)
+        x = (x - self.mean) / self.std
+        return self.model(x).argmax(dim=1).to(torch.uint8)
+
+
+def is_inference_model_path(abs_path):
+    return str(abs_path).endswith('.pt')
+
+
+def save_inference_model(module, meta, abs_path):
+    """
+    Parameters
+    ----------
+    module : TorchScript module (eg. a traced ExportedSegmenter)
+    meta : {labels, tile_size, ...}, json serializable
+    """
+    abs_path.parent.mkdir(parents=True, exist_ok=True)
+    meta = {'format_version': INFERENCE_FORMAT_VERSION, 'created_at': time.time(), **meta}
+    torch.jit.save(module, str(abs_path), _extra_files={
+        INFERENCE_META_FILENAME: json.dumps(meta)})
+    return abs_path
+
+
+class InferenceModel:
+    """
+    A loaded exported model.
+
+    Attributes
+    ----------
+    module : TorchScript module
+    meta : {format_version, labels, tile_size, precision, ...}
+    labels : [{label, rgb}], as the model was trained with
+    tile_size : (w, h) the model was exported for
+    precision : 'float32' or 'int8' (see ml.quantize)
+    """
+
+    def __init__(self, abs_path):
+        extra_files = {INFERENCE_META_FILENAME: ''}
+        self.module = torch.jit.load(str(abs_path), map_location='cpu', _extra_files=extra_files)
+        self.module.eval()
+        self.meta = json.loads(extra_files[INFERENCE_META_FILENAME])
+        if self.meta.get('format_version') != INFERENCE_FORMAT_VERSION:
+            raise ValueError(f"{abs_path} has unsupported inference format "
+                             f"{self.meta.get('format_version')!r}")
+        self.labels = self.meta['labels']
+        self.tile_size = tuple(self.meta['tile_size'])
+        self.precision = self.meta.get('precision', 'float32')
+
+    @property
+    def nbytes(self):
+        tensors = list(self.module.parameters()) + list(self.module.buffers())
+        return sum(t.numel() * t.element_size() for t in tensors)
+
+    def predict_batch(self, tile_arrs):
+        """[h*w*3 uint8 np.array] -> [h*w uint8 np.array of class codes]"""
+        with torch.no_grad():
+            return list(self.module(torch.from_numpy(np.stack(tile_arrs))).numpy())
+
+
+inference_model_cache = LearnerCache(
+    load=InferenceModel,
+    sizeof=attrgetter('nbytes'),
+    max_bytes=LEARNER_CACHE_MAX_BYTES,
+)
+
+
+def load_inference_model(abs_path, cache=True):
+    if cache:
+        return inference_model_cache.get(abs_path)
+    return InferenceModel(abs_path)
+
+
+def predict_tiles(model, tile_arrs, bs=None):
+    """Like ml.core.predict_tiles, for an InferenceModel."""
+    apply_execution_profile()
+    bs = bs or PREDICT_BS or auto_predict_bs(model.tile_size)
+    batch = []
+    for tile_arr in tile_arrs:
+        batch.append(tile_arr)
+        if len(batch) == bs:
+            yield from model.predict_batch(batch)
+            batch = []
+    if batch:
+        yield from model.predict_batch(batch)
+
+
+def iter_predict_images(model, labels, image_paths, bs=None, predict_tiles=predict_tiles):
+    """
+    Predict images, tiling them in memory.
+
+    Parameters
+    ----------
+    model : InferenceModel, or whatever `predict_tiles` takes (eg. a Learner
+        with ml.core.predict_tiles)
+    labels : [{label, rgb}] (default: the InferenceModel's)
+
+    Yields
+    ------
+    (image_path, raw_result_arr, nice_result_image), one image at a time
+    """
+    labels = labels or model.labels
+    size = getattr(model, 'tile_size', None)
+    # : Tile, each source image decoded once
+    tiles, tiles_to_predict = itertools.tee(iter_images_tiles(image_paths, size))
+    tile_arrs = (tile.arr for tile in tiles_to_predict)
+
+    # --- make predictions for tiles
+    # (tiles of an image come in one run, batches can span images)
+    result_tiles = (
+        tile._replace(arr=result_arr)
+        for tile, result_arr in zip(tiles, predict_tiles(model, tile_arrs, bs)))
+    for image_path, image_result_tiles in itertools.groupby(
+            result_tiles, key=attrgetter('image_path')):
+        # --- reassemble full result image from tiles and convert it to nice version
+        # assemble results (raw) from predicted tiles (using their boxes)
+        raw_result_arr = make_arr_from_tiles(image_result_tiles, make_arr=make_result_arr)
+        # create nice version of prediction from raw version
+        nice_result_img = make_nice_result(raw_result_arr, labels)
+        yield image_path, raw_result_arr, nice_result_img
+
+
+def make_result_arr(img_sz):
+    """
+    h*w uint8 np.array to stitch an image's result into: in memory, or for
+    huge images (MEMMAP_RESULT_MIN_PIXELS and up) memory-mapped to a temporary
+    .npy file (in RAW_LABELS_PATH/tmp), so it's written out as it's stitched.
+
+    The temporary file is deleted once the array is garbage collected, unless
+    it's kept (see keep_result_arr, as ml.api.save_prediction does).
+    """
+    w, h = img_sz
+    if w * h < MEMMAP_RESULT_MIN_PIXELS:
+        return np.zeros((h, w), dtype=np.uint8)
+    tmp_abs_path = RAW_LABELS_PATH / 'tmp' / (uuid.uuid4().hex + '.npy')
+    return _own_result_file(make_memmap_arr(tmp_abs_path, img_sz), tmp_abs_path)
+
+
+def _own_result_file(arr, abs_path):
+    """Delete `abs_path` once `arr` is garbage collected (unless released before)."""
+    arr._result_file_finalizer = weakref.finalize(arr, _remove_file, abs_path)
+    return arr
+
+
+def _remove_file(abs_path):
+    try:
+        os.remove(abs_path)
+    except FileNotFoundError:
+        pass
+
+
+def release_result_arr(arr):
+    """Flush a memory-mapped result and stop its temporary file from being
+    deleted with it (eg. to hand it over to another process, see
+    load_result_arr), -> the file's Path."""
+    arr.flush()
+    finalizer = getattr(arr, '_result_file_finalizer', None)
+    if finalizer is not None:
+        finalizer.detach()
+    return Path(arr.filename)
+
+
+def load_result_arr(abs_path):
+    """Memory-map a temporary result file handed over by another process (it's
+    then deleted with the returned array, unless kept)."""
+    return _own_result_file(np.load(abs_path, mmap_mode='r+'), abs_path)
+
+
+def keep_result_arr(arr, abs_path):
+    """Move a memory-mapped result's temporary file to `abs_path`, for good."""
+    os.replace(release_result_arr(arr), abs_path)
+    return abs_path
+
+
+def make_nice_result(raw_result_arr, labels):
+    """make_nice_mask of a result, downscaled to a NICE_PREVIEW_MAX_SIDE preview
+    for memory-mapped (huge) ones."""
+    if isinstance(raw_result_arr, np.memmap):
+        step = -(-max(raw_result_arr.shape) // NICE_PREVIEW_MAX_SIDE)
+        raw_result_arr = np.ascontiguousarray(raw_result_arr[::step, ::step])
+    return make_nice_mask(raw_result_arr, labels)
+
+
+def compare_inference_models(reference, candidate, tile_arrs, bs=None):
+    """
+    Check how much a (eg. int8 quantized) model agrees with a reference (eg.
+    float32) one on some tiles, and how much faster it is.
+
+    Parameters
+    ----------
+    reference, candidate : InferenceModel's with the same labels
+    tile_arrs : [h*w*3 uint8 np.array], ideally not the quantized model's
+        calibration tiles
+
+    Returns
+    -------
+    {tiles: int,
+     pixel_agreement: float, fraction of pixels both models predict the same,
+     per_class: {label -> {pixels: int, predicted by the reference,
+                           agreement: float, fraction of them the candidate
+                           predicts the same (None if no pixels)}},
+     reference_tiles_per_s, candidate_tiles_per_s, speedup: float}
+    """
+    labels = reference.labels
+    n_classes = len(labels)
+    # : reference class x candidate class -> pixels
+    confusion = np.zeros((n_classes, n_classes), dtype=np.int64)
+    dts = {'reference': 0., 'candidate': 0.}
+    bs = bs or PREDICT_BS or auto_predict_bs(reference.tile_size)
+    for model in (reference, candidate):  # (warm up, first runs of TorchScript are slow)
+        model.predict_batch(tile_arrs[:1])
+    for i in range(0, len(tile_arrs), bs):
+        batch = tile_arrs[i:i + bs]
+        t0 = time.perf_counter()
+        ref_codes = np.stack(reference.predict_batch(batch))
+        t1 = time.perf_counter()
+        cand_codes = np.stack(candidate.predict_batch(batch))
+        dts['reference'] += t1 - t0
+        dts['candidate'] += time.perf_counter() - t1
+        confusion += np.bincount(
+            ref_codes.ravel().astype(np.int64) * n_classes + cand_codes.ravel(),
+            minlength=n_classes * n_classes,
+        ).reshape(n_classes, n_classes)
+
+    pixels = confusion.sum(axis=1)
+    res = {
+        'tiles': len(tile_arrs),
+        'pixel_agreement': float(np.trace(confusion) / max(1, confusion.sum())),
+        'per_class': {
+            lbl['label']: {
+                'pixels': int(pixels[c]),
+                'agreement': float(confusion[c, c] / pixels[c]) if pixels[c] else None,
+            }
+            for c, lbl in enumerate(labels)
+        },
+    }
+    for k, dt in dts.items():
+        res[f'{k}_tiles_per_s'] = len(tile_arrs) / dt if dt else None
+    res['speedup'] = (
+        dts['reference'] / dts['candidate'] if dts['candidate'] else None)
+    return res
@@ -1,10 +1,29 @@
+from collections import defaultdict
+
 import numpy as np
 from PIL import Image as PILImage
 
+from .config import *
+
+
+def pack_rgb(rgb_arr):
+    """Pack a (...,3) or (...,4) array of rgb(a) values into (...) uint32 keys 0xRRGGBB.
+
+    Alpha (if present) is ignored, and only one uint32 array gets allocated.
+    """
+    keys = rgb_arr[..., 0].astype(np.uint32)
+    keys <<= 8
+    keys |= rgb_arr[..., 1]
+    keys <<= 8
+    keys |= rgb_arr[..., 2]
+    return keys
+
 
 def image_rgb_to_cls_codes(rgb_arr, col2cls):
     """Convert image matrix of rgb values (x,w,3) to color codes (x,w).
 
+    Colors not in `col2cls` get code 0. An alpha channel (x,w,4) is ignored.
+
     Example
     -------
     >>> image_rgb_to_cls_codes(
@@ -17,16 +36,40 @@ def image_rgb_to_cls_codes(rgb_arr, col2cls):
 
     Parameters
     ----------
-    rgb_arr : x*w*3 np.array
+    rgb_arr : x*w*3 (or x*w*4) np.array
     col2cls : {(r:int, g:int, b:int) -> (code:int, label:str)}
 
     Returns
     -------
     x*w*1 np.array
     """
-    return np.apply_along_axis(
-        lambda rgb: col2cls.get(tuple(rgb), [0])[0], 2, rgb_arr
-    ).astype(np.uint8)
+    keys = pack_rgb(rgb_arr)
+    if not col2cls:
+        return np.zeros(keys.shape, dtype=np.uint8)
+    # sorted colors keys -> codes, so lookup is a (vectorized) binary search
+    col_keys = pack_rgb(np.array(list(col2cls.keys()), dtype=np.uint32))
+    col_codes = np.array([code for code, _ in col2cls.values()], dtype=np.uint8)
+    order = np.argsort(col_keys)
+    col_keys, col_codes = col_keys[order], col_codes[order]
+    idxs = np.searchsorted(col_keys, keys)
+    idxs[idxs == len(col_keys)] = 0
+    found = col_keys[idxs] == keys
+    codes = col_codes[idxs]
+    codes[~found] = 0
+    return codes
+
+
+def palette_to_cls_codes_lut(palette, col2cls):
+    """Map palette indices to class codes, from a PIL palette ([r, g, b, r, g, b, ...]).
+
+    Returns
+    -------
+    256 np.array of uint8 class codes (so `lut[palette_image_arr]` gives the codes)
+    """
+    palette_rgb = np.asarray(palette, dtype=np.uint8)[:256 * 3].reshape(-1, 3)
+    lut = np.zeros(256, dtype=np.uint8)
+    lut[:len(palette_rgb)] = image_rgb_to_cls_codes(palette_rgb, col2cls)
+    return lut
 
 
 def image_cls_codes_to_rgb(rgb_arr, cls2col):
@@ -51,11 +94,24 @@ def image_cls_codes_to_rgb(rgb_arr, cls2col):
     -------
     x*w*1 np.array
     """
-    r = np.zeros(rgb_arr.shape + (3,), dtype=np.uint8)
-    for i in range(rgb_arr.shape[0]):
-        for j in range(rgb_arr.shape[1]):
-            r[i, j, :] = cls2col.get(rgb_arr[i, j], [(0, 0, 0)])[0]
-    return r
+    return make_cls_palette(cls2col)[rgb_arr]
+
+
+def make_cls_palette(cls2col):
+    """Get a 256*3 lookup table <class code> -> rgb (codes not in cls2col are black).
+
+    Parameters
+    ----------
+    cls2col : {code:int -> (rgb:(r:int, g:int, b:int), label:str)}
+
+    Returns
+    -------
+    256*3 np.array of uint8
+    """
+    palette = np.zeros((256, 3), dtype=np.uint8)
+    for code, (rgb, _) in cls2col.items():
+        palette[code] = rgb
+    return palette
 
 
 def make_col2cls(labels):
@@ -105,24 +161,208 @@ def make_cls2cols(labels):
 
 
 def make_raw_mask(img, labels):
-    img_arr = np.asarray(img)
-    img_arr = img_arr[:, :, :3]  # ignore alpha
-    proc_img_arr = image_rgb_to_cls_codes(img_arr, make_col2cls(labels))
+    col2cls = make_col2cls(labels)
+    if img.mode == 'P':
+        # map the (max 256) palette colors instead of every pixel
+        lut = palette_to_cls_codes_lut(img.getpalette(), col2cls)
+        proc_img_arr = lut[np.asarray(img)]
+    else:
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGB')
+        # (alpha is ignored)
+        proc_img_arr = image_rgb_to_cls_codes(np.asarray(img), col2cls)
     return PILImage.fromarray(proc_img_arr)
 
 
-def make_nice_mask(img_or_arr, labels):
-    labels = labels.copy()
-    # make the __void__ label white
-    if labels[0]['label'] == '__void__':
-        labels[0]['rgb'] = (255, 255, 255)
+def make_nice_palette(labels):
+    """Palette for rendering class codes, with the __void__ label (if any) white."""
+    cls2col = make_cls2cols(labels)
+    if labels and labels[0]['label'] == '__void__':
+        cls2col[0] = ((255, 255, 255), labels[0]['label'])
+    return make_cls_palette(cls2col)
+
+
+def get_cls_codes_arr(img_or_arr):
+    """Class codes np.array from a raw mask (np.array or 'L'/'P' or grey RGB image)."""
     if isinstance(img_or_arr, np.ndarray):
-        img_arr = img_or_arr
-    else:
-        img = img_or_arr.convert(mode='L')
-        img_arr = np.asarray(img)
-    unproc_img_arr = image_cls_codes_to_rgb(
-        img_arr,
-        make_cls2cols(labels)
+        return img_or_arr
+    if img_or_arr.mode not in ('L', 'P'):
+        img_or_arr = img_or_arr.convert(mode='L')
+    return np.asarray(img_or_arr)
+
+
+def make_nice_mask(img_or_arr, labels):
+    """Render a raw mask as a 'P' mode image, with the labels' colors as palette.
+
+    (Pixels keep their class codes, so there's no rgb expansion.)
+    """
+    img = PILImage.fromarray(get_cls_codes_arr(img_or_arr).astype(np.uint8, copy=False))
+    img.putpalette(make_nice_palette(labels).tobytes())
+    return img
+
+
+def merge_roots(parent, u, v):
+    """Merge the sets of elements `u` and `v` (edges) into the union-find `parent`.
+
+    Vectorized: every round each set root is hooked to the smallest root it
+    touches, then paths are compressed by pointer jumping, so the number of
+    sets still being merged halves each round. Roots end up being the
+    smallest element of their set.
+
+    Returns
+    -------
+    parent : np.array, with every element pointing directly to its root
+    """
+    while len(u):
+        pu, pv = parent[u], parent[v]
+        # edges inside a set can't merge anything anymore
+        crossing = pu != pv
+        u, v, pu, pv = u[crossing], v[crossing], pu[crossing], pv[crossing]
+        if not len(u):
+            break
+        # --- hook: bigger root -> smallest root it touches
+        np.minimum.at(parent, np.maximum(pu, pv), np.minimum(pu, pv))
+        # --- compress: point everything directly to its root
+        while True:
+            grand_parent = parent[parent]
+            if (grand_parent == parent).all():
+                break
+            parent = grand_parent
+    return parent
+
+
+def label_islands(m, codes):
+    """Find 4-connected islands of same-code pixels, for the pixels with a code in `codes`.
+
+    Returns
+    -------
+    (pixels: flat indices of the pixels with a code in `codes`, in row-major order,
+     roots: flat index of the island root (its first pixel) of each of those pixels)
+    """
+    h, w = m.shape
+    idx_dtype = np.int32 if h * w < 2 ** 31 else np.int64
+    selected = np.isin(m, list(codes))
+    idx = np.arange(h * w, dtype=idx_dtype).reshape(h, w)
+
+    # --- edges between same code (selected) neighbour pixels
+    right = selected[:, :-1] & (m[:, :-1] == m[:, 1:])
+    down = selected[:-1, :] & (m[:-1, :] == m[1:, :])
+    u = np.concatenate([idx[:, :-1][right], idx[:-1, :][down]])
+    v = np.concatenate([idx[:, 1:][right], idx[1:, :][down]])
+
+    parent = merge_roots(idx.ravel().copy(), u, v)
+    pixels = np.flatnonzero(selected)
+    return pixels, parent[pixels]
+
+
+def _strip_islands(strip, codes, top):
+    """Islands of a strip of rows starting at row `top` (see count_islands).
+
+    Returns
+    -------
+    ({code, area, row_min, row_max, col_min, col_max: np.array per island, in
+      row-major order of their first pixel},
+     first_row_ids, last_row_ids: w np.array, island of each pixel of the strip's
+     first / last row, -1 for pixels without a code in `codes`)
+    """
+    h, w = strip.shape
+    first_row_ids = np.full(w, -1, dtype=np.int64)
+    last_row_ids = np.full(w, -1, dtype=np.int64)
+    pixels, roots = label_islands(strip, codes)
+    if not len(pixels):
+        return None, first_row_ids, last_row_ids
+
+    island_roots, island_ids = np.unique(roots, return_inverse=True)
+    n = len(island_roots)
+    rows, cols = np.divmod(pixels, w)
+    row_min, col_min = np.divmod(island_roots, w)
+    col_min = col_min.copy()
+    np.minimum.at(col_min, island_ids, cols)
+    row_max = np.zeros(n, dtype=rows.dtype)
+    np.maximum.at(row_max, island_ids, rows)
+    col_max = np.zeros(n, dtype=cols.dtype)
+    np.maximum.at(col_max, island_ids, cols)
+    islands = dict(
+        code=strip.ravel()[island_roots],
+        area=np.bincount(island_ids, minlength=n),
+        row_min=row_min + top,
+        row_max=row_max + top,
+        col_min=col_min,
+        col_max=col_max,
     )
-    return PILImage.fromarray(unproc_img_arr)
+
+    in_first_row = rows == 0
+    first_row_ids[cols[in_first_row]] = island_ids[in_first_row]
+    in_last_row = rows == h - 1
+    last_row_ids[cols[in_last_row]] = island_ids[in_last_row]
+    return islands, first_row_ids, last_row_ids
+
+
+def count_islands(m, codes, strip_pixels=None):
+    """Get the sizes of the 4-connected islands of pixels with the same code.
+
+    The mask is read and labelled in strips of rows (of about `strip_pixels`,
+    default COUNT_ISLANDS_STRIP_PIXELS, pixels), islands touching across strip
+    boundaries are merged after, so huge (memory-mapped) masks are never
+    processed whole.
+
+    Parameters
+    ----------
+    m : h*w np.array of class codes
+    codes : {code:int}, codes to find islands of
+
+    Returns
+    -------
+    {code -> [(area:int, h:int, w:int)]}, islands in row-major order of their first pixel
+    """
+    island_szs = defaultdict(list)
+    h, w = m.shape
+    strip_h = max(1, (strip_pixels or COUNT_ISLANDS_STRIP_PIXELS) // max(w, 1))
+
+    strips_islands = []
+    u, v = [], []  # : islands (global ids) touching across strip boundaries
+    n, prev_row_ids = 0, None
+    for top in range(0, h, strip_h):
+        strip = np.asarray(m[top:top + strip_h])
+        islands, first_row_ids, last_row_ids = _strip_islands(strip, codes, top)
+        if islands is not None:
+            first_row_ids[first_row_ids >= 0] += n
+            last_row_ids[last_row_ids >= 0] += n
+            strips_islands.append(islands)
+            n += len(islands['area'])
+        if prev_row_ids is not None:
+            # (same code neighbours on both sides of the boundary)
+            touching = ((prev_row_ids >= 0) & (first_row_ids >= 0)
+                        & (np.asarray(m[top - 1]) == strip[0]))
+            u.append(prev_row_ids[touching])
+            v.append(first_row_ids[touching])
+        prev_row_ids = last_row_ids
+    if not n:
+        return island_szs
+
+    islands = {k: np.concatenate([it[k] for it in strips_islands]) for k in strips_islands[0]}
+    # (global ids are in row-major order of the islands' first pixel, so are
+    # the roots of merged islands, the smallest of their ids)
+    parent = np.arange(n, dtype=np.int64)
+    if u:
+        parent = merge_roots(parent, np.concatenate(u), np.concatenate(v))
+    merged_roots, merged_ids = np.unique(parent, return_inverse=True)
+    n_merged = len(merged_roots)
+    areas = np.bincount(merged_ids, weights=islands['area'], minlength=n_merged).astype(np.int64)
+    row_min = islands['row_min'][merged_roots]
+    col_min = islands['col_min'][merged_roots].copy()
+    np.minimum.at(col_min, merged_ids, islands['col_min'])
+    row_max = islands['row_max'][merged_roots].copy()
+    np.maximum.at(row_max, merged_ids, islands['row_max'])
+    col_max = islands['col_max'][merged_roots].copy()
+    np.maximum.at(col_max, merged_ids, islands['col_max'])
+
+    for code, area, ih, iw in zip(
+        islands['code'][merged_roots].tolist(),
+        areas.tolist(),
+        (row_max - row_min + 1).tolist(),
+        (col_max - col_min + 1).tolist(),
+    ):
+        island_szs[code].append((area, ih, iw))
+
+    return island_szs
@@ -0,0 +1,169 @@
+"""
+Preprocessing of training data: tiling images and converting label images
+to raw masks, in a pool of worker processes, with outputs kept in the
+(content addressed, size bounded) preprocessing cache.
+
+Only needs numpy and PIL (no torch / fastai), so worker processes start quickly.
+"""
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+from PIL import Image as PILImage
+
+from .config import *
+from .cache import PreprocessingCache
+from .masks import make_nice_mask, make_raw_mask
+from .readers import open_image_reader
+from .tiles import iter_reader_tiles
+
+
+log = logging.getLogger(__name__)
+
+
+def get_img_size(image_path):
+    with open_image_reader(image_path) as reader:  # (header only, for most formats)
+        return reader.size
+
+
+preprocessing_cache = PreprocessingCache(
+    root=PREPROCESS_CACHE_PATH,
+    max_bytes=PREPROCESS_CACHE_MAX_BYTES,
+)
+
+
+def save_tiles(image_abs_path, dir_abs_path, size=None):
+    """Save the tiles of an image (read region by region, see
+    ml.tiles.iter_reader_tiles) as files named after their box."""
+    dir_abs_path.mkdir(parents=True)
+    # (.npy images get .png tiles)
+    suffix = '.png' if image_abs_path.suffix.lower() == '.npy' else image_abs_path.suffix
+    tile_abs_paths = []
+
+    # (with the image's own channels, so raw masks stay masks of codes)
+    with open_image_reader(image_abs_path, rgb=False) as reader:
+        palette = getattr(reader, 'palette', None)
+        for tile in iter_reader_tiles(reader, size, image_abs_path):
+            tile_img = PILImage.fromarray(np.ascontiguousarray(tile.arr))
+            if palette is not None:
+                tile_img.putpalette(palette)
+            # --- save, named after the [left, top, right, bottom] box it was cropped from
+            tile_abs_path = dir_abs_path / ('-'.join(map(str, tile.box)) + suffix)
+            tile_abs_paths.append(tile_abs_path)
+            tile_img.save(tile_abs_path)
+
+    return tile_abs_paths
+
+
+def get_tile_paths(image_abs_path, size=None, recreate=False):
+    """Get (make if not already in the preprocessing cache) the tile files of an image."""
+    tile_w, tile_h = size or TILE_SIZE
+    key = preprocessing_cache.make_key(image_abs_path, 'tiles', size=[tile_w, tile_h])
+    if recreate:
+        preprocessing_cache.invalidate(key)
+    dir_abs_path = preprocessing_cache.get_or_make(
+        key, lambda tmp_abs_path: save_tiles(image_abs_path, tmp_abs_path, size))
+    return sorted(dir_abs_path.iterdir())
+
+
+def map_preprocess(func, items, workers=None):
+    """Map `func` over `items` (in order), in a pool of `workers` processes.
+
+    Parameters
+    ----------
+    workers : int, default PREPROCESS_WORKERS (capped at the number of CPU cores, <= 1 -> no pool)
+    """
+    items = list(items)
+    workers = PREPROCESS_WORKERS if workers is None else workers
+    workers = min(workers, os.cpu_count() or 1, len(items))
+    if workers <= 1:
+        return list(map(func, items))
+    # ('spawn', since forking a process that already ran torch ops can deadlock;
+    # workers only unpickle functions of this module, so they don't import torch)
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        return list(pool.map(func, items))
+
+
+def _timed(func, *args, **kwargs):
+    t0 = time.perf_counter()
+    res = func(*args, **kwargs)
+    return res, time.perf_counter() - t0
+
+
+def _tile_image(image_path, size=None):
+    img_sz, dt_sz = _timed(get_img_size, image_path)
+    tile_paths, dt_tiles = _timed(get_tile_paths, image_path, size)
+    return img_sz, tile_paths, dt_sz + dt_tiles
+
+
+def get_images_tiles_path(image_paths, size=None, workers=None, timings=None):
+    """Get (make if not already existing) tiles of images, in parallel.
+
+    Parameters
+    ----------
+    workers : int, number of processes (see `map_preprocess`)
+    timings : dict, if given it's filled with {image_path -> seconds}
+
+    Returns
+    -------
+    (image_tiles: [(image_idx: int, [tile_path])],
+     image_szs: [(w: int, h: int)]), both in the order of image_paths
+
+    (Tiles are cached by content, so images with identical bytes share the
+    same tile paths: tiles are kept per image index, not looked up by path.)
+    """
+    image_tiles = []  # : [(image_idx, [tile_path])]
+    image_szs = []  # : [(w: int, h: int)]
+    image_res = map_preprocess(partial(_tile_image, size=size), image_paths, workers)
+    for image_idx, (image_path, (img_sz, image_tile_paths, dt)) in enumerate(
+            zip(image_paths, image_res)):
+        log.info(f"tiled {image_path} ({len(image_tile_paths)} tiles) in {dt:.2f}s")
+        if timings is not None:
+            timings[image_path] = dt
+        image_szs.append(img_sz)
+        image_tiles.append((image_idx, image_tile_paths))
+    return image_tiles, image_szs
+
+
+def get_raw_label_path(nice_label_abs_path, labels):
+    """Get (make if not already in the preprocessing cache) the raw mask of a label image."""
+    key = preprocessing_cache.make_key(
+        nice_label_abs_path, 'raw-label',
+        labels=[(lbl['label'], list(lbl['rgb'])) for lbl in labels])
+    return preprocessing_cache.get_or_make(
+        key,
+        lambda tmp_abs_path: make_raw_mask(
+            PILImage.open(nice_label_abs_path), labels
+        ).save(tmp_abs_path),
+        suffix='.png')
+
+
+def _make_raw_label(nice_label_abs_path, labels):
+    return _timed(get_raw_label_path, nice_label_abs_path, labels)
+
+
+def get_raw_label_paths(nice_label_abs_paths, labels, workers=None, timings=None):
+    """`get_raw_label_path` for many labels, in parallel (see `get_images_tiles_path`)."""
+    raw_label_abs_paths = []
+    label_res = map_preprocess(partial(_make_raw_label, labels=labels), nice_label_abs_paths, workers)
+    for nice_label_abs_path, (raw_label_abs_path, dt) in zip(nice_label_abs_paths, label_res):
+        log.info(f"converted label {nice_label_abs_path} in {dt:.2f}s")
+        if timings is not None:
+            timings[nice_label_abs_path] = dt
+        raw_label_abs_paths.append(raw_label_abs_path)
+    return raw_label_abs_paths
+
+
+def get_nice_label_path(raw_label_abs_path, labels):
+    nice_label_abs_path = LABELS_PATH / raw_label_abs_path.name
+    if not nice_label_abs_path.exists():
+        nice_label_abs_path.parent.mkdir(parents=True, exist_ok=True)
+        make_nice_mask(
+            PILImage.open(raw_label_abs_path), labels
+        ).save(nice_label_abs_path)
+    return nice_label_abs_path
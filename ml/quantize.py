@@ -0,0 +1,122 @@
+"""
+Post-training static int8 quantization of segmentation models, for CPU inference.
+
+Every Conv2d (with an eval mode BatchNorm2d right after it folded in) is
+swapped for an int8 one, wrapped to quantize its input and dequantize its
+output. Unlike whole graph quantization this doesn't need the model to be
+symbolically traceable (fastai's U-Nets pass encoder features around through
+forward hooks), and the convolutions are where nearly all the time goes.
+"""
+import copy
+import logging
+
+import torch
+from torch import nn
+
+from .config import *
+
+try:
+    import torch.quantization as tq
+except ImportError:  # (torch < 1.3)
+    tq = None
+
+
+log = logging.getLogger(__name__)
+
+
+def has_quantization_support():
+    quantized = getattr(torch.backends, 'quantized', None)
+    return tq is not None and quantized is not None and bool(quantized.supported_engines)
+
+
+def get_quantization_backend(name=None):
+    name = name or QUANTIZATION_BACKEND
+    supported = [e for e in torch.backends.quantized.supported_engines if e != 'none']
+    if name is None:
+        name = 'fbgemm' if 'fbgemm' in supported else 'qnnpack'
+    if name not in supported:
+        raise ValueError(f"unsupported quantization backend {name!r}, "
+                         f"expected one of {', '.join(supported)}")
+    return name
+
+
+def _has_hooks(module):
+    return bool(module._forward_hooks or module._forward_pre_hooks)
+
+
+def fold_batchnorms(model):
+    """
+    Fold BatchNorm2d's into the Conv2d right before them in nn.Sequential's
+    (in place, model must be in eval mode). Only Sequential's are looked at,
+    since only there is the order of children the order they're run in.
+
+    Returns
+    -------
+    number of folded BatchNorm2d's
+    """
+    from torch.nn.utils.fusion import fuse_conv_bn_eval
+    n = 0
+    for seq in [mod for mod in model.modules() if isinstance(mod, nn.Sequential)]:
+        names = list(seq._modules)
+        for conv_name, bn_name in zip(names, names[1:]):
+            conv, bn = seq._modules[conv_name], seq._modules[bn_name]
+            if (type(conv) is nn.Conv2d and type(bn) is nn.BatchNorm2d and
+                    not _has_hooks(conv) and not _has_hooks(bn)):
+                seq._modules[conv_name] = fuse_conv_bn_eval(conv, bn)
+                seq._modules[bn_name] = nn.Identity()
+                n += 1
+    return n
+
+
+def wrap_convs(model, qconfig):
+    """
+    Wrap every (quantizable) Conv2d in a QuantWrapper with `qconfig`, in place.
+
+    Returns
+    -------
+    number of wrapped Conv2d's
+    """
+    n = 0
+    for parent in list(model.modules()):
+        for name, child in list(parent._modules.items()):
+            if (type(child) is nn.Conv2d and not _has_hooks(child) and
+                    getattr(child, 'padding_mode', 'zeros') == 'zeros'):
+                child.qconfig = qconfig  # (QuantWrapper passes it on to its stubs)
+                wrapper = tq.QuantWrapper(child)
+                wrapper.qconfig = qconfig
+                parent._modules[name] = wrapper
+                n += 1
+    return n
+
+
+def quantize_model(model, calibrate, backend=None):
+    """
+    Parameters
+    ----------
+    model : float nn.Module (left untouched, a quantized copy is made)
+    calibrate : (prepared_model) -> None, runs representative inputs through
+        the model, so its observers record the ranges of conv activations
+    backend : quantized kernels backend (default: QUANTIZATION_BACKEND)
+
+    Returns
+    -------
+    (quantized model (on CPU, in eval mode), number of int8 convolutions)
+    """
+    if not has_quantization_support():
+        raise RuntimeError("int8 quantization needs a torch build with quantized "
+                           "CPU kernels (torch >= 1.3)")
+    backend = get_quantization_backend(backend)
+    torch.backends.quantized.engine = backend
+
+    model = copy.deepcopy(model).cpu().float().eval()
+    n_folded = fold_batchnorms(model)
+    n_convs = wrap_convs(model, tq.get_default_qconfig(backend))
+    if not n_convs:
+        raise ValueError("model has no convolutions to quantize")
+    tq.prepare(model, inplace=True)
+    with torch.no_grad():
+        calibrate(model)
+    tq.convert(model, inplace=True)
+    log.info(f"quantized {n_convs} convolutions ({n_folded} with batchnorm folded in), "
+             f"backend {backend!r}")
+    return model, n_convs
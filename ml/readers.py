@@ -0,0 +1,178 @@
+"""
+Lazy, region by region reading of (possibly huge, eg. whole-slide) images.
+
+- TiffReader: tiled / pyramidal TIFFs (and formats tifffile reads, eg. .svs),
+  only the chunks overlapping a region are decoded (needs the optional
+  `tifffile` and `zarr` packages)
+- NpyReader: h*w(*c) uint8 .npy arrays, memory-mapped
+- PILReader: anything else PIL opens, decoded whole on first read (as before)
+
+Use `open_image_reader` to get the right one for a file.
+"""
+import logging
+
+import numpy as np
+from PIL import Image as PILImage
+
+from .config import *
+
+try:
+    import tifffile
+    import zarr
+except ImportError:  # (optional, TIFFs are then read with PIL, whole)
+    tifffile = zarr = None
+
+
+log = logging.getLogger(__name__)
+
+TIFF_SUFFIXES = ('.tif', '.tiff', '.svs', '.ndpi', '.scn')
+
+
+def clamp_box(box, img_sz):
+    """The part of a [left, top, right, bottom] box inside an image of img_sz
+    (boxes of images smaller than a tile go over their edges, see
+    ml.tiles.get_tile_boxes)."""
+    w, h = img_sz
+    left, top, right, bottom = box
+    return [max(left, 0), max(top, 0), min(right, w), min(bottom, h)]
+
+
+def pad_to_box(arr, inner_box, box):
+    """Zero pad `arr`, the `inner_box` part of `box`, to the size of the whole box."""
+    if list(inner_box) == list(box):
+        return arr
+    left, top, right, bottom = box
+    padded = np.zeros((bottom - top, right - left) + arr.shape[2:], dtype=arr.dtype)
+    padded[inner_box[1] - top:inner_box[3] - top, inner_box[0] - left:inner_box[2] - left] = arr
+    return padded
+
+
+def crop_arr(arr, box):
+    """`box` of an image array (a view), zero padded where the box goes over
+    its edges (like PIL's Image.crop does)."""
+    inner_box = clamp_box(box, (arr.shape[1], arr.shape[0]))
+    left, top, right, bottom = inner_box
+    return pad_to_box(arr[top:bottom, left:right], inner_box, box)
+
+
+def as_rgb_arr(arr):
+    """h*w, h*w*1, h*w*3 or h*w*4 uint8 np.array -> h*w*3 uint8 np.array"""
+    if arr.ndim == 2:
+        arr = arr[:, :, None]
+    if arr.shape[2] == 1:
+        return np.repeat(arr, 3, axis=2)
+    return np.asarray(arr[:, :, :3])
+
+
+class ImageReader:
+    """
+    Base of image readers.
+
+    Attributes
+    ----------
+    size : (w, h) of the (full resolution) image
+    rgb : bool, regions are read as h*w*3 arrays, else with the image's own
+        channels (eg. h*w arrays of codes for raw masks)
+    """
+
+    size = None
+    rgb = True
+
+    def read_region(self, box):
+        """
+        [left, top, right, bottom] -> (bottom-top)*(right-left)*3 uint8 np.array
+        (see `rgb`), zero padded where the box goes over the image's edges
+        """
+        inner_box = clamp_box(box, self.size)
+        return pad_to_box(self.read_inner_region(inner_box), inner_box, box)
+
+    def read_inner_region(self, box):
+        """Like read_region, for a box inside the image."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PILReader(ImageReader):
+    """
+    Attributes
+    ----------
+    palette : palette of 'P' mode images read with rgb=False (whose regions are
+        arrays of palette indices), else None
+    """
+
+    def __init__(self, abs_path, rgb=True):
+        self.abs_path = abs_path
+        self.rgb = rgb
+        with PILImage.open(abs_path) as img:  # (only reads the header)
+            self.size = img.size
+            self.palette = img.getpalette() if img.mode == 'P' and not rgb else None
+            self._keep_mode = img.mode in ('L', 'P', 'RGB', 'RGBA') and not rgb
+        self._arr = None
+
+    def read_inner_region(self, box):
+        if self._arr is None:
+            img = PILImage.open(self.abs_path)
+            self._arr = np.asarray(img if self._keep_mode else img.convert('RGB'))
+        left, top, right, bottom = box
+        return self._arr[top:bottom, left:right]
+
+    def close(self):
+        self._arr = None
+
+
+class NpyReader(ImageReader):
+    def __init__(self, abs_path, rgb=True):
+        self.rgb = rgb
+        self._arr = np.load(abs_path, mmap_mode='r')
+        self.size = (self._arr.shape[1], self._arr.shape[0])
+
+    def read_inner_region(self, box):
+        left, top, right, bottom = box
+        region_arr = np.array(self._arr[top:bottom, left:right])
+        return as_rgb_arr(region_arr) if self.rgb else region_arr
+
+    def close(self):
+        self._arr = None
+
+
+class TiffReader(ImageReader):
+    """Reads the full resolution level (series 0, level 0) of a TIFF."""
+
+    def __init__(self, abs_path, rgb=True):
+        self.rgb = rgb
+        self._tif = tifffile.TiffFile(str(abs_path))
+        store = self._tif.series[0].aszarr(level=0)
+        self._arr = zarr.open(store, mode='r')
+        axes = self._tif.series[0].levels[0].axes
+        if axes[:2] == 'YX':
+            self.size = (self._arr.shape[1], self._arr.shape[0])
+        else:  # (eg. 'SYX' for planar RGB)
+            raise ValueError(f"{abs_path} has unsupported TIFF axes {axes!r}")
+
+    def read_inner_region(self, box):
+        left, top, right, bottom = box
+        region_arr = self._arr[top:bottom, left:right]
+        return as_rgb_arr(region_arr) if self.rgb else np.asarray(region_arr)
+
+    def close(self):
+        self._tif.close()
+
+
+def open_image_reader(abs_path, rgb=True):
+    """The ImageReader for an image file (by its extension), see ImageReader.rgb."""
+    suffix = Path(abs_path).suffix.lower()
+    if suffix == '.npy':
+        return NpyReader(abs_path, rgb)
+    if suffix in TIFF_SUFFIXES:
+        if tifffile is not None:
+            return TiffReader(abs_path, rgb)
+        log.warning(f"tifffile/zarr not installed, reading {abs_path} whole")
+    return PILReader(abs_path, rgb)
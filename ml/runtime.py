@@ -0,0 +1,155 @@
+import logging
+import os
+import re
+
+import torch
+
+from .config import *
+from ._utils import ifnone
+
+
+log = logging.getLogger(__name__)
+
+# : (profile name, slot) applied in this process
+_applied_profile = None
+
+
+def get_execution_profile(name=None):
+    name = name or EXECUTION_PROFILE
+    if name in EXECUTION_PROFILES:
+        return EXECUTION_PROFILES[name]
+    # 'shared-<n>' for any n, eg. for n worker processes sharing the box
+    match = re.fullmatch(r'shared-([1-9][0-9]*)', name)
+    if match:
+        return make_shared_profile(int(match.group(1)))
+    raise ValueError(f"unknown execution profile {name!r}, "
+                     f"expected one of {', '.join(EXECUTION_PROFILES)} or shared-<n>")
+
+
+def make_shared_profile(n):
+    """Profile for one of `n` concurrent processes, each on its share of cores."""
+    return dict(threads=1 / n, interop_threads=1, pin_cores=True, channels_last=True)
+
+
+def get_available_cores():
+    """Sorted ids of the cores this process may run on."""
+    return sorted(
+        os.sched_getaffinity(0) if hasattr(os, 'sched_getaffinity') else
+        range(os.cpu_count()))
+
+
+def get_profile_cores(profile, slot=None):
+    """
+    Returns
+    -------
+    (n_threads:int, cores:[int] to pin to, or None)
+    """
+    available_cores = get_available_cores()
+    threads = profile.get('threads', None)
+    if threads is None:
+        return None, None
+    if isinstance(threads, float):
+        threads = max(1, int(len(available_cores) * threads))
+    threads = min(threads, len(available_cores))
+    if not profile.get('pin_cores', False):
+        return threads, None
+    n_slots = max(1, len(available_cores) // threads)
+    slot = int(ifnone(slot, ifnone(EXECUTION_SLOT, os.getpid()))) % n_slots
+    return threads, available_cores[slot * threads:(slot + 1) * threads]
+
+
+def apply_execution_profile(name=None, slot=None):
+    """
+    Set torch threads (and optionally CPU affinity) for this process, from an
+    EXECUTION_PROFILES profile (default: EXECUTION_PROFILE).
+
+    Only the first profile applied in a process sticks (torch's inter-op
+    threads can't be changed once set), so this is cheap to call before any
+    training / inference. Once one is applied, `name=None` means "the profile
+    in effect" (a warning is only logged if another one is asked for).
+
+    Returns
+    -------
+    name of the profile in effect
+    """
+    global _applied_profile
+    if _applied_profile is not None:
+        if name is not None and name != _applied_profile[0]:
+            log.warning(f"execution profile {_applied_profile[0]!r} already applied, "
+                        f"ignoring {name!r}")
+        return _applied_profile[0]
+    name = name or EXECUTION_PROFILE
+
+    profile = get_execution_profile(name)
+    threads, cores = get_profile_cores(profile, slot)
+    if cores is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    if threads is not None:
+        torch.set_num_threads(threads)
+    if 'interop_threads' in profile and hasattr(torch, 'set_num_interop_threads'):
+        try:
+            torch.set_num_interop_threads(profile['interop_threads'])
+        except RuntimeError:  # (if any parallel work already happened)
+            log.warning("could not set torch inter-op threads")
+    log.info(f"execution profile {name!r}: threads={threads} cores={cores}")
+
+    _applied_profile = (name, slot)
+    return name
+
+
+def uses_channels_last(name=None):
+    if name is None and _applied_profile is not None:
+        name = _applied_profile[0]
+    return (
+        get_execution_profile(name).get('channels_last', False) and
+        hasattr(torch, 'channels_last'))
+
+
+def prepare_model(model, name=None):
+    """Put a model in the memory layout of the (applied) execution profile."""
+    if uses_channels_last(name):
+        model = model.to(memory_format=torch.channels_last)
+    return model
+
+
+def prepare_batch(xb, name=None):
+    """Put a NCHW input batch in the memory layout of the (applied) execution profile."""
+    if uses_channels_last(name):
+        xb = xb.contiguous(memory_format=torch.channels_last)
+    return xb
+
+
+def get_available_memory():
+    """Best effort estimate of the currently available RAM in bytes (or None)."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def get_process_rss():
+    """Resident memory of this process in bytes (or None)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def auto_predict_bs(size=None, mem_fraction=None, max_bs=None):
+    """Pick the number of tiles per forward pass that fits in available RAM."""
+    tile_w, tile_h = size or TILE_SIZE
+    mem_fraction = mem_fraction or PREDICT_MEM_FRACTION
+    max_bs = max_bs or PREDICT_MAX_BS
+    avail = get_available_memory()
+    if avail is None:
+        return 1
+    tile_bytes = tile_w * tile_h * 4 * PREDICT_ACTIVATION_CHANNELS
+    return int(max(1, min(max_bs, avail * mem_fraction // tile_bytes)))
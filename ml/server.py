@@ -0,0 +1,375 @@
+"""
+Long-lived inference server, shared by the processes predicting on a host.
+
+It keeps models loaded (once, however many callers use them) and runs tiles of
+concurrent requests for the same model through it together, in batches of up
+to `max_bs` tiles. A request waits at most `max_latency_ms` for others to
+batch with, before its batch runs anyway.
+
+Callers connect to a Unix socket (INFERENCE_SERVER_ADDRESS) and send either
+tiles (predicted as they are) or image paths (read and tiled by the server,
+so it must see the same files). Run it from the project root, eg.:
+
+    python -m ml.server --preload data/inference-models/<model>.pt
+
+and predict through it with `ml.api.predict(..., backend='server')` (or
+PREDICT_BACKEND = 'server').
+"""
+import argparse
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+from .config import *
+from .inference import (
+    is_inference_model_path,
+    load_inference_model,
+    load_result_arr,
+    make_nice_result,
+    make_result_arr,
+    release_result_arr,
+)
+from .readers import open_image_reader
+from .runtime import apply_execution_profile
+from .tiles import iter_reader_tiles, make_arr_from_tiles
+
+
+log = logging.getLogger(__name__)
+
+
+class InferenceServerError(Exception):
+    """A request failed server side."""
+
+
+def _get_authkey(authkey=None):
+    authkey = authkey or INFERENCE_SERVER_AUTHKEY
+    return authkey.encode() if isinstance(authkey, str) else authkey
+
+
+class _LearnerModel:
+    """InferenceModel-like wrapper of a Learner, for models without an exported
+    inference model (fastai is only imported if one is served)."""
+
+    def __init__(self, learner_abs_path):
+        from .core import learner_load
+        self.learner = learner_load(learner_abs_path, cache=False)
+        self.labels = None
+        self.tile_size = TILE_SIZE
+        self.precision = 'float32'
+
+    def predict_batch(self, tile_arrs):
+        from .core import predict_tiles
+        return list(predict_tiles(self.learner, tile_arrs, len(tile_arrs)))
+
+
+class Batcher:
+    """
+    Runs the tiles of all requests for a model in batches, in a thread of its own.
+
+    A batch starts with the oldest pending request and takes the ones after
+    it while they fit in `max_bs` tiles and its deadline (`max_latency_s`
+    after the first request came) hasn't passed.
+    """
+
+    def __init__(self, model, max_bs, max_latency_s, name=''):
+        self.model = model
+        self.max_bs = max_bs
+        self.max_latency_s = max_latency_s
+        self.batches = 0
+        self.tiles = 0
+        self._queue = queue.Queue()  # : (tile_arrs, Future, arrived_at) or None to stop
+        self._stopping = False
+        self._stop_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name=f'batcher-{name}', daemon=True)
+        self._thread.start()
+
+    def predict(self, tile_arrs):
+        """[h*w*3 uint8 np.array] -> [h*w uint8 np.array of class codes], blocks until done"""
+        futures = []
+        with self._stop_lock:
+            if self._stopping:
+                raise InferenceServerError("model unloaded")
+            # (requests bigger than a batch are split)
+            for i in range(0, len(tile_arrs), self.max_bs):
+                future = Future()
+                self._queue.put((tile_arrs[i:i + self.max_bs], future, time.monotonic()))
+                futures.append(future)
+        return [codes for future in futures for codes in future.result()]
+
+    def stop(self):
+        with self._stop_lock:
+            self._stopping = True
+            self._queue.put(None)
+        self._thread.join()
+
+    def stats(self):
+        return dict(
+            batches=self.batches,
+            tiles=self.tiles,
+            avg_bs=self.tiles / self.batches if self.batches else None,
+        )
+
+    def _run(self):
+        carried = []  # : request (or stop) that didn't fit in the previous batch
+        while True:
+            first = carried.pop() if carried else self._queue.get()
+            if first is None:
+                self._fail_pending(carried)
+                return
+            batch, n_tiles = [first], len(first[0])
+            deadline = first[2] + self.max_latency_s
+            while n_tiles < self.max_bs:
+                try:
+                    req = self._queue.get(timeout=max(0., deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if req is None or n_tiles + len(req[0]) > self.max_bs:
+                    carried.append(req)
+                    break
+                batch.append(req)
+                n_tiles += len(req[0])
+            self._run_batch(batch)
+
+    def _fail_pending(self, carried):
+        # (no request should be left once stopping, but none must be left waiting)
+        pending = list(carried)
+        while True:
+            try:
+                pending.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        for req in pending:
+            if req is not None:
+                req[1].set_exception(InferenceServerError("model unloaded"))
+
+    def _run_batch(self, batch):
+        tile_arrs = [tile_arr for tile_arrs, _, _ in batch for tile_arr in tile_arrs]
+        try:
+            codes = self.model.predict_batch(tile_arrs)
+        except Exception as exc:
+            for _, future, _ in batch:
+                future.set_exception(exc)
+            return
+        self.batches += 1
+        self.tiles += len(tile_arrs)
+        i = 0
+        for req_tile_arrs, future, _ in batch:
+            future.set_result(codes[i:i + len(req_tile_arrs)])
+            i += len(req_tile_arrs)
+
+
+class InferenceServer:
+    """
+    Parameters
+    ----------
+    address : Unix socket path (default: INFERENCE_SERVER_ADDRESS)
+    max_bs, max_latency_ms : see Batcher (default: INFERENCE_SERVER_MAX_BS /
+        INFERENCE_SERVER_MAX_LATENCY_MS)
+    authkey : shared secret clients must know (default: INFERENCE_SERVER_AUTHKEY)
+    """
+
+    def __init__(self, address=None, max_bs=None, max_latency_ms=None, authkey=None):
+        self.address = str(address or INFERENCE_SERVER_ADDRESS)
+        self.max_bs = max_bs or INFERENCE_SERVER_MAX_BS
+        self.max_latency_s = (max_latency_ms or INFERENCE_SERVER_MAX_LATENCY_MS) / 1000
+        self.authkey = _get_authkey(authkey)
+        self._batchers = {}  # : {model_path:str -> Batcher}
+        self._lock = threading.Lock()
+
+    def get_batcher(self, model_path):
+        model_path = str(model_path)
+        with self._lock:
+            if model_path not in self._batchers:
+                t0 = time.perf_counter()
+                model = (
+                    load_inference_model(model_path, cache=False)
+                    if is_inference_model_path(model_path) else
+                    _LearnerModel(model_path))
+                self._batchers[model_path] = Batcher(
+                    model, self.max_bs, self.max_latency_s, name=os.path.basename(model_path))
+                log.info(f"loaded {model_path} in {time.perf_counter() - t0:.2f}s")
+            return self._batchers[model_path]
+
+    def unload(self, model_path):
+        with self._lock:
+            batcher = self._batchers.pop(str(model_path), None)
+        if batcher:
+            batcher.stop()
+
+    # --- requests: {op, ...} -> {...}
+
+    def op_info(self, model_path):
+        model = self.get_batcher(model_path).model
+        return dict(labels=model.labels, tile_size=model.tile_size, precision=model.precision)
+
+    def op_predict_tiles(self, model_path, tile_arrs):
+        return dict(codes=self.get_batcher(model_path).predict(tile_arrs))
+
+    def op_predict_image(self, model_path, image_path):
+        """Huge images' results are sent as the path of the (temporary) .npy
+        they're written to, the client takes it over."""
+        batcher = self.get_batcher(model_path)
+        raw_result_arr = None
+        with open_image_reader(image_path) as reader:
+            tiles = iter_reader_tiles(reader, batcher.model.tile_size, image_path)
+            # (a row of tiles at a time, to batch with other requests meanwhile)
+            for _, row_tiles in itertools.groupby(tiles, key=lambda tile: tile.box[1]):
+                row_tiles = list(row_tiles)
+                codes = batcher.predict([tile.arr for tile in row_tiles])
+                if raw_result_arr is None:
+                    raw_result_arr = make_result_arr(reader.size)
+                make_arr_from_tiles(
+                    (tile._replace(arr=tile_codes) for tile, tile_codes in zip(row_tiles, codes)),
+                    make_arr=lambda img_sz: raw_result_arr)
+        if isinstance(raw_result_arr, np.memmap):
+            return dict(raw_result_path=str(release_result_arr(raw_result_arr)))
+        return dict(raw_result_arr=raw_result_arr)
+
+    def op_unload(self, model_path):
+        self.unload(model_path)
+        return {}
+
+    def op_stats(self):
+        with self._lock:
+            return dict(models={path: b.stats() for path, b in self._batchers.items()})
+
+    def handle(self, req):
+        req = dict(req)
+        op = req.pop('op', None)
+        handler = getattr(self, f'op_{op}', None)
+        if handler is None:
+            raise ValueError(f"unknown op {op!r}")
+        return handler(**req)
+
+    def serve_connection(self, conn):
+        with conn:
+            while True:
+                try:
+                    req = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    res = {'ok': True, **self.handle(req)}
+                except Exception as exc:
+                    log.exception(f"failed handling {req.get('op')!r} request")
+                    res = {'ok': False, 'error': f"{type(exc).__name__}: {exc}"}
+                conn.send(res)
+
+    def serve_forever(self):
+        if os.path.exists(self.address):  # (left over by a previous server)
+            os.unlink(self.address)
+        with Listener(self.address, family='AF_UNIX', authkey=self.authkey) as listener:
+            os.chmod(self.address, 0o600)
+            log.info(f"inference server listening on {self.address}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception:  # (eg. a client failing authentication)
+                    log.exception("failed accepting connection")
+                    continue
+                threading.Thread(target=self.serve_connection, args=(conn,), daemon=True).start()
+
+
+class InferenceClient:
+    """Connection to an InferenceServer (thread safe, requests of threads
+    sharing it are sent one after another)."""
+
+    def __init__(self, address=None, authkey=None):
+        self.address = str(address or INFERENCE_SERVER_ADDRESS)
+        self._conn = Client(self.address, family='AF_UNIX', authkey=_get_authkey(authkey))
+        self._lock = threading.Lock()
+
+    def request(self, op, **kwargs):
+        with self._lock:
+            self._conn.send({'op': op, **kwargs})
+            res = self._conn.recv()
+        if not res.pop('ok'):
+            raise InferenceServerError(res['error'])
+        return res
+
+    def model(self, model_path):
+        return RemoteModel(self, model_path)
+
+    def close(self):
+        self._conn.close()
+
+
+class RemoteModel:
+    """InferenceModel-like model served by an InferenceServer."""
+
+    def __init__(self, client, model_path):
+        self.client = client
+        self.model_path = str(model_path)
+        info = client.request('info', model_path=self.model_path)
+        self.labels = info['labels']
+        self.tile_size = tuple(info['tile_size'])
+        self.precision = info['precision']
+
+    def predict_batch(self, tile_arrs):
+        return self.client.request(
+            'predict_tiles', model_path=self.model_path, tile_arrs=list(tile_arrs))['codes']
+
+    def predict_image(self, image_path):
+        """-> h*w uint8 np.array of class codes (memory-mapped for huge images)"""
+        res = self.client.request(
+            'predict_image', model_path=self.model_path, image_path=str(image_path))
+        if 'raw_result_path' in res:
+            return load_result_arr(res['raw_result_path'])
+        return res['raw_result_arr']
+
+
+# : InferenceClient of this process
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """This process' (lazily connected) InferenceClient."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = InferenceClient()
+        return _client
+
+
+def iter_predict_images(model, labels, image_paths, bs=None):
+    """
+    Like ml.inference.iter_predict_images, for a RemoteModel (images are read,
+    tiled and predicted by the server, `bs` is up to it too).
+
+    Yields
+    ------
+    (image_path, raw_result_arr, nice_result_image), one image at a time
+    """
+    labels = labels or model.labels
+    for image_path in image_paths:
+        raw_result_arr = model.predict_image(image_path)
+        yield image_path, raw_result_arr, make_nice_result(raw_result_arr, labels)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--address', default=INFERENCE_SERVER_ADDRESS, help="Unix socket path")
+    parser.add_argument('--max-bs', type=int, default=INFERENCE_SERVER_MAX_BS)
+    parser.add_argument('--max-latency-ms', type=float, default=INFERENCE_SERVER_MAX_LATENCY_MS)
+    parser.add_argument('--execution-profile', choices=list(EXECUTION_PROFILES))
+    parser.add_argument('--preload', nargs='*', default=[], help="model paths to load upfront")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    apply_execution_profile(args.execution_profile)
+    server = InferenceServer(args.address, args.max_bs, args.max_latency_ms)
+    for model_path in args.preload:
+        server.get_batcher(model_path)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+"""Tiling images (in memory, region by region) and stitching per-tile results back together."""
+import itertools
+from collections import namedtuple
+from operator import attrgetter, itemgetter
+
+import numpy as np
+from PIL import Image as PILImage
+
+from .config import *
+from .readers import clamp_box, crop_arr, open_image_reader
+
+
+def get_tile_boxes(img_sz, size=None):
+    """Yield the [left, top, right, bottom] boxes of the tiles covering an image.
+
+    Tiles on the last row/column are shifted back inside the image, so they
+    overlap with the previous ones instead of going over the edges. Unless
+    the image is smaller than a tile: its tiles then go over the top / left
+    edges (and are zero padded there, see ml.readers.crop_arr).
+
+    Parameters
+    ----------
+    img_sz : (w:int, h:int)
+    size : (tile_w:int, tile_h:int), default TILE_SIZE
+    """
+    tile_w, tile_h = size or TILE_SIZE
+    w, h = img_sz
+    for y in range(0, h, tile_h):
+        for x in range(0, w, tile_w):
+            box = [x, y, x + tile_w, y + tile_h]
+            # if (last) box goes over edges, shift it back inside bounding area
+            # (yes, it will overlap with previous boxes)
+            if box[2] > w:
+                dx = box[2] - w
+                box[0] -= dx
+                box[2] -= dx
+            if box[3] > h:
+                dy = box[3] - h
+                box[1] -= dy
+                box[3] -= dy
+            yield box
+
+
+def load_image_arr(image_abs_path):
+    """Decode an image (once) to a h*w*3 uint8 np.array."""
+    return np.asarray(PILImage.open(image_abs_path).convert('RGB'))
+
+
+# a tile of an image:
+# - box : [left, top, right, bottom] in the source image
+# - arr : tile_h*tile_w(*c) np.array (eg. a view into the source image, or a predicted mask)
+# - image_path : source image path (if any)
+# - image_sz : (w, h) of the source image
+Tile = namedtuple('Tile', ['box', 'arr', 'image_path', 'image_sz'])
+
+
+def tile_slices(box):
+    """Array index for a [left, top, right, bottom] box."""
+    left, top, right, bottom = box
+    return slice(top, bottom), slice(left, right)
+
+
+def shift_box(box, dx, dy):
+    left, top, right, bottom = box
+    return [left + dx, top + dy, right + dx, bottom + dy]
+
+
+def iter_tiles(img_arr, size=None, image_path=None):
+    """Yield the tiles of an image, without copying or writing files.
+
+    Parameters
+    ----------
+    img_arr : h*w(*c) np.array
+    size : (tile_w:int, tile_h:int), default TILE_SIZE
+
+    Yields
+    ------
+    Tile, with .arr a view into img_arr (a zero padded copy for images smaller than a tile)
+    """
+    h, w = img_arr.shape[:2]
+    for box in get_tile_boxes((w, h), size):
+        yield Tile(box, crop_arr(img_arr, box), image_path, (w, h))
+
+
+def iter_reader_tiles(reader, size=None, image_path=None, tiles_per_read=None):
+    """Yield the tiles of an image, reading it region by region.
+
+    Each read covers `tiles_per_read` (default READ_REGION_TILES) tiles of a
+    row of tiles, so only about that much of the image is in memory at once
+    (for readers that decode lazily, see ml.readers).
+
+    Parameters
+    ----------
+    reader : ml.readers.ImageReader
+    size : (tile_w:int, tile_h:int), default TILE_SIZE
+
+    Yields
+    ------
+    Tile, with .arr a view into the region read
+    """
+    tiles_per_read = tiles_per_read or READ_REGION_TILES
+    # (boxes come row by row, left to right, all boxes of a row have the same top / bottom)
+    for _, row_boxes in itertools.groupby(get_tile_boxes(reader.size, size), key=itemgetter(1)):
+        row_boxes = list(row_boxes)
+        for i in range(0, len(row_boxes), tiles_per_read):
+            boxes = row_boxes[i:i + tiles_per_read]
+            left, top, right, bottom = boxes[0][0], boxes[0][1], boxes[-1][2], boxes[0][3]
+            region_arr = reader.read_region([left, top, right, bottom])
+            for box in boxes:
+                yield Tile(box, region_arr[:, box[0] - left:box[2] - left], image_path, reader.size)
+
+
+def iter_images_tiles(image_abs_paths, size=None):
+    """Yield the Tiles of all images.
+
+    Images are read lazily, one at a time and region by region (see
+    iter_reader_tiles), as their tiles are consumed.
+    """
+    for image_abs_path in image_abs_paths:
+        with open_image_reader(image_abs_path) as reader:
+            yield from iter_reader_tiles(reader, size, image_abs_path)
+
+
+def make_arr_from_tiles(tiles, img_sz=None, make_arr=None):
+    """Stitch (single channel) Tiles back together into one preallocated h*w uint8 np.array.
+
+    Parameters
+    ----------
+    tiles : iterable of Tile
+    img_sz : (w:int, h:int), default: .image_sz of the first tile
+    make_arr : (w, h) -> h*w uint8 np.array to stitch into (default: in memory
+        zeros, see also make_memmap_arr)
+    """
+    arr = None
+    for tile in tiles:
+        if arr is None:
+            w, h = img_sz or tile.image_sz
+            arr = make_arr((w, h)) if make_arr else np.zeros((h, w), dtype=np.uint8)
+        # (only the part of the tile inside the image, for images smaller than a tile)
+        inner_box = clamp_box(tile.box, (w, h))
+        left, top = tile.box[:2]
+        arr[tile_slices(inner_box)] = tile.arr[tile_slices(shift_box(inner_box, -left, -top))]
+    return arr
+
+
+def make_memmap_arr(abs_path, img_sz):
+    """A h*w uint8 np.array memory-mapped to a (new) .npy file, so results bigger
+    than RAM can be written to it tile by tile."""
+    w, h = img_sz
+    abs_path.parent.mkdir(parents=True, exist_ok=True)
+    return np.lib.format.open_memmap(str(abs_path), mode='w+', dtype=np.uint8, shape=(h, w))
+
+
+def pair_tiles(image_tiles, label_tiles):
+    """
+    Pair the tile files of images with the tile files of their labels.
+
+    Parameters
+    ----------
+    image_tiles, label_tiles : [(image_idx:int, [tile_path])], label of image
+        `image_idx` is the one with the same index, tile files are named by
+        their box (see ml.preprocessing.save_tiles)
+
+    Returns
+    -------
+    (tile_paths, label_tile_paths), label_tile_paths[i] is the label of tile_paths[i]
+    """
+    idx2label_tile_paths = dict(label_tiles)
+    tile_paths, label_tile_paths = [], []
+    for image_idx, image_tile_paths in image_tiles:
+        # : {box name -> label tile path}
+        box2label_tile_path = {p.stem: p for p in idx2label_tile_paths[image_idx]}
+        for tile_path in sorted(image_tile_paths, key=attrgetter('stem')):
+            if tile_path.stem not in box2label_tile_path:
+                raise ValueError(f"no label tile for {tile_path} (image {image_idx}), "
+                                 f"image and label sizes differ?")
+            tile_paths.append(tile_path)
+            label_tile_paths.append(box2label_tile_path[tile_path.stem])
+    return tile_paths, label_tile_paths
+
+
+def sample_tile_arrs(image_abs_paths, n, size=None, seed=0):
+    """`n` (copied) tile arrays picked uniformly at random among all the images' tiles.
+
+    Images are decoded one at a time and only the sampled tiles are kept.
+    """
+    rng = np.random.RandomState(seed)
+    sample = []
+    for i, tile in enumerate(iter_images_tiles(image_abs_paths, size)):
+        # (reservoir sampling)
+        if i < n:
+            sample.append(np.array(tile.arr))
+        else:
+            j = rng.randint(0, i + 1)
+            if j < n:
+                sample[j] = np.array(tile.arr)
+    return sample
+
+
+def split_train_valid_arrs(image_arrs, mask_arrs, valid_pct, seed=0):
+    """
+    Split images (and their masks) into disjoint training and validation parts.
+
+    Whole images are held out for validation, picked at random until they make
+    about `valid_pct` of the total area (at least one is kept for training). A
+    single image is split by rows instead: its last `valid_pct` rows are held out.
+    Parts are views, so memory-mapped arrays stay memory-mapped.
+
+    Returns
+    -------
+    (train_image_arrs, train_mask_arrs), (valid_image_arrs, valid_mask_arrs)
+    """
+    if valid_pct <= 0:
+        return (list(image_arrs), list(mask_arrs)), ([], [])
+    if len(image_arrs) == 1:
+        h = image_arrs[0].shape[0]
+        n_valid_rows = min(h - 1, max(1, int(round(h * valid_pct))))
+        if n_valid_rows < 1:
+            return (list(image_arrs), list(mask_arrs)), ([], [])
+        (image_arr,), (mask_arr,) = image_arrs, mask_arrs
+        return (
+            ([image_arr[:h - n_valid_rows]], [mask_arr[:h - n_valid_rows]]),
+            ([image_arr[h - n_valid_rows:]], [mask_arr[h - n_valid_rows:]]),
+        )
+
+    areas = [arr.shape[0] * arr.shape[1] for arr in image_arrs]
+    valid_area, target_area = 0, sum(areas) * valid_pct
+    valid_idxs = set()
+    for i in np.random.RandomState(seed).permutation(len(image_arrs))[:-1]:
+        if valid_area >= target_area:
+            break
+        valid_idxs.add(i)
+        valid_area += areas[i]
+    train_idxs = [i for i in range(len(image_arrs)) if i not in valid_idxs]
+    valid_idxs = sorted(valid_idxs)
+    return (
+        ([image_arrs[i] for i in train_idxs], [mask_arrs[i] for i in train_idxs]),
+        ([image_arrs[i] for i in valid_idxs], [mask_arrs[i] for i in valid_idxs]),
+    )
@@ -0,0 +1,62 @@
+import json
+
+from ml.cache import PreprocessingCache
+
+
+def make_entry(cache, key, nbytes=100):
+    def make(tmp_abs_path):
+        tmp_abs_path.mkdir()
+        (tmp_abs_path / 'data').write_bytes(b'x' * nbytes)
+    return cache.get_or_make(key, make)
+
+
+def test_lru_eviction(tmp_path):
+    cache = PreprocessingCache(tmp_path, max_bytes=250)
+    a = make_entry(cache, 'a')
+    make_entry(cache, 'b')
+    make_entry(cache, 'c')
+    assert not a.exists()
+    assert cache.stats()['entries'] == 2
+
+
+def test_pinned_entries_are_not_evicted(tmp_path):
+    cache = PreprocessingCache(tmp_path, max_bytes=250)
+    a = make_entry(cache, 'a')
+    with cache.pinned([a]) as missing:
+        assert missing == []
+        # (another cache instance, as another process would have)
+        other = PreprocessingCache(tmp_path, max_bytes=250)
+        b = make_entry(other, 'b')
+        make_entry(other, 'c')
+        assert a.exists()
+        assert not b.exists()
+    make_entry(cache, 'd')
+    assert not a.exists()
+    assert not list((tmp_path / cache.PINS_DIRNAME).iterdir())
+
+
+def test_pinning_evicted_entries(tmp_path):
+    cache = PreprocessingCache(tmp_path, max_bytes=250)
+    a = make_entry(cache, 'a')
+    make_entry(cache, 'b')
+    make_entry(cache, 'c')
+    with cache.pinned([a]) as missing:
+        assert missing == [a]
+        # (made again by the caller, then kept)
+        make_entry(cache, 'a')
+        make_entry(cache, 'd')
+        make_entry(cache, 'e')
+        assert a.exists()
+
+
+def test_pins_of_dead_processes_are_ignored(tmp_path):
+    cache = PreprocessingCache(tmp_path, max_bytes=250)
+    a = make_entry(cache, 'a')
+    # (a pin file nobody holds a lock on anymore)
+    stale_pin_abs_path = tmp_path / cache.PINS_DIRNAME / '1234-dead.json'
+    stale_pin_abs_path.parent.mkdir()
+    stale_pin_abs_path.write_text(json.dumps([a.name]))
+    make_entry(cache, 'b')
+    make_entry(cache, 'c')
+    assert not a.exists()
+    assert not stale_pin_abs_path.exists()
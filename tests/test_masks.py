@@ -0,0 +1,81 @@
+from collections import defaultdict, deque
+
+import numpy as np
+import pytest
+
+from ml.masks import count_islands
+
+
+def count_islands_bfs(m, codes):
+    """The original, per pixel breadth first search implementation."""
+    island_szs = defaultdict(list)
+    visited = np.zeros(m.shape, dtype=bool)
+    h, w = m.shape
+    for r in range(h):
+        for c in range(w):
+            if m[r, c] not in codes or visited[r, c]:
+                continue
+            code = m[r, c]
+            visited[r, c] = True
+            frontier = deque([(r, c)])
+            sz, r_min, c_min, r_max, c_max = 0, r, c, r, c
+            while frontier:
+                cr, cc = frontier.popleft()
+                sz += 1
+                r_min, r_max = min(r_min, cr), max(r_max, cr)
+                c_min, c_max = min(c_min, cc), max(c_max, cc)
+                for nr, nc in ((cr - 1, cc), (cr, cc - 1), (cr + 1, cc), (cr, cc + 1)):
+                    if (0 <= nr < h and 0 <= nc < w and not visited[nr, nc]
+                            and m[nr, nc] == code):
+                        visited[nr, nc] = True
+                        frontier.append((nr, nc))
+            island_szs[code].append((sz, r_max - r_min + 1, c_max - c_min + 1))
+    return island_szs
+
+
+def make_random_masks(n, seed=0):
+    rng = np.random.RandomState(seed)
+    for _ in range(n):
+        h, w = rng.randint(1, 40, 2)
+        n_codes = rng.randint(1, 5)
+        # (blocky masks too, so there are big, irregular islands)
+        block = rng.randint(1, 6)
+        m = rng.randint(0, n_codes, (h // block + 1, w // block + 1)).astype(np.uint8)
+        m = np.kron(m, np.ones((block, block), dtype=np.uint8))[:h, :w]
+        flip = rng.rand(h, w) < 0.1
+        m[flip] = rng.randint(0, n_codes, flip.sum())
+        codes = set(rng.choice(n_codes, rng.randint(1, n_codes + 1), replace=False).tolist())
+        yield m, codes
+
+
+def test_count_islands_matches_bfs():
+    for m, codes in make_random_masks(200):
+        assert dict(count_islands(m, codes)) == dict(count_islands_bfs(m, codes))
+
+
+def test_count_islands_in_strips_matches_bfs():
+    # (islands crossing strip boundaries, down to one row strips)
+    for strip_pixels in (1, 37, 200):
+        for m, codes in make_random_masks(100, seed=2):
+            assert (dict(count_islands(m, codes, strip_pixels=strip_pixels))
+                    == dict(count_islands_bfs(m, codes)))
+
+
+def test_count_islands_matches_scipy():
+    ndimage = pytest.importorskip('scipy.ndimage')
+    for m, codes in make_random_masks(50, seed=1):
+        counts = count_islands(m, codes)
+        for code in codes:
+            labelled, n = ndimage.label(m == code)
+            areas = sorted(np.bincount(labelled.ravel())[1:].tolist())
+            assert sorted(area for area, _, _ in counts.get(code, [])) == areas
+            assert len(counts.get(code, [])) == n
+
+
+def test_count_islands_spiral():
+    # one island winding around, the worst case for naive root hooking
+    m = np.zeros((9, 9), dtype=np.uint8)
+    m[0, :] = m[:, 8] = m[8, :] = m[2:, 0] = m[2, :7] = m[2:7, 6] = m[6, 2:7] = m[4:7, 2] = 1
+    assert dict(count_islands(m, {1})) == dict(count_islands_bfs(m, {1}))
+    assert len(count_islands(m, {1})[1]) == 1
+    assert dict(count_islands(m, {1}, strip_pixels=9)) == dict(count_islands_bfs(m, {1}))
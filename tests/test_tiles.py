@@ -0,0 +1,129 @@
+import numpy as np
+import pytest
+from PIL import Image as PILImage
+
+from ml.preprocessing import save_tiles
+from ml.readers import PILReader, crop_arr
+from ml.tiles import (
+    get_tile_boxes,
+    iter_reader_tiles,
+    iter_tiles,
+    make_arr_from_tiles,
+    pair_tiles,
+    split_train_valid_arrs,
+)
+
+
+def make_img_arr(w, h, seed=0):
+    return np.random.RandomState(seed).randint(1, 256, (h, w, 3)).astype(np.uint8)
+
+
+def test_tiles_cover_image_and_stitch_back():
+    img_arr = make_img_arr(450, 330)
+    tiles = list(iter_tiles(img_arr, (200, 200)))
+    assert all(tile.arr.shape == (200, 200, 3) for tile in tiles)
+    stitched = make_arr_from_tiles(tile._replace(arr=tile.arr[:, :, 0]) for tile in tiles)
+    assert (stitched == img_arr[:, :, 0]).all()
+
+
+def test_small_image_tiles_are_padded_like_pil_crop():
+    img_arr = make_img_arr(150, 120)
+    box, = get_tile_boxes((150, 120), (200, 200))
+    assert box == [-50, -80, 150, 120]
+
+    tile, = iter_tiles(img_arr, (200, 200))
+    expected = np.asarray(PILImage.fromarray(img_arr).crop(box))
+    assert tile.arr.shape == (200, 200, 3)
+    assert (tile.arr == expected).all()
+
+    stitched = make_arr_from_tiles([tile._replace(arr=tile.arr[:, :, 1])])
+    assert stitched.shape == (120, 150)
+    assert (stitched == img_arr[:, :, 1]).all()
+
+
+def test_small_image_reader_tiles(tmp_path):
+    img_arr = make_img_arr(90, 260)
+    image_path = tmp_path / 'small.png'
+    PILImage.fromarray(img_arr).save(image_path)
+    with PILReader(image_path) as reader:
+        tiles = list(iter_reader_tiles(reader, (200, 200), image_path))
+    assert [tile.box for tile in tiles] == [[-110, 0, 90, 200], [-110, 60, 90, 260]]
+    for tile in tiles:
+        assert tile.arr.shape == (200, 200, 3)
+        assert (tile.arr == crop_arr(img_arr, tile.box)).all()
+    stitched = make_arr_from_tiles(tile._replace(arr=tile.arr[:, :, 2]) for tile in tiles)
+    assert (stitched == img_arr[:, :, 2]).all()
+
+
+def make_tile_files(dir_path, img_sz, suffix):
+    dir_path.mkdir()
+    paths = []
+    for box in get_tile_boxes(img_sz, (200, 200)):
+        paths.append(dir_path / ('-'.join(map(str, box)) + suffix))
+        paths[-1].write_text(str(box))
+    return paths
+
+
+def test_pair_tiles_with_identical_masks(tmp_path):
+    # two images of different sizes whose (blank) masks have identical bytes,
+    # so their label tiles are one cached directory, shared
+    image_tiles = [
+        (0, make_tile_files(tmp_path / 'image-a', (400, 400), '.jpg')),
+        (1, make_tile_files(tmp_path / 'image-b', (400, 400), '.jpg')),
+        (2, make_tile_files(tmp_path / 'image-c', (600, 200), '.jpg')),
+    ]
+    blank_label_tile_paths = make_tile_files(tmp_path / 'blank-label', (400, 400), '.png')
+    label_tiles = [
+        (0, blank_label_tile_paths),
+        (1, blank_label_tile_paths),
+        (2, make_tile_files(tmp_path / 'label-c', (600, 200), '.png')),
+    ]
+
+    tile_paths, label_tile_paths = pair_tiles(image_tiles, label_tiles)
+
+    assert len(tile_paths) == len(label_tile_paths) == 4 + 4 + 3
+    assert [p.parent.name for p in tile_paths] == ['image-a'] * 4 + ['image-b'] * 4 + ['image-c'] * 3
+    assert [p.parent.name for p in label_tile_paths] == ['blank-label'] * 8 + ['label-c'] * 3
+    for tile_path, label_tile_path in zip(tile_paths, label_tile_paths):
+        assert tile_path.stem == label_tile_path.stem
+
+
+def test_pair_tiles_of_mismatched_sizes(tmp_path):
+    image_tiles = [(0, make_tile_files(tmp_path / 'image', (400, 400), '.jpg'))]
+    label_tiles = [(0, make_tile_files(tmp_path / 'label', (400, 200), '.png'))]
+    with pytest.raises(ValueError):
+        pair_tiles(image_tiles, label_tiles)
+
+
+def test_split_train_valid_holds_out_whole_images():
+    image_arrs = [make_img_arr(100, 100, seed) for seed in range(5)]
+    mask_arrs = [arr[:, :, 0] for arr in image_arrs]
+    (train_imgs, train_masks), (valid_imgs, valid_masks) = split_train_valid_arrs(
+        image_arrs, mask_arrs, 0.2)
+    assert len(train_imgs) == 4 and len(valid_imgs) == 1
+    train_ids = {id(arr) for arr in train_imgs}
+    assert not train_ids & {id(arr) for arr in valid_imgs}
+    assert all((img[:, :, 0] == mask).all() for img, mask in zip(train_imgs + valid_imgs,
+                                                                 train_masks + valid_masks))
+
+
+def test_split_train_valid_splits_single_image_by_rows():
+    img_arr = make_img_arr(100, 50)
+    (train_imgs, _), (valid_imgs, valid_masks) = split_train_valid_arrs(
+        [img_arr], [img_arr[:, :, 0]], 0.2)
+    assert train_imgs[0].shape[0] == 40 and valid_imgs[0].shape[0] == 10
+    assert (np.concatenate([train_imgs[0], valid_imgs[0]]) == img_arr).all()
+    assert valid_masks[0].shape == (10, 100)
+
+    (train_imgs, _), (valid_imgs, _) = split_train_valid_arrs([img_arr], [img_arr[:, :, 0]], 0)
+    assert train_imgs[0] is img_arr and not valid_imgs
+
+
+def test_save_tiles_keeps_mask_codes(tmp_path):
+    mask_arr = make_img_arr(450, 130)[:, :, 0] % 4
+    PILImage.fromarray(mask_arr).save(tmp_path / 'mask.png')
+    tile_paths = save_tiles(tmp_path / 'mask.png', tmp_path / 'tiles', (200, 200))
+    for tile_path, box in zip(tile_paths, get_tile_boxes((450, 130), (200, 200))):
+        tile_img = PILImage.open(tile_path)
+        assert tile_img.mode == 'L'
+        assert (np.asarray(tile_img) == crop_arr(mask_arr, box)).all()
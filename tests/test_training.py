@@ -0,0 +1,46 @@
+import itertools
+import time
+import types
+
+import numpy as np
+import pytest
+
+pytest.importorskip('fastai')
+
+import torch  # noqa: E402
+from fastai.basic_data import DataBunch  # noqa: E402
+from fastai.basic_train import Learner  # noqa: E402
+from fastai.metrics import accuracy  # noqa: E402
+from torch import nn  # noqa: E402
+
+from ml import core  # noqa: E402
+
+
+def make_learner(n_batches=20, bs=4):
+    torch.manual_seed(0)
+    x = torch.randn(n_batches * bs, 3)
+    y = (x[:, 0] > 0).long()
+    ds = torch.utils.data.TensorDataset(x, y)
+    data = DataBunch.create(ds, ds, bs=bs, num_workers=0)
+    return Learner(data, nn.Linear(3, 2), loss_func=nn.CrossEntropyLoss(), metrics=[accuracy])
+
+
+def test_time_budget_compresses_schedule(monkeypatch):
+    # (every epoch "takes" 10s, so 3 of the 10 planned fit the 35s budget)
+    clock = itertools.count(0, 10)
+    fake_time = types.SimpleNamespace(
+        **{k: getattr(time, k) for k in dir(time) if not k.startswith('_')},
+        monotonic=lambda: float(next(clock)))
+    monkeypatch.setattr(core, 'time', fake_time)
+
+    learner = make_learner()
+    lr_max, div_factor = 1e-2, 25.
+    res = core.learner_train(learner, dict(
+        epochs=10, lr=lr_max, div_factor=div_factor, time_budget_s=35,
+        on_epoch_done=None))
+
+    assert res['stop_reason'] == 'time_budget'
+    assert res['epochs_run'] == 3
+    # (annealed to the end of the, compressed, cycle)
+    final_div = div_factor * 1e4
+    assert np.isclose(learner.opt.lr, lr_max / final_div, rtol=1e-2)
@@ -125,6 +125,19 @@ export default class Step3Training extends Component {
           trainingInProgress: data.epoch === nEpochs ? false : true,
           trainingProgress: (data.epoch / nEpochs) * 100,
         });
+      } else if (
+        data.type === "training_batch_progress" &&
+        data.run === "validated"
+      ) {
+        // (rate limited server side, a few per second at most)
+        this.setState({
+          trainingProgress:
+            ((data.epoch + data.batch / data.n_batches) / data.epochs) * 100,
+        });
+      } else if (data.type === "training_done") {
+        // (sent right after weights are saved, predictions may come later
+        // in a "training_results" message, or not at all)
+        this.setState({trainingInProgress: false, trainingProgress: 100});
       }
     };
     // - close websocket